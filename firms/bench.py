@@ -0,0 +1,274 @@
+"""
+Benchmarks for ingest and query performance, and comparison of results against a saved baseline.
+
+Results are plain dictionaries, written out as JSON, of the form
+`{"meta": {...}, "ingest": {...}, "query": {"lookup": {...}, "<grader>": {...}}, "db": {...}, "memory": {...},
+"startup": {"python": {...}, "<command>": {...}, "heavy_imports": [...]}}`.
+"""
+
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+import music21
+import numpy as np
+from music21 import converter, corpus
+from music21 import stream as m21stream
+
+from firms.models import GraderLookup
+from firms.sampling import IndexSampler
+
+LATENCY_PERCENTILES = (50, 95, 99)
+
+# Metrics compared against a baseline, and whether higher values are better
+HIGHER_IS_BETTER = {
+    ('ingest', 'pieces_per_sec'): True,
+    ('ingest', 'snippets_per_sec'): True,
+    ('db', 'bytes_per_piece'): False,
+    ('memory', 'peak_rss_mb'): False
+}
+LATENCY_METRICS = ['p50_ms', 'p95_ms', 'p99_ms']
+
+# Commands timed by bench_startup, as arguments to `firms`, with {path} replaced by the index path.
+# They only read metadata, so shouldn't import any of HEAVY_MODULES
+STARTUP_COMMANDS = {
+    'help': ['--help'],
+    'composers': ['composers'],
+    'info general': ['info', 'general', '--path', '{path}'],
+    'info pieces': ['info', 'pieces', '--path', '{path}']
+}
+HEAVY_MODULES = ('music21', 'scipy', 'numpy', 'tabulate')
+# What the installed `firms` script runs. Unlike `python -m firms.command_line`, this imports the
+# command line from its cached bytecode instead of compiling it on every run
+FIRMS_SCRIPT = "import sys; from firms.command_line import cli; sys.exit(cli())"
+
+def corpus_paths(corpus_spec, limit=None):
+    """
+    List the score files in a benchmark corpus
+        :param corpus_spec: Either a directory of .xml and .mxl files, or `composer:<name>` for a music21 composer
+        :param limit=None: Maximum number of files, taken in sorted order
+    """
+    if corpus_spec.startswith('composer:'):
+        paths = [str(path) for path in corpus.getComposer(corpus_spec[len('composer:'):])]
+    else:
+        paths = [
+            os.path.join(root, filename)
+            for root, dirs, files in os.walk(corpus_spec)
+            for filename in files
+            if (filename.endswith('.xml') and not filename.endswith('.query.xml')) or filename.endswith('.mxl')
+        ]
+    paths = sorted(paths)
+    return paths[:limit] if limit else paths
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process, in megabytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def latency_summary(seconds):
+    """
+    Summarize a list of latencies in milliseconds
+        :param seconds: List of latencies, in seconds
+    """
+    milliseconds = np.asarray(seconds) * 1000
+    summary = {'count': len(seconds), 'mean_ms': float(milliseconds.mean()) if len(seconds) else None}
+    for percentile in LATENCY_PERCENTILES:
+        summary['p%s_ms' % percentile] = float(np.percentile(milliseconds, percentile)) if len(seconds) else None
+    return summary
+
+def bench_ingest(sql_ir_system, paths, explicit_repeats=False):
+    """
+    Parse and index every path, timing each stage. Pieces that fail to parse or index are counted and skipped
+        :param sql_ir_system: SqlIRSystem to add pieces to
+        :param paths: List of score file paths
+        :param explicit_repeats=False: Expand repeats before indexing
+    """
+    parse_sec = 0.0
+    index_sec = 0.0
+    failed = 0
+    for path in paths:
+        print("Adding piece %s" % path)
+        try:
+            start = time.perf_counter()
+            stream = converter.parse(path)
+            parse_sec = parse_sec + time.perf_counter() - start
+            start = time.perf_counter()
+            for piece in stream.recurse(classFilter=m21stream.Score, skipSelf=False):
+                sql_ir_system.add_piece(piece, path, explicit_repeats)
+            index_sec = index_sec + time.perf_counter() - start
+        except Exception:
+            print("\tUnable to process piece %s" % path)
+            traceback.print_exc()
+            failed = failed + 1
+    counts = sql_ir_system.info()
+    total_sec = parse_sec + index_sec
+    return {
+        'files': len(paths),
+        'failed': failed,
+        'pieces': counts['pieces'],
+        'snippets': counts['snippets'],
+        'entries': counts['entries'],
+        'parse_sec': parse_sec,
+        'index_sec': index_sec,
+        'pieces_per_sec': counts['pieces'] / total_sec if total_sec else None,
+        'snippets_per_sec': counts['snippets'] / total_sec if total_sec else None
+    }
+
+def sample_queries(sql_ir_system, number_of_queries, seed, minsize=3, maxsize=7):
+    """
+    Draw query streams from the notes stored in the index, each from its own seeded generator
+        :param sql_ir_system: SqlIRSystem with stored part notes
+        :param number_of_queries: Number of queries
+        :param seed: Seed choosing the pieces and samples
+        :param minsize=3: Minimum sample size (in measures)
+        :param maxsize=7: Maximum sample size (in measures)
+    """
+    sampler = IndexSampler(sql_ir_system)
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(number_of_queries):
+        if not sampler.pieces:
+            break
+        detail, sequence = sampler.sample(rng.choice(sampler.pieces), random.Random(rng.randrange(2**32)), minsize, maxsize)
+        if len(sequence):
+            queries.append(sequence.to_stream())
+    return queries
+
+def bench_queries(sql_ir_system, queries):
+    """
+    Time each query. The plan and stem lookups are shared by every grader, so they are timed once
+    as `lookup`; the latency of each grader is the lookup time plus the time it takes to aggregate
+    and grade the matches
+        :param sql_ir_system: SqlIRSystem to query
+        :param queries: List of music21 query streams
+    """
+    corpus_size = sql_ir_system.corpus_size()
+    latencies = {'lookup': []}
+    latencies.update({grader_name: [] for grader_name in sql_ir_system.grader_methods})
+    for query in queries:
+        start = time.perf_counter()
+        plan = sql_ir_system.plan_query(query)
+        lookups = [
+            (query_stem, multiplicity, GraderLookup(stemmer=query_stem.stemmer, lookup=lookup_results, query_offsets=tuple(plan.offsets.get(query_stem, ()))))
+            for query_stem, multiplicity, lookup_results in sql_ir_system.execute_plan(plan)
+        ]
+        lookup_sec = time.perf_counter() - start
+        latencies['lookup'].append(lookup_sec)
+        for grader_name, grader in sql_ir_system.grader_methods.items():
+            start = time.perf_counter()
+            accumulator = grader.accumulator()
+            for query_stem, multiplicity, matches in lookups:
+                accumulator.aggregate(matches, multiplicity)
+            accumulator.grade(corpus_size)
+            latencies[grader_name].append(lookup_sec + time.perf_counter() - start)
+    return {name: latency_summary(seconds) for name, seconds in latencies.items()}
+
+def firms_process_env():
+    """
+    Environment for running firms in a subprocess, able to import this copy of the package
+    """
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    return env
+
+def heavy_imports():
+    """
+    List the HEAVY_MODULES imported by just importing the command line
+    """
+    script = "import sys, firms.command_line; print(' '.join(name for name in %r if name in sys.modules))" % (HEAVY_MODULES,)
+    output = subprocess.run([sys.executable, '-c', script], env=firms_process_env(), check=True, capture_output=True, text=True).stdout
+    return output.split()
+
+def bench_startup(dbpath, runs=5, commands=STARTUP_COMMANDS):
+    """
+    Time commands from process start to exit, against an interpreter that does nothing
+        :param dbpath: Path to the index used by commands taking --path
+        :param runs=5: Number of times to run each command
+        :param commands=STARTUP_COMMANDS: Dictionary from name to `firms` arguments
+    """
+    env = firms_process_env()
+    def time_process(args):
+        start = time.perf_counter()
+        subprocess.run(args, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - start
+    results = {'python': latency_summary([time_process([sys.executable, '-c', 'pass']) for _ in range(runs)])}
+    for name, args in commands.items():
+        args = [sys.executable, '-c', FIRMS_SCRIPT] + [arg.replace('{path}', dbpath) for arg in args]
+        results[name] = latency_summary([time_process(args) for _ in range(runs)])
+    results['heavy_imports'] = heavy_imports()
+    return results
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'music21': music21.__version__,
+        'platform': platform.platform()
+    }
+
+def run_benchmark(sql_ir_system, corpus_spec, paths, number_of_queries, seed, startup_runs=5):
+    """
+    Ingest paths into an empty SqlIRSystem, then query it with samples drawn from the index
+        :param sql_ir_system: Empty SqlIRSystem
+        :param corpus_spec: Description of the corpus, recorded in the results
+        :param paths: List of score file paths
+        :param number_of_queries: Number of queries to time
+        :param seed: Seed for query sampling
+        :param startup_runs=5: Number of times to time each startup command against the index; 0 to skip
+    """
+    ingest = bench_ingest(sql_ir_system, paths)
+    queries = sample_queries(sql_ir_system, number_of_queries + 1, seed)
+    # The first query warms the page cache and isn't timed
+    if queries:
+        sql_ir_system.query(queries[0])
+    db_bytes = os.path.getsize(sql_ir_system.dbpath)
+    results = {
+        'meta': dict(environment(), corpus=corpus_spec, queries=max(0, len(queries) - 1), seed=seed),
+        'ingest': ingest,
+        'query': bench_queries(sql_ir_system, queries[1:]),
+        'db': {
+            'bytes': db_bytes,
+            'bytes_per_piece': db_bytes / ingest['pieces'] if ingest['pieces'] else None
+        },
+        'memory': {'peak_rss_mb': peak_rss_mb()}
+    }
+    if startup_runs:
+        results['startup'] = bench_startup(sql_ir_system.dbpath, startup_runs)
+    return results
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Compare benchmark results against a baseline.
+    Returns a list of (metric, baseline value, current value, relative change, regressed) tuples,
+    where a metric regresses if it is worse than the baseline by more than threshold
+        :param results: Benchmark results
+        :param baseline: Baseline benchmark results
+        :param threshold: Allowed relative slowdown, e.g. 0.1 for 10%
+    """
+    metrics = dict(HIGHER_IS_BETTER)
+    for name in sorted(set(results.get('query', {})) & set(baseline.get('query', {}))):
+        for metric in LATENCY_METRICS:
+            metrics[('query', name, metric)] = False
+    for name in sorted(set(results.get('startup', {})) & set(baseline.get('startup', {}))):
+        if isinstance(results['startup'][name], dict):
+            metrics[('startup', name, 'p50_ms')] = False
+    comparisons = []
+    for keys, higher_is_better in metrics.items():
+        current, previous = results, baseline
+        for key in keys:
+            current = current.get(key) if isinstance(current, dict) else None
+            previous = previous.get(key) if isinstance(previous, dict) else None
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        regressed = -change > threshold if higher_is_better else change > threshold
+        comparisons.append(('.'.join(keys), previous, current, change, regressed))
+    return comparisons
@@ -1,25 +1,38 @@
 """Fuzzy Information Retrieval for Music Scores"""
 
-from operator import attrgetter
+from operator import attrgetter, itemgetter
+from functools import partial
+import heapq
 import random
-from itertools import groupby
-from scipy import stats
 import csv
 from abc import ABCMeta, abstractmethod
+import json
+import sys
 import traceback
 import os
+import shutil
+import tempfile
 import time
 
-from music21 import converter, corpus, note, stream
-from music21 import stream as m21stream
-from tabulate import tabulate
 import click
 
-from firms.sql_irsystems import SqlIRSystem
-from firms.graders import Bm25Grader, LogWeightedSumGrader
+from firms.profiling import profiler
+from firms.sql_irsystems import SqlIRSystem, SCHEMA_VERSION
+from firms.fuzzy import MAX_FUZZY_DISTANCE
+from firms.models import QueryBudget
+from firms.planner import CostPlanner
+from firms.sql_tracing import sql_tracer
+from firms.graders import AlignmentGrader, Bm25Grader, LogWeightedSumGrader, update_with_sum
 from firms.stemmers import index_key_by_pitch, index_key_by_simple_pitch, index_key_by_interval,\
     index_key_by_contour, index_key_by_rythm, index_key_by_normalized_rythm
 
+def tabulate(*args, **kwargs):
+    """
+    Format a table with tabulate, which is only imported once a command prints a table
+    """
+    from tabulate import tabulate as format_table
+    return format_table(*args, **kwargs)
+
 valid_chars = '-_.() abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
 
 index_methods = {
@@ -36,6 +49,8 @@ grader_methods = {
     'BM25': Bm25Grader(),
     'LogWeightedSumGrader': LogWeightedSumGrader(weights2)
 }
+# Stemmers with short postings, looked up for every piece by the first stage of --rerank
+stage_one_stemmers = ['By Pitch', 'By Interval']
 
 composers_list = [
     "airdsAirs",
@@ -81,57 +96,63 @@ class TranscriptionErrorType():
         self.efunction = efunction
         self.name = name
 
-    def introduce_error(self, sample_stream):
-        return self.efunction(sample_stream)
+    def introduce_error(self, sample_stream, rng=random):
+        return self.efunction(sample_stream, rng)
 
-def add_piece_to_index(piecepath, path, explicit_repeats=False):
+def add_piece_to_index(piecepath, path, explicit_repeats=False, replace=False):
+    from music21 import converter
+    from music21 import stream as m21stream
     sqlIrSystem = connect(path)
-    stream = converter.parse(piecepath)
-    for piece in stream.recurse(classFilter=m21stream.Score, skipSelf=False):
-        sqlIrSystem.add_piece(piece, piecepath, explicit_repeats)
+    with profiler.stage('parse'):
+        stream = converter.parse(piecepath)
+    sqlIrSystem.add_scores(list(stream.recurse(classFilter=m21stream.Score, skipSelf=False)), piecepath, explicit_repeats, replace)
 
 def clean_file_name(filename):
     return ''.join([i for i in filename if i in valid_chars])
 
-def new_random_note_or_rest():
+def new_random_note_or_rest(rng=random):
+    from music21 import note
     new_note = None
-    new_duration = random.choice(durations)
-    if random.random() < .5:
-        new_pitch = random.choice(note_names)
-        new_accidental = random.choice(accidentals)
-        new_octave = random.choice(octaves)
+    new_duration = rng.choice(durations)
+    if rng.random() < .5:
+        new_pitch = rng.choice(note_names)
+        new_accidental = rng.choice(accidentals)
+        new_octave = rng.choice(octaves)
         new_note = note.Note(new_pitch, new_accidental, new_octave, type=new_duration)
     else:
         new_note = note.Rest(type=new_duration)
     return new_note
 
-def add_note_error(sample_stream):
+def add_note_error(sample_stream, rng=random):
+    from music21 import stream
     result = stream.Stream(sample_stream)
-    random_note_idx = random.randint(0, len(result.notesAndRests))
+    random_note_idx = rng.randint(0, len(result.notesAndRests))
     print("\tIntroducing error: Note add")
-    new_note = new_random_note_or_rest()
+    new_note = new_random_note_or_rest(rng)
     result.insert(random_note_idx, new_note)
     return result
 
-def remove_note_error(sample_stream):
+def remove_note_error(sample_stream, rng=random):
+    from music21 import note, stream
     result = stream.Stream(sample_stream)
-    random_note_idx = random.randint(0, len(result.notesAndRests))
+    random_note_idx = rng.randint(0, len(result.notesAndRests))
     print("\tIntroducing error: Note remove")
     random_note = result.getElementAtOrBefore(random_note_idx, [note.Rest, note.Note])
     result.remove(random_note, firstMatchOnly=True, shiftOffsets=True)
     return result
 
-def replace_note_error(sample_stream):
+def replace_note_error(sample_stream, rng=random):
+    from music21 import note, stream
     result = stream.Stream(sample_stream)
-    random_note_idx = random.randint(0, len(result.notesAndRests))
+    random_note_idx = rng.randint(0, len(result.notesAndRests))
     print("\tIntroducing error: Note replace")
     random_note = result.getElementAtOrBefore(random_note_idx, [note.Rest, note.Note])
-    result.replace(random_note, new_random_note_or_rest())
+    result.replace(random_note, new_random_note_or_rest(rng))
     return result
 
-def transposition_error(sample_stream):
+def transposition_error(sample_stream, rng=random):
     print("Introducing error: transposition")
-    return sample_stream.transpose(random.randint(-5,5))
+    return sample_stream.transpose(rng.randint(-5,5))
 
 def build_error_types(add_note_error_rate, remove_note_error_rate, replace_note_error_rate, transposition_error_rate):
     return [
@@ -141,33 +162,179 @@ def build_error_types(add_note_error_rate, remove_note_error_rate, replace_note_
         TranscriptionErrorType(transposition_error_rate, transposition_error, 'Transposition Error')
     ]
 
-def introduce_error(sample_stream, erate, transcription_error_types):
+def introduce_error(sample_stream, erate, transcription_error_types, rng=random):
     # Sample erate. If false, return
-    if random.random() > erate:
+    if rng.random() > erate:
         return sample_stream
     # Combine error types into a single distribution, sample to select an error type
     cumulative_error_type = 0
-    error_type_sample = random.random()
+    error_type_sample = rng.random()
     for tet in transcription_error_types:
         cumulative_error_type = cumulative_error_type + tet.error_rate
         if error_type_sample <= cumulative_error_type:
             print("Introducing error type %s" % tet.name)
-            return tet.introduce_error(sample_stream) 
+            return tet.introduce_error(sample_stream, rng)
     print("Error type sample: %s" % error_type_sample)
     print("%s" % (transcription_error_types))
     print("No error added")
     return sample_stream
 
-def connect(path):
-    return SqlIRSystem(path, index_methods, grader_methods, [], False)
+def parse_snippet_lengths(length_options):
+    """
+    Parse --lengths options into a dictionary from stemmer name to snippet lengths.
+    Each option is either a list of lengths applied to every stemmer, e.g. `3,5,8`,
+    or a list of lengths for a single stemmer, e.g. `By Pitch=3,5,8`
+        :param length_options: Sequence of option strings
+    """
+    snippet_lengths = {}
+    for option in length_options:
+        stemmer_names, _, lengths = option.rpartition('=')
+        stemmer_names = [stemmer_names] if stemmer_names else index_methods.keys()
+        for stemmer_name in stemmer_names:
+            if stemmer_name not in index_methods:
+                raise click.BadParameter("Unknown stemmer %s" % stemmer_name, param_hint='--lengths')
+            snippet_lengths[stemmer_name] = [int(length) for length in lengths.split(',')]
+    return snippet_lengths
+
+def connect(path, query_workers=1):
+    if os.path.isdir(path):
+        from firms.sharded_irsystems import ShardedIRSystem
+        return ShardedIRSystem(path, index_methods, grader_methods, query_workers=query_workers)
+    return SqlIRSystem(path, index_methods, grader_methods, [], False, query_workers=query_workers)
+
+def add_paths_to_shards(irsystem, piece_paths, explicit_repeats=False, replace=False):
+    """
+    Add score files to a sharded index, one writer process per shard, reporting any failures
+    """
+    added, failures = irsystem.add_paths(piece_paths, explicit_repeats, replace)
+    for piece_path, _ in failures:
+        print("\tUnable to process piece %s" % piece_path)
+    print("Added %s pieces to %s shards" % (added, irsystem.number_of_shards))
+
+# The index opened by init_worker in each worker process
+worker_system = None
+# Sampler over the notes stored in worker_system, created on first use
+worker_sampler = None
+
+def init_worker(path, workers):
+    """
+    Open the index once per worker process
+    """
+    global worker_system, worker_sampler
+    if sql_tracer.enabled:
+        from multiprocessing.util import Finalize
+        # Worker processes exit without running atexit handlers, so save their statistics on shutdown
+        Finalize(None, sql_tracer.save, exitpriority=10)
+    worker_system = connect(path, workers)
+    worker_sampler = None
+
+def get_worker_sampler():
+    """
+    Return the worker's IndexSampler, reading the list of stored parts once per worker process
+    """
+    global worker_sampler
+    from firms.sampling import IndexSampler
+    if worker_sampler is None:
+        worker_sampler = IndexSampler(worker_system)
+    return worker_sampler
 
 @click.command()
 @click.argument('path')
-def create(path):
+@click.option('--lengths', multiple=True, help="Snippet lengths to index, e.g. `3,5,8` for all stemmers or `By Pitch=3,5,8` for one. May be repeated; defaults to 5")
+@click.option('--shards', default=None, type=click.IntRange(min=1), help="Partition the index across this many files in the directory PATH")
+def create(path, lengths, shards):
     """
     Create or overwrite a existing FIRMs index at the provided path.
+
+    Queries use the longest indexed snippet length that fits within the query, so
+    indexing several lengths lets short queries match and long queries stay selective.
+
+    With --shards, PATH is a directory of shard files. Pieces are spread across shards by path,
+    added by one process per shard, and every query searches all shards in parallel.
+    """
+    if shards:
+        from firms.sharded_irsystems import ShardedIRSystem, shard_paths
+        if os.path.isdir(path):
+            for shard_path in shard_paths(path):
+                os.remove(shard_path)
+        ShardedIRSystem(path, index_methods, grader_methods, shards, parse_snippet_lengths(lengths))
+    else:
+        SqlIRSystem(path, index_methods, grader_methods, [], True, parse_snippet_lengths(lengths))
+
+@click.command()
+@click.argument('output')
+@click.argument('sources', nargs=-1, required=True)
+def merge(output, sources):
+    """
+    Merge FIRMs indexes into the index at OUTPUT, creating it if needed.
+
+    Each source is a database file or a sharded index directory. Pieces already in
+    OUTPUT, or in an earlier source, are skipped by path. Stems shared by several
+    sources are stored once.
     """
-    SqlIRSystem(path, index_methods, grader_methods, [], True)
+    start = time.time()
+    source_paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            from firms.sharded_irsystems import shard_paths
+            source_paths.extend(shard_paths(source))
+        else:
+            source_paths.append(source)
+    # Sources are attached by URI, to open them read-only
+    with sql_tracer.connect(output, uri=True) as conn:
+        if SqlIRSystem.schema_version(conn) != SCHEMA_VERSION:
+            SqlIRSystem.ensure_db(conn)
+        for source_path in source_paths:
+            try:
+                counts = SqlIRSystem.merge(conn, source_path)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+            print("Merged %s: %s pieces, %s entries; skipped %s pieces already indexed" % (
+                source_path, counts['pieces'], counts['entries'], counts['skipped']))
+    print("Ellapsed time: %s sec" % (time.time() - start))
+
+@click.command()
+@click.argument('pieces', nargs=-1)
+@click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
+@click.option('--orphans', is_flag=True, help="Also delete stems left without entries by earlier merges or edits")
+def remove(pieces, path, orphans):
+    """
+    Remove pieces, given by id or by the path they were added from.
+
+    A piece's parts, snippets and postings are deleted with it, along with any
+    stems no other piece uses, so later queries rank as if it was never added.
+    """
+    sqlIRSystem = connect(path)
+    piece_ids = []
+    for piece in pieces:
+        ids = [int(piece)] if piece.isdigit() else sqlIRSystem.piece_ids_by_path(piece)
+        if not ids or (piece.isdigit() and not sqlIRSystem.piece_by_id(ids[0])):
+            print("No piece found matching %s" % piece)
+        piece_ids.extend(ids)
+    counts = sqlIRSystem.remove_pieces(piece_ids)
+    print("Removed %s" % ', '.join("%s %s" % (count, table) for table, count in counts.items()))
+    if orphans:
+        shards = getattr(sqlIRSystem, 'shards', [sqlIRSystem])
+        stems = 0
+        for shard in shards:
+            with sql_tracer.connect(shard.dbpath) as conn:
+                stems = stems + SqlIRSystem.delete_orphan_stems(conn)
+        print("Removed %s orphaned stems" % stems)
+
+@click.command("fuzzy_index")
+@click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
+@click.option('--distance', default=1, type=click.IntRange(1, MAX_FUZZY_DISTANCE), help="Largest number of note edits fuzzy queries will use; defaults to 1")
+def fuzzy_index(path, distance):
+    """
+    Store the note deletion variants of every stem, for --fuzzy queries.
+
+    Adding pieces keeps a stored index up to date. Without one, or for a larger
+    --fuzzy distance, each query process varies the stems in memory on its first
+    fuzzy query, which is slow on large indexes.
+    """
+    start = time.time()
+    connect(path).build_fuzzy_indexes(distance)
+    print("Ellapsed time: %s sec" % (time.time() - start))
 
 @click.group()
 def add():
@@ -180,14 +347,15 @@ def add():
 @click.argument('piecepath')
 @click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
 @click.option('--explicit_repeats', default=False, help="Convert to midi and back to expand repeats. Very slow")
-def add_piece(piecepath, path, explicit_repeats):
+@click.option('--replace', is_flag=True, help="Update pieces in place, deleting pieces previously added from the same file")
+def add_piece(piecepath, path, explicit_repeats, replace):
     """
     Add a musicXML (.xml or .mxl) file.
 
     The piecepath argument is a fully qualified path to the file.
     """
     start = time.time()
-    add_piece_to_index(piecepath, path, explicit_repeats)
+    add_piece_to_index(piecepath, path, explicit_repeats, replace)
     print("Ellapsed: %s sec" % (time.time() - start))
 
 @click.command("composer")
@@ -200,6 +368,8 @@ def add_composer(composer, filetype, path, explicit_repeats):
         Music21 corpus pieces by composer.
         Use `firms_cli.py composers` to see a list of composers.
     """
+    from music21 import corpus
+    from music21 import stream as m21stream
     start = time.time()
     sqlIRSystem = connect(path)
     paths = corpus.getComposer(composer, filetype)
@@ -207,31 +377,42 @@ def add_composer(composer, filetype, path, explicit_repeats):
         print("Error: no pieces found matching composer %s" % composer)
     else:
         print("Found %s pieces" % (len(paths)))
+    if os.path.isdir(path):
+        add_paths_to_shards(sqlIRSystem, paths, explicit_repeats)
+        paths = []
     for idx,path in enumerate(paths):
         print("\tProcessing piece %s: %s" % (idx, path))
         stream = corpus.parse(path)
         for piece in stream.recurse(classFilter=m21stream.Score, skipSelf=False):
-            sqlIRSystem.add_piece(piece, path, explicit_repeats)
+            sqlIRSystem.add_piece(piece, str(path), explicit_repeats)
     print("Ellapsed time: %s sec" % (time.time() - start))
 
 @click.command("dir")
 @click.argument('dirpath', type=click.Path(exists=True))
 @click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
 @click.option('--explicit_repeats', default=False, help="Convert to midi and back to expand repeats. Very slow")
-def add_directory(dirpath, path, explicit_repeats):
+@click.option('--replace', is_flag=True, help="Update pieces in place, deleting pieces previously added from the same file")
+def add_directory(dirpath, path, explicit_repeats, replace):
     """
     All .xml and .mxl files in given directory.
 
     Note: this method skips files ending in `.query.xml`, which are assumed to be user queries
     """
     start = time.time()
+    sharded = os.path.isdir(path)
+    piece_paths = []
     for root, dirs, files in os.walk(dirpath):
         for filename in files:
             if (filename.endswith('.xml') and not filename.endswith('.query.xml')) or filename.endswith('.mxl'):
                 print("Adding piece %s" % (filename))
-                add_piece_to_index(os.path.join(root, filename), path, explicit_repeats)
+                if sharded:
+                    piece_paths.append(os.path.join(root, filename))
+                else:
+                    add_piece_to_index(os.path.join(root, filename), path, explicit_repeats, replace)
             else:
                 print("\tSkipping piece %s: only mxl and xml files supported" % filename)
+    if sharded:
+        add_paths_to_shards(connect(path), piece_paths, explicit_repeats, replace)
     print("Ellapsed time: %s sec" % (time.time() - start))
 
 @click.command('music21')
@@ -244,16 +425,21 @@ def add_music21(filetype, path, explicit_repeats):
 
     Note, this results in over four thousand pieces and may take a significant amount of time.
     """
+    from music21 import corpus
+    from music21 import stream as m21stream
     start = time.time()
     sqlIRSystem = connect(path)
     paths = corpus.getPaths(filetype)
+    if os.path.isdir(path):
+        add_paths_to_shards(sqlIRSystem, paths, explicit_repeats)
+        paths = []
     num_pieces = len(paths)
     for idx,path in enumerate(paths):
         print("Adding piece %s of %s" % (idx, num_pieces))
         try:
             stream = corpus.parse(path)
             for piece in stream.recurse(classFilter=m21stream.Score, skipSelf=False):
-                sqlIRSystem.add_piece(piece, path, explicit_repeats)
+                sqlIRSystem.add_piece(piece, str(path), explicit_repeats)
         except:
             print("\tUnable to process piece %s" % path)
     print("Ellapsed time: %s sec" % (time.time() - start))
@@ -262,7 +448,16 @@ def add_music21(filetype, path, explicit_repeats):
 @click.argument('query')
 @click.option('--output', default=None, help="Path to write results out to")
 @click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
-def query_tiny(query, output, path):
+@click.option('--workers', default=1, help="Number of threads looking up stemmers concurrently; defaults to 1")
+@click.option('--fuzzy', default=0, type=click.IntRange(0, MAX_FUZZY_DISTANCE), help="Also match stems within this many note edits of the query's, weighting them down by distance; defaults to 0")
+@click.option('--rerank', default=0, help="Pick this many candidates with the pitch and interval stemmers, then re-rank them by how their matches line up with the query; defaults to 0, grading every piece")
+@click.option('--max_rows', type=click.INT, default=None, help="Skip the least valuable stem lookups so the query fetches at most about this many rows")
+@click.option('--max_ms', type=click.FLOAT, default=None, help="Skip the least valuable stem lookups so they take about this many milliseconds at most")
+@click.option('--explain', is_flag=True, help="Print every stem lookup with its estimated and actual rows")
+@click.option('--stem_row_limit', type=click.INT, default=None, help="Fetch at most this many matches per stem lookup")
+@click.option('--row_limit', type=click.INT, default=None, help="Fetch at most this many matches for the whole query")
+@click.option('--deadline_ms', type=click.FLOAT, default=None, help="Stop fetching matches after this many milliseconds and grade the matches so far")
+def query_tiny(query, output, path, workers, fuzzy, rerank, max_rows, max_ms, explain, stem_row_limit, row_limit, deadline_ms):
     """
         Query for piece using tiny notation.
 
@@ -270,13 +465,15 @@ def query_tiny(query, output, path):
 
         python.exe firms_cli.py tiny "tinyNotation: 3/4 E4 r f# g=lastG trip{b-8 a g} c4~ c" --path "example.db.sqlite" 
     """
+    from music21 import converter
     start = time.time()
-    sqlIrSystem = connect(path)
+    sqlIrSystem = connect(path, workers)
     print("Parsing query")
-    stream = converter.parse(query)
+    with profiler.stage('parse'):
+        stream = converter.parse(query)
     notes = stream.recurse().notesAndRests
     print("Querying")
-    results = sqlIrSystem.query(notes)
+    results = run_query(sqlIrSystem, notes, fuzzy, rerank, make_planner(max_rows, max_ms), explain, make_limits(stem_row_limit, row_limit, deadline_ms))
     print("Formatting results")
     formatted_results = print_results(results, sqlIrSystem.pieces())
     if output:
@@ -290,13 +487,24 @@ def query_tiny(query, output, path):
 @click.argument('file')
 @click.option('--output', default=None, help="Path to write results out to")
 @click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
-def query_piece(file, output, path):
+@click.option('--workers', default=1, help="Number of threads looking up stemmers concurrently; defaults to 1")
+@click.option('--fuzzy', default=0, type=click.IntRange(0, MAX_FUZZY_DISTANCE), help="Also match stems within this many note edits of the query's, weighting them down by distance; defaults to 0")
+@click.option('--rerank', default=0, help="Pick this many candidates with the pitch and interval stemmers, then re-rank them by how their matches line up with the query; defaults to 0, grading every piece")
+@click.option('--max_rows', type=click.INT, default=None, help="Skip the least valuable stem lookups so the query fetches at most about this many rows")
+@click.option('--max_ms', type=click.FLOAT, default=None, help="Skip the least valuable stem lookups so they take about this many milliseconds at most")
+@click.option('--explain', is_flag=True, help="Print every stem lookup with its estimated and actual rows")
+@click.option('--stem_row_limit', type=click.INT, default=None, help="Fetch at most this many matches per stem lookup")
+@click.option('--row_limit', type=click.INT, default=None, help="Fetch at most this many matches for the whole query")
+@click.option('--deadline_ms', type=click.FLOAT, default=None, help="Stop fetching matches after this many milliseconds and grade the matches so far")
+def query_piece(file, output, path, workers, fuzzy, rerank, max_rows, max_ms, explain, stem_row_limit, row_limit, deadline_ms):
     """
     Query for piece using an example MusicXML document.
     """
-    sqlIrSystem = connect(path)
-    stream = converter.parse(file)
-    results = sqlIrSystem.query(stream)
+    from music21 import converter
+    sqlIrSystem = connect(path, workers)
+    with profiler.stage('parse'):
+        stream = converter.parse(file)
+    results = run_query(sqlIrSystem, stream, fuzzy, rerank, make_planner(max_rows, max_ms), explain, make_limits(stem_row_limit, row_limit, deadline_ms))
     formatted_results = print_results(results, sqlIrSystem.pieces())
     if output:
         with open(output, 'w') as outf:
@@ -304,6 +512,195 @@ def query_piece(file, output, path):
             for row in formatted_results:
                 writer.writerow(row)
 
+def load_batch_queries(source):
+    """
+    Read query specifications from a directory of `.query.xml` files or from a JSONL file.
+    Each JSONL line is an object with an optional `id` and either a `path` to a MusicXML
+    file, a `tiny` tiny notation string, or `notes` encoded as stored in the index, as written
+    by `firms synth`.
+    Yields dictionaries with an `id` and either a `path`, `tiny` or `notes` key
+        :param source: Path to a directory or JSONL file
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            for filename in sorted(files):
+                if filename.endswith('.query.xml'):
+                    query_path = os.path.join(root, filename)
+                    yield {'id': query_path, 'path': query_path}
+    else:
+        with open(source) as inf:
+            for line_number, line in enumerate(inf):
+                if line.strip():
+                    spec = json.loads(line)
+                    spec.setdefault('id', line_number)
+                    yield spec
+
+def parse_batch_query(spec):
+    """
+    Parse a query specification produced by load_batch_queries into a music21 stream
+        :param spec: Dictionary with either a `path`, `tiny` or `notes` key
+    """
+    from music21 import converter
+    from firms.sampling import decode_notes
+    if 'path' in spec:
+        return converter.parse(spec['path'])
+    if 'notes' in spec:
+        return decode_notes(spec['notes']).to_stream()
+    tiny = spec['tiny']
+    if not tiny.lower().startswith('tinynotation:'):
+        tiny = 'tinyNotation: %s' % tiny
+    return converter.parse(tiny).recurse().notesAndRests
+
+def lookup_args(fuzzy):
+    """
+    Extra arguments passed on to index lookups for the --fuzzy option
+    """
+    return (fuzzy, ) if fuzzy else ()
+
+def make_planner(max_rows=None, max_ms=None):
+    """
+    Build a planner for the --max_rows and --max_ms options
+    """
+    if max_rows is None and max_ms is None:
+        return None
+    return CostPlanner(max_rows, max_ms / 1000 if max_ms is not None else None)
+
+def make_limits(stem_row_limit=None, row_limit=None, deadline_ms=None):
+    """
+    Build the query limits for the --stem_row_limit, --row_limit and --deadline_ms options
+    """
+    return {
+        'max_rows_per_stem': stem_row_limit,
+        'max_rows': row_limit,
+        'deadline': deadline_ms / 1000 if deadline_ms is not None else None
+    }
+
+def run_query(system, query, fuzzy=0, rerank=0, planner=None, explain=False, limits=None):
+    """
+    Query a system, in two stages if re-ranking
+        :param system: IRSystem to query
+        :param query: Query represented by a Music21 stream
+        :param fuzzy=0: Largest edit distance of fuzzy stem matches
+        :param rerank=0: Number of candidates to re-rank by alignment; 0 grades every piece with every grader
+        :param planner=None: Planner choosing the stems to look up; not used when re-ranking
+        :param explain=False: Print the lookups chosen by the planner, or by an unlimited planner if None
+        :param limits=None: Keyword arguments of QueryBudget; not used when re-ranking
+    """
+    if rerank:
+        return system.two_stage_query(query, *lookup_args(fuzzy), reranker=AlignmentGrader(), candidates=rerank, stage_one_stemmers=stage_one_stemmers)
+    limits = limits or {}
+    if explain:
+        budget = QueryBudget(**limits) if any(limit is not None for limit in limits.values()) else None
+        results, steps = system.explain_query(query, *lookup_args(fuzzy), planner=planner or CostPlanner(), budget=budget)
+        print_plan(steps)
+    else:
+        results = system.query(query, *lookup_args(fuzzy), planner=planner, **limits)
+    if getattr(results, 'truncated', False):
+        print("Results truncated: a row limit or the deadline stopped lookups early")
+    return results
+
+def run_batch_chunk(specs, topk, fuzzy=0):
+    """
+    Run a chunk of batch queries against the worker's index, sharing lookups across the chunk.
+    Returns a list of result records, one per query specification
+        :param specs: List of query specifications
+        :param topk: Number of results to keep per grader
+        :param fuzzy=0: Largest edit distance of fuzzy stem matches
+    """
+    pieces_lookup = {piece_id: name for name, piece_path, piece_id in worker_system.pieces()}
+    records = [{'id': spec['id'], 'stats': {}, 'results': {}, 'error': None} for spec in specs]
+    queries = []
+    for record, spec in zip(records, specs):
+        start = time.perf_counter()
+        try:
+            with profiler.stage('parse'):
+                queries.append((record, parse_batch_query(spec)))
+        except Exception as e:
+            record['error'] = repr(e)
+        record['stats']['parse_sec'] = time.perf_counter() - start
+    batch_results = worker_system.batch_query([query for record, query in queries], *lookup_args(fuzzy), topk=topk)
+    for (record, query), batch_result in zip(queries, batch_results):
+        record['stats'].update(batch_result.stats)
+        if batch_result.error:
+            record['error'] = repr(batch_result.error)
+            continue
+        for grader, results in batch_result.grades.items():
+            record['results'][grader] = [
+                {'rank': rank, 'piece': result.piece, 'name': pieces_lookup.get(result.piece), 'grade': result.grade}
+                for rank, result in enumerate(results)
+            ]
+    return records
+
+def write_batch_records(records, outf, output_format):
+    """
+    Write batch query result records as JSONL or CSV rows
+    """
+    if output_format == 'jsonl':
+        for record in records:
+            outf.write(json.dumps(record) + "\n")
+    else:
+        writer = csv.writer(outf, lineterminator="\n")
+        for record in records:
+            stats = [record['stats'].get(stat) for stat in BATCH_STATS]
+            if record['error'] or not record['results']:
+                writer.writerow([record['id'], None, None, None, None, None] + stats + [record['error']])
+            for grader, results in record['results'].items():
+                for result in results:
+                    writer.writerow([record['id'], grader, result['rank'], result['piece'], result['name'], result['grade']] + stats + [None])
+    outf.flush()
+
+BATCH_STATS = ['parse_sec', 'plan_sec', 'lookup_sec', 'grade_sec', 'lookups', 'cached_lookups']
+
+@click.command("batch")
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--output', default=None, help="Path to write results out to; defaults to stdout")
+@click.option('--format', 'output_format', type=click.Choice(['jsonl', 'csv']), default='jsonl', help="Output format; defaults to jsonl")
+@click.option('--topk', default=10, help="Number of results to output per grader; defaults to 10")
+@click.option('--chunk_size', default=100, help="Number of queries sharing stem lookups; defaults to 100")
+@click.option('--processes', default=1, help="Number of worker processes; defaults to 1")
+@click.option('--workers', default=1, help="Number of threads looking up stemmers concurrently in each process; defaults to 1")
+@click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
+@click.option('--fuzzy', default=0, type=click.IntRange(0, MAX_FUZZY_DISTANCE), help="Also match stems within this many note edits of the query's, weighting them down by distance; defaults to 0")
+def query_batch(source, output, output_format, topk, chunk_size, processes, workers, path, fuzzy):
+    """
+    Run many queries against one index.
+
+    SOURCE is either a directory, in which case every `.query.xml` file in it is a query,
+    or a JSONL file with one query per line, e.g. {"id": "q1", "tiny": "4/4 c4 d e f g"}
+    or {"id": "q2", "path": "examples/ode-to-joy.query.xml"}.
+
+    Queries are processed in chunks; each distinct stem is looked up once per chunk.
+    Results are streamed as they complete, along with per-query timings, and the overall
+    throughput is reported on stderr at the end.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    start = time.time()
+    specs = list(load_batch_queries(source))
+    chunks = [specs[i:i + chunk_size] for i in range(0, len(specs), chunk_size)]
+    outf = open(output, 'w') if output else sys.stdout
+    if output_format == 'csv':
+        csv.writer(outf, lineterminator="\n").writerow(['id', 'grader', 'rank', 'piece', 'name', 'grade'] + BATCH_STATS + ['error'])
+    errors = 0
+    try:
+        if processes > 1:
+            executor = ProcessPoolExecutor(processes, initializer=init_worker, initargs=(path, workers))
+            chunk_records = executor.map(run_batch_chunk, chunks, [topk] * len(chunks), [fuzzy] * len(chunks))
+        else:
+            init_worker(path, workers)
+            chunk_records = (run_batch_chunk(chunk, topk, fuzzy) for chunk in chunks)
+        for records in chunk_records:
+            errors = errors + sum(1 for record in records if record['error'])
+            write_batch_records(records, outf, output_format)
+        if processes > 1:
+            executor.shutdown()
+    finally:
+        if output:
+            outf.close()
+    elapsed = time.time() - start
+    click.echo("Queries: %s (%s failed)" % (len(specs), errors), err=True)
+    click.echo("Ellapsed: %s sec" % elapsed, err=True)
+    click.echo("Throughput: %s queries/sec" % (len(specs) / elapsed if elapsed else 0), err=True)
+
 @click.group()
 def query():
     """
@@ -362,6 +759,204 @@ def info_piece(id, path):
     results = sqlIrSystem.piece_by_id(id)
     print_pieces(results)
 
+@click.command("stems")
+@click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
+@click.option('--top', default=10, help="Number of most frequent stems to list per stemmer; defaults to 10")
+@click.option('--stemmer', default=None, help="Only list the most frequent stems of this stemmer")
+def info_stems(path, top, stemmer):
+    """
+    Show how stems are spread over the index
+
+    For each stemmer and snippet length, shows the number of distinct stems, their posting lengths
+    (snippets per stem), the share of postings held by the most frequent 1% of stems, a histogram of
+    posting lengths, the most frequent stems, and the bytes used by each table and index.
+    Long postings make lookups slow; use the percentiles to choose stop stem thresholds.
+    """
+    from firms.index_stats import bucket_label
+    sqlIrSystem = connect(path)
+    stats = sqlIrSystem.stem_stats(top)
+    summaries = stats['stemmers']
+    print(tabulate(
+        [[s['stemmer'], s['snippet_length'], s['stems'], s['postings'], format_number(s['stems_per_snippet']), format_number(s['mean']),
+          s['p50'], s['p90'], s['p99'], s['max'], format_number(100 * s['singletons']), format_number(100 * s['top_share'])]
+         for s in summaries],
+        headers=['Stemmer', 'Length', 'Stems', 'Postings', 'Stems/snippet', 'Mean', 'p50', 'p90', 'p99', 'Max', 'Singleton %', 'Top 1% share %']))
+    print()
+    number_of_buckets = max([len(s['buckets']) for s in summaries] + [0])
+    print(tabulate(
+        [[s['stemmer'], s['snippet_length']] + s['buckets'] + [0] * (number_of_buckets - len(s['buckets'])) for s in summaries],
+        headers=['Stems with postings of', 'Length'] + [bucket_label(bucket) for bucket in range(number_of_buckets)]))
+    for (name, snippet_length), stems in stats['top_stems'].items():
+        if stems and (stemmer is None or stemmer == name):
+            print()
+            print(tabulate(stems, headers=['%s (%s) stem' % (name, snippet_length), 'Postings']))
+    print()
+    if stats['sizes'] is None:
+        print("Table sizes are unavailable; this sqlite build doesn't include dbstat")
+    else:
+        print(tabulate([[name, format(size, ",d")] for name, size in stats['sizes']], headers=['Table or index', 'Bytes']))
+
+@click.command("filters")
+@click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
+def info_filters(path):
+    """
+    Show the Bloom filters used to skip lookups of stems that are not indexed
+
+    For each stemmer and snippet length, shows the stems in the filter, the number it was sized for,
+    its memory use and its estimated false positive rate. Filters missing from the index are built.
+    """
+    sqlIrSystem = connect(path)
+    print(tabulate(
+        [[s['stemmer'], s['snippet_length'], s['stems'], s['capacity'], s['hashes'], format(s['bytes'], ",d"),
+          format_number(100 * s['false_positive_rate'])]
+         for s in sqlIrSystem.stem_filter_stats()],
+        headers=['Stemmer', 'Length', 'Stems', 'Capacity', 'Hashes', 'Bytes', 'False positive %']))
+
+@click.command("sql")
+@click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
+@click.option('--top', default=20, help="Number of statements and stems to show; defaults to 20")
+@click.option('--by', type=click.Choice(['seconds', 'calls', 'rows']), default='seconds', help="Order statements and stems by total seconds, calls or rows; defaults to seconds")
+@click.option('--plans', is_flag=True, default=False, help="Show the query plan of each statement")
+@click.option('--reset', is_flag=True, default=False, help="Discard the saved statistics")
+def info_sql(path, top, by, plans, reset):
+    """
+    Show where SQL time goes, from statistics saved by `firms --trace_sql`
+
+    Lists the slowest statements, the stems whose lookups took longest, and lookup totals per stemmer.
+    """
+    sqlIrSystem = connect(path)
+    if reset:
+        sqlIrSystem.reset_sql_stats()
+        print("Discarded saved SQL statistics")
+        return
+    stats = sqlIrSystem.sql_stats(top, by)
+    if stats is None:
+        print("No SQL statistics saved in %s; run commands with `firms --trace_sql` to collect them" % path)
+        return
+    statements, stems, stemmers = stats
+    print(tabulate(
+        [[calls, format_number(seconds * 1000), format_number(1000 * seconds / calls), format_number(max_seconds * 1000), rows, statement]
+         for statement, calls, seconds, max_seconds, rows, _ in statements],
+        headers=['Calls', 'Total ms', 'Mean ms', 'Max ms', 'Rows', 'Statement']))
+    if plans:
+        for statement, _, _, _, _, plan in statements:
+            print("\n%s" % statement)
+            for detail in json.loads(plan):
+                print("    %s" % detail)
+    print()
+    print(tabulate(
+        [[stemmer, snippet_length, stem, calls, format_number(seconds * 1000), rows] for stemmer, snippet_length, stem, calls, seconds, rows in stems],
+        headers=['Stemmer', 'Length', 'Stem', 'Calls', 'Total ms', 'Rows']))
+    print()
+    print(tabulate(
+        [[stemmer, calls, format_number(seconds * 1000), rows] for stemmer, calls, seconds, rows in stemmers],
+        headers=['Stemmer', 'Lookups', 'Total ms', 'Rows']))
+
+def evaluate_piece_samples(piece_samples, erate, minsize, maxsize, error_rates, output, rerank=0):
+    """
+    Evaluate every sample drawn from one piece against the worker's index, parsing the piece only once.
+    Each sample draws its part, measures and errors from its own seeded random generator, so results
+    don't depend on which worker runs it.
+    Returns a list of (sample index, sample detail, query result) tuples, omitting samples that fail,
+    and a dictionary of seconds spent per stage
+        :param piece_samples: Tuple of a (name, path, id) piece row and a list of (sample index, seed) tuples
+        :param erate: Rate at which to simulate error
+        :param minsize: Minimum sample size (in measures)
+        :param maxsize: Maximum sample size (in measures)
+        :param error_rates: Relative weights of the add, remove, replace and transposition errors
+        :param output: Directory to save query samples to, or None
+        :param rerank=0: Number of candidates to re-rank by alignment; see run_query
+    """
+    from music21 import converter
+    (sample_piece_name, sample_piece_path, sample_piece_id), samples = piece_samples
+    timings = {'parse': 0.0, 'sample': 0.0, 'query': 0.0}
+    evaluations = []
+    start = time.perf_counter()
+    try:
+        with profiler.stage('parse'):
+            piece = converter.parse(sample_piece_path)
+        parts = list(piece.recurse().parts)
+    except Exception as e:
+        print("Unable to process piece %s" % sample_piece_path)
+        traceback.print_exc()
+        print(e)
+        return evaluations, timings
+    timings['parse'] = time.perf_counter() - start
+    for sample_index, sample_seed in samples:
+        rng = random.Random(sample_seed)
+        try:
+            start = time.perf_counter()
+            print("Sample %s: %s (%s)" % (sample_index + 1, sample_piece_name, sample_piece_path))
+            part = rng.choice(parts)
+            num_of_measures = part.measures(0,None)[-1].number
+            sample_size = rng.randint(minsize, maxsize)
+            idx = rng.randint(0, num_of_measures-sample_size)
+            sample_stream = part.measures(idx, idx+sample_size).recurse().notesAndRests
+            sample_detail = (sample_piece_name, part.partName, idx, sample_piece_path, sample_piece_id)
+            print("Part %s, Start measure %s, Length %s, of total measures %s" % (part.partName, idx, sample_size, num_of_measures))
+            if (len(sample_stream) == 0):
+                print("\tSample stream is empty, likely because it belongs to an unsupported instrument. Skipping.")
+                continue
+            sample_stream = introduce_error(sample_stream, erate, build_error_types(*error_rates), rng)
+            if output:
+                print("\tSaving query sample")
+                sample_stream.write("xml", "%s/%s.sample.xml" % (output, clean_file_name(sample_piece_name)))
+            timings['sample'] = timings['sample'] + time.perf_counter() - start
+            print("\tQuerying..")
+            start = time.perf_counter()
+            query_result = run_query(worker_system, sample_stream, rerank=rerank)
+            timings['query'] = timings['query'] + time.perf_counter() - start
+            evaluations.append((sample_index, sample_detail, query_result))
+        except Exception as e:
+            print("Unable to process piece %s" % sample_piece_path)
+            traceback.print_exc()
+            print(e)
+    return evaluations, timings
+
+def evaluate_index_samples(piece_samples, erate, minsize, maxsize, error_rates, output, rerank=0):
+    """
+    Evaluate every sample drawn from one piece using the note sequences stored in the worker's index,
+    without reading or parsing the piece's source file. Takes the same arguments and returns the same
+    results as evaluate_piece_samples
+        :param piece_samples: Tuple of a (name, path, id) piece row and a list of (sample index, seed) tuples
+        :param erate: Rate at which to simulate error
+        :param minsize: Minimum sample size (in measures)
+        :param maxsize: Maximum sample size (in measures)
+        :param error_rates: Relative weights of the add, remove, replace and transposition errors
+        :param output: Directory to save query samples to, or None
+        :param rerank=0: Number of candidates to re-rank by alignment; see run_query
+    """
+    sample_piece, samples = piece_samples
+    sample_piece_name, sample_piece_path, sample_piece_id = sample_piece
+    timings = {'sample': 0.0, 'query': 0.0}
+    evaluations = []
+    sampler = get_worker_sampler()
+    for sample_index, sample_seed in samples:
+        rng = random.Random(sample_seed)
+        try:
+            start = time.perf_counter()
+            print("Sample %s: %s (%s)" % (sample_index + 1, sample_piece_name, sample_piece_path))
+            sample_detail, sample_sequence = sampler.sample(sample_piece, rng, minsize, maxsize, erate, error_rates)
+            print("Part %s, Start measure %s, %s notes" % (sample_detail.part_name, sample_detail.measure, len(sample_sequence)))
+            if len(sample_sequence) == 0:
+                print("\tSample is empty, likely because it belongs to an unsupported instrument. Skipping.")
+                continue
+            sample_stream = sample_sequence.to_stream()
+            if output:
+                print("\tSaving query sample")
+                sample_stream.write("xml", "%s/%s.sample.xml" % (output, clean_file_name(sample_piece_name)))
+            timings['sample'] = timings['sample'] + time.perf_counter() - start
+            print("\tQuerying..")
+            start = time.perf_counter()
+            query_result = run_query(worker_system, sample_stream, rerank=rerank)
+            timings['query'] = timings['query'] + time.perf_counter() - start
+            evaluations.append((sample_index, tuple(sample_detail), query_result))
+        except Exception as e:
+            print("Unable to process piece %s" % sample_piece_path)
+            traceback.print_exc()
+            print(e)
+    return evaluations, timings
+
 @click.command("evaluate")
 @click.option('--n', default=2, help="Number of pieces to sample")
 @click.option('--erate', default=0.0, help="Rate at which to simulate error")
@@ -374,74 +969,242 @@ def info_piece(id, path):
 @click.option('--output', default=None, help="Path to write results out to")
 @click.option('--noprint', default=False, help="Set to True to skip printing results")
 @click.option('--topk', type=click.INT, default=None, help="If set, count all ranks above as 0")
+@click.option('--seed', type=click.INT, default=None, help="Seed for sampling and error injection; a random seed is chosen and printed if not set")
+@click.option('--processes', default=1, help="Number of worker processes; defaults to 1")
+@click.option('--source', type=click.Choice(['files', 'index']), default='files', help="Sample from the original score files, or from the notes stored in the index; defaults to files")
+@click.option('--metrics_output', default=None, help="Path to write the rank and grade of every sample to, as a NumPy .npz file")
 @click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
-def evaluate(n, erate, minsize, maxsize, add_note_error, remove_note_error, replace_note_error, transposition_error, output, noprint, topk, path):
+@click.option('--rerank', default=0, help="Query in two stages, re-ranking this many candidates by alignment; defaults to 0")
+def evaluate(n, erate, minsize, maxsize, add_note_error, remove_note_error, replace_note_error, transposition_error, output, noprint, topk, seed, processes, source, metrics_output, path, rerank):
     """
     Select random samples from index and run IR evaluation.
 
     Select n random samples of length [minsize, maxsize] measures
     With probability erate, introduce errors to the sampled snippets
         Select error using relative weights of each  of the --*error parameters
+
+    Runs with the same --seed draw the same samples and errors, regardless of --processes.
+    If n is larger than the number of pieces, pieces are sampled with replacement.
+    With --source index, samples are cut from the note sequences stored when pieces were added,
+    so the original score files are never read.
     """
+    from concurrent.futures import ProcessPoolExecutor
+    from scipy import stats
+    from firms.metrics import EvaluationRun, NOT_FOUND
     start = time.time()
-    print("Running evaluation with %s samples" % n)
-    sqlIrSystem = connect(path)
-    pieces = sqlIrSystem.pieces()
+    if seed is None:
+        seed = random.randrange(2**32)
+    print("Running evaluation with %s samples, seed %s" % (n, seed))
+    init_worker(path, 1)
+    if source == 'index':
+        pieces = get_worker_sampler().pieces
+        if not pieces:
+            print("No stored notes found in %s. Re-add pieces to sample from the index, or use --source files" % path)
+            return
+        evaluate_samples_fn = evaluate_index_samples
+    else:
+        pieces = worker_system.pieces()
+        evaluate_samples_fn = evaluate_piece_samples
     print("Selecing sample pieces")
-    sample_pieces = random.sample(pieces, n)
-    details = []
-    query_results = []
-    for idx,sample_piece in enumerate(sample_pieces):
-        try:
-            sample_piece_name, sample_piece_path, sample_piece_id = sample_piece
-            print("Sample %s: %s (%s)" % (idx + 1, sample_piece_name, sample_piece_path))
-            piece = converter.parse(sample_piece_path)
-            part = random.choice(list(piece.recurse().parts))
-            num_of_measures = part.measures(0,None)[-1].number
-            sample_size = random.randint(minsize, maxsize)
-            idx = random.randint(0, num_of_measures-sample_size)
-            sample_stream = part.measures(idx, idx+sample_size).recurse().notesAndRests
-            sample_detail = (sample_piece_name, part, idx, sample_piece_path, sample_piece_id)
-            print("Part %s, Start measure %s, Length %s, of total measures %s" % (part.partName, idx, sample_size, num_of_measures))
-            if (len(sample_stream) == 0):
-                print("\tSample stream is empty, likely because it belongs to an unsupported instrument. Skipping.")
-                continue
-            sample_stream = introduce_error(sample_stream, erate, build_error_types(add_note_error, remove_note_error, replace_note_error, transposition_error))
-            if output:
-                print("\tSaving query sample")
-                sample_stream.write("xml", "%s/%s.sample.xml" % (output, clean_file_name(sample_piece_name)))
-            print("\tQuerying..")
-            query_result = sqlIrSystem.query(sample_stream)
-            query_results.append(query_result)
-            details.append(sample_detail)
-        except Exception as e:
-            print("Unable to process piece %s" % sample_piece_path)
-            traceback.print_exc()
-            print(e)
-    evaluations = print_evaluations(details, query_results, noprint)
+    rng = random.Random(seed)
+    sample_pieces = rng.sample(pieces, n) if n <= len(pieces) else rng.choices(pieces, k=n)
+    # Group samples by piece so each piece is parsed once, seeding every sample independently
+    samples_by_piece = {}
+    for sample_index, sample_piece in enumerate(sample_pieces):
+        samples_by_piece.setdefault(sample_piece, []).append((sample_index, rng.randrange(2**32)))
+    evaluate_samples = partial(evaluate_samples_fn,
+        erate=erate, minsize=minsize, maxsize=maxsize, output=output, rerank=rerank,
+        error_rates=(add_note_error, remove_note_error, replace_note_error, transposition_error))
+    if processes > 1:
+        with ProcessPoolExecutor(processes, initializer=init_worker, initargs=(path, 1)) as executor:
+            piece_evaluations = list(executor.map(evaluate_samples, samples_by_piece.items()))
+    else:
+        piece_evaluations = [evaluate_samples(piece_samples) for piece_samples in samples_by_piece.items()]
+    stage_timings = {}
+    sample_evaluations = []
+    for evaluations, timings in piece_evaluations:
+        sample_evaluations.extend(evaluations)
+        update_with_sum(stage_timings, timings)
+    sample_evaluations.sort(key=itemgetter(0))
+    details = [detail for sample_index, detail, query_result in sample_evaluations]
+    query_results = [query_result for sample_index, detail, query_result in sample_evaluations]
+    start_metrics = time.perf_counter()
+    run = EvaluationRun.from_results([detail[4] for detail in details], query_results)
+    evaluations = print_evaluations(details, query_results, run, noprint)
     print("Computing evaluation metrics")
-    # Filter by [3] (is actual)
-    tp_evaluations = [x for x in evaluations if x[3]]
-    # Aggregate by [1] (grading method)
-    tps_by_method = dict((k, list(g)) for k,g in groupby(sorted(tp_evaluations, key=lambda x: x[1]), lambda x: x[1]))
-    # Compute statistics on [5] (rank) and [6] (grade)
+    # Compute statistics on the rank of the true piece, where found
     # If topk then count all ranks less than k as rank 0
-    aggregate_rank_results = None
-    if topk:
-        aggregate_rank_results = {method: stats.describe([tp[4] if tp[4] > topk else 0 for tp in tps]) for method,tps in tps_by_method.items()}
-    else:
-        aggregate_rank_results = {method: stats.describe([tp[4] for tp in tps]) for method,tps in tps_by_method.items()}
-    for method, description in aggregate_rank_results.items():
+    for method in run.graders():
+        ranks = run.ranks[method]
+        ranks = ranks[ranks != NOT_FOUND]
+        if not len(ranks):
+            continue
+        if topk:
+            ranks = ranks * (ranks > topk)
+        description = stats.describe(ranks)
         print("Statistics for %s" % method)
         for stat,val in zip(description._fields, description):
             print("\t%s: %s" % (stat,val))
-    print("Ellapsed: %s sec" % (time.time() - start))
+    print_metrics(run)
+    if metrics_output:
+        run.save(metrics_output)
+    stage_timings['metrics'] = time.perf_counter() - start_metrics
+    elapsed = time.time() - start
+    print("Seed: %s" % seed)
+    print("Time per stage, summed over workers:")
+    for stage, stage_time in stage_timings.items():
+        print("\t%s: %s sec" % (stage, stage_time))
+    print("Ellapsed: %s sec" % elapsed)
+    print("Throughput: %s samples/sec" % (len(sample_evaluations) / elapsed))
     if output:
         with open(output + '/results.csv', 'w') as outf:
             writer = csv.writer(outf, lineterminator="\n")
             for row in evaluations:
                 writer.writerow(row)
 
+@click.command("metrics")
+@click.argument('runs', nargs=-1, required=True, type=click.Path(exists=True))
+def show_metrics(runs):
+    """
+    Print retrieval metrics for evaluation runs saved with `firms evaluate --metrics_output`.
+    Pass several runs to compare them.
+    """
+    from firms.metrics import EvaluationRun
+    for run_path in runs:
+        print(run_path)
+        print_metrics(EvaluationRun.load(run_path))
+        print()
+
+@click.command("bench")
+@click.option('--corpus', 'corpus_spec', default='examples', help="Directory of .xml and .mxl files, or `composer:<name>` for a music21 composer; defaults to `examples`")
+@click.option('--limit', type=click.INT, default=None, help="Maximum number of files to ingest")
+@click.option('--queries', default=100, help="Number of queries to time; defaults to 100")
+@click.option('--seed', default=0, help="Seed for query sampling; defaults to 0")
+@click.option('--lengths', multiple=True, help="Snippet lengths to index, as for `firms create`")
+@click.option('--output', default='bench.json', help="Path to write JSON results to; defaults to `./bench.json`")
+@click.option('--baseline', default=None, type=click.Path(exists=True), help="JSON results of a previous run to compare against")
+@click.option('--threshold', default=0.1, help="Relative slowdown against the baseline counted as a regression; defaults to 0.1")
+@click.option('--startup_runs', default=5, help="Number of times to time each metadata command's startup; 0 to skip; defaults to 5")
+@click.option('--startup_only', is_flag=True, default=False, help="Only time command startup, against an empty index")
+def bench(corpus_spec, limit, queries, seed, lengths, output, baseline, threshold, startup_runs, startup_only):
+    """
+    Benchmark ingest, query and startup performance.
+
+    Indexes a corpus into a temporary database, reporting pieces/sec and snippets/sec,
+    then times queries sampled from the index, reporting p50/p95/p99 latency per grader.
+    Also reports database size per piece and peak memory use.
+
+    Startup is timed by running metadata commands such as `firms info general` as new processes,
+    alongside a Python interpreter that does nothing, and checking which heavy modules they import.
+
+    With --baseline, exits with status 1 if any metric regressed by more than --threshold.
+    """
+    from firms.bench import corpus_paths, run_benchmark, compare_to_baseline, bench_startup, environment
+    paths = [] if startup_only else corpus_paths(corpus_spec, limit)
+    if not paths and not startup_only:
+        print("Error: no pieces found in corpus %s" % corpus_spec)
+        sys.exit(1)
+    if paths:
+        print("Benchmarking %s files from %s" % (len(paths), corpus_spec))
+    directory = tempfile.mkdtemp()
+    try:
+        sqlIrSystem = SqlIRSystem(os.path.join(directory, 'bench.sqlite.db'), index_methods, grader_methods, [], False,
+                                  parse_snippet_lengths(lengths))
+        if startup_only:
+            results = {'meta': environment(), 'startup': bench_startup(sqlIrSystem.dbpath, startup_runs or 5)}
+        else:
+            results = run_benchmark(sqlIrSystem, corpus_spec, paths, queries, seed, startup_runs)
+    finally:
+        shutil.rmtree(directory)
+    with open(output, 'w') as outf:
+        json.dump(results, outf, indent=2, sort_keys=True)
+    if 'ingest' in results:
+        ingest = results['ingest']
+        print("Ingest: %s pieces (%s failed), %s pieces/sec, %s snippets/sec" % (
+            ingest['pieces'], ingest['failed'], format_number(ingest['pieces_per_sec']), format_number(ingest['snippets_per_sec'])))
+        print(tabulate(
+            [[name] + [format_number(summary[key]) for key in ['count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms']] for name, summary in results['query'].items()],
+            headers=['Latency', 'Queries', 'Mean ms', 'p50 ms', 'p95 ms', 'p99 ms']))
+        print("DB size: %s bytes per piece" % format_number(results['db']['bytes_per_piece']))
+        print("Peak RSS: %s MB" % format_number(results['memory']['peak_rss_mb']))
+    if 'startup' in results:
+        startup = results['startup']
+        interpreter_ms = startup['python']['p50_ms']
+        print(tabulate(
+            [[name, format_number(summary['p50_ms']), format_number(summary['p50_ms'] - interpreter_ms), format_number(summary['p95_ms'])]
+             for name, summary in startup.items() if isinstance(summary, dict)],
+            headers=['Startup', 'p50 ms', 'Over Python ms', 'p95 ms']))
+        print("Heavy modules imported at startup: %s" % (', '.join(startup['heavy_imports']) or "none"))
+    print("Results written to %s" % output)
+    if baseline:
+        with open(baseline) as inf:
+            comparisons = compare_to_baseline(results, json.load(inf), threshold)
+        print(tabulate(
+            [[metric, format_number(previous), format_number(current), "%+.1f%%" % (change * 100), "REGRESSED" if regressed else ""]
+             for metric, previous, current, change, regressed in comparisons],
+            headers=['Metric', 'Baseline', 'Current', 'Change', '']))
+        regressions = [comparison for comparison in comparisons if comparison[4]]
+        if regressions:
+            print("%s metrics regressed by more than %s%%" % (len(regressions), threshold * 100))
+            sys.exit(1)
+
+def format_number(value):
+    return "-" if value is None else format(value, ",.2f")
+
+@click.command("synth")
+@click.option('--pieces', default=1000, help="Number of pieces to generate; defaults to 1000")
+@click.option('--parts', default=1, help="Number of parts in each piece; defaults to 1")
+@click.option('--notes', default=200, help="Mean number of notes in each part; defaults to 200")
+@click.option('--seed', default=0, help="Seed for generation; defaults to 0")
+@click.option('--zipf', default=1.2, help="Zipf exponent skewing interval, rhythm and motif frequencies; defaults to 1.2")
+@click.option('--motifs', default=200, help="Number of motifs shared across the corpus; defaults to 200")
+@click.option('--motif_rate', default=0.5, help="Probability of continuing a melody with a shared motif; defaults to 0.5")
+@click.option('--chord_rate', default=0.0, help="Probability of turning a note into a chord; defaults to 0")
+@click.option('--rest_rate', default=0.05, help="Probability of a rest; defaults to 0.05")
+@click.option('--plant', default=0, help="Number of known queries to cut from generated pieces; defaults to 0")
+@click.option('--planted_output', default='planted.jsonl', help="JSONL file to write planted queries to, for `firms query batch`; defaults to `./planted.jsonl`")
+@click.option('--erate', default=0.0, help="Rate at which to simulate error in planted queries")
+@click.option('--minsize', default=3, help="Minimum planted query size (in measures)")
+@click.option('--maxsize', default=7, help="Maximum planted query size (in measures)")
+@click.option('--lengths', multiple=True, help="Snippet lengths to index, as for `firms create`")
+@click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
+def synth(pieces, parts, notes, seed, zipf, motifs, motif_rate, chord_rate, rest_rate, plant, planted_output, erate, minsize, maxsize, lengths, path):
+    """
+    Generate a synthetic corpus directly into an index.
+
+    Melodies come from a Markov chain over intervals mixed with motifs shared across the corpus,
+    with Zipf distributed frequencies. Nothing is written as MusicXML. Pieces are added to the
+    index at --path, so corpora can be grown by running again with a different --seed.
+
+    With --plant, queries are cut from randomly chosen pieces and written to --planted_output,
+    each with the id and path of the piece it came from.
+    """
+    from firms.synth import MelodyGenerator, synth_piece_path, plant_query
+    start = time.time()
+    sqlIrSystem = SqlIRSystem(path, index_methods, grader_methods, [], False, parse_snippet_lengths(lengths))
+    rng = random.Random(seed)
+    generator = MelodyGenerator(random.Random(rng.randrange(2**32)), zipf, motifs, motif_rate, chord_rate, rest_rate)
+    planted_pieces = set(rng.sample(range(pieces), min(plant, pieces)))
+    planted = []
+    for piece_number in range(pieces):
+        piece_rng = random.Random(rng.randrange(2**32))
+        piece_parts = generator.piece(piece_rng, parts, notes)
+        piece_path = synth_piece_path(seed, piece_number)
+        piece_id = sqlIrSystem.add_parts(piece_path, "Synthetic %s" % piece_number, [
+            ("Part %s" % idx, sequence.to_notes(), sequence.encode()) for idx, sequence in enumerate(piece_parts)
+        ])
+        if piece_number in planted_pieces:
+            query = plant_query(piece_rng, piece_parts, minsize, maxsize, erate)
+            planted.append({'id': 'planted-%s' % piece_number, 'notes': query.encode(), 'expected_piece_id': piece_id, 'expected_path': piece_path})
+        if (piece_number + 1) % 1000 == 0:
+            print("Added %s pieces, %s pieces/sec" % (piece_number + 1, (piece_number + 1) / (time.time() - start)))
+    if planted:
+        with open(planted_output, 'w') as outf:
+            for record in planted:
+                outf.write(json.dumps(record) + "\n")
+        print("Wrote %s planted queries to %s" % (len(planted), planted_output))
+    print("Ellapsed time: %s sec" % (time.time() - start))
+
 @click.command("show")
 @click.argument("piece_path")
 @click.option('--path', default=DEFAULT_DB_PATH, help="Path to sqlite DB file; defaults to `./firms.sqlite.db`")
@@ -451,6 +1214,7 @@ def show(piece_path, path):
 
     Warning: for some file types this may open up several browser tabs, which can be slow.
     """
+    from music21 import corpus
     try:
         sqlIrSystem = connect(path)
         full_path = [p for (n, p) in sqlIrSystem.pieces() if piece_path.lower() in p.lower()][0]
@@ -473,6 +1237,7 @@ def midi_tiny(tinynotation):
     """
     Play the given tiny notation as MIDI.
     """
+    from music21 import converter
     stream = converter.parse(tinynotation)
     stream.show('midi')
 
@@ -482,6 +1247,7 @@ def midi_xml(filepath):
     """
     Play the given MusicXML or MXL file as MIDI.
     """
+    from music21 import converter
     stream = converter.parse(tinynotation)
     stream.show('midi')
 
@@ -503,39 +1269,76 @@ def print_results(grader_results, pieces, show_path=False):
                     result_number,
                     grade
                 ])
-    print(tabulate(table_rows, headers=table_headers))
+    with profiler.stage('tabulate'):
+        print(tabulate(table_rows, headers=table_headers))
     return table_rows
 
-def print_evaluations(sample_details, query_results, skip_print):
+def print_plan(steps):
+    """
+    Print the lookups of a query plan, in the order the planner ranked them
+        :param steps: List of PlanStep
+    """
+    table_rows = [
+        [step.query_stem.stemmer, step.query_stem.length, step.query_stem.stem, step.multiplicity,
+         step.estimated_rows, step.actual_rows, '%.3f' % (step.cost * 1000), '%.2f' % step.value, 'yes' if step.chosen else 'skip']
+        for step in steps
+    ]
+    table_headers = ['Stemmer', 'Length', 'Stem', 'Count', 'Est. rows', 'Rows', 'Est. ms', 'Value', 'Chosen']
+    with profiler.stage('tabulate'):
+        print(tabulate(table_rows, headers=table_headers))
+    chosen = [step for step in steps if step.chosen]
+    print("%s of %s lookups, %s estimated rows, %s rows fetched" % (
+        len(chosen), len(steps), sum(step.estimated_rows or 0 for step in chosen), sum(step.actual_rows or 0 for step in chosen)))
+
+def print_evaluations(sample_details, query_results, run, skip_print):
+    """
+    Build a table of the top 5 results of every sample, plus the true piece wherever it ranked
+        :param sample_details: List of (piece name, part name, measure, piece path, piece id) sample details
+        :param query_results: List of dictionaries from grader to results, one per sample
+        :param run: EvaluationRun of the samples
+        :param skip_print: If true, only return the table
+    """
     table_rows = []
     table_headers = ['Query Source', 'Grader', 'Piece ID', 'Actual', 'Rank', 'Grade']
-    for (detail, grader_results) in zip(sample_details, query_results):
+    for sample_index, (detail, grader_results) in enumerate(zip(sample_details, query_results)):
+        source = "%s %s (m %s)" % (detail[0], detail[1], detail[2])
+        piece_split = detail[0].split('site-packages')
         for grader,results in grader_results.items():
-            results_ordered_by_grade = sorted(results, key=attrgetter('grade'), reverse=True)
-            for result_number,(piece, grade, meta) in enumerate(results_ordered_by_grade):
-                is_actual = detail[4] == piece
-                if result_number < 5 or is_actual:
-                    piece_split = detail[0].split('site-packages')
-                    truncated_piece = '..%s' % piece_split[-1] if len(piece_split) > 1 else piece
-                    table_rows.append([
-                        "%s %s (m %s)" % (detail[0], detail[1].partName, detail[2]),
-                        grader,
-                        truncated_piece,
-                        is_actual,
-                        result_number,
-                        round(grade, 2)
-                    ])
+            actual_rank = run.ranks[grader][sample_index]
+            for result_number,(piece, grade, meta) in enumerate(heapq.nlargest(5, results, key=attrgetter('grade'))):
+                truncated_piece = '..%s' % piece_split[-1] if len(piece_split) > 1 else piece
+                table_rows.append([source, grader, truncated_piece, result_number == actual_rank, result_number, round(grade, 2)])
+            if actual_rank >= 5:
+                truncated_piece = '..%s' % piece_split[-1] if len(piece_split) > 1 else detail[4]
+                table_rows.append([source, grader, truncated_piece, True, int(actual_rank), round(run.grades[grader][sample_index], 2)])
     table_rows.sort(key=lambda x: (x[0], x[1], -1*x[5]))
     if not skip_print:
-        print(tabulate(table_rows, headers=table_headers))
+        with profiler.stage('tabulate'):
+            print(tabulate(table_rows, headers=table_headers))
     return table_rows
 
+def print_metrics(run):
+    """
+    Print retrieval metrics for each grader of an evaluation run
+        :param run: EvaluationRun
+    """
+    summaries = run.summarize()
+    table_headers = ['Grader'] + (list(next(iter(summaries.values())).keys()) if summaries else [])
+    table_rows = [[grader] + list(summary.values()) for grader, summary in summaries.items()]
+    print(tabulate(table_rows, headers=table_headers, floatfmt=".3f"))
+
 def print_pieces(pieces):
     table_headers = ['Name', 'Path', 'ID']
     print(tabulate(pieces, headers=table_headers))
 
 @click.group()
-def cli():
+@click.option('--profile', envvar='FIRMS_PROFILE', default=None, help="Path to write per-stage timings and counters to as JSON; also set by FIRMS_PROFILE")
+@click.option('--cprofile', envvar='FIRMS_CPROFILE', default=None, help="Path to dump cProfile statistics to; also set by FIRMS_CPROFILE")
+@click.option('--trace_sql', envvar='FIRMS_TRACE_SQL', is_flag=True, default=False, help="Time every SQL statement and index lookup, saving totals to the index for `firms info sql`; also set by FIRMS_TRACE_SQL")
+@click.option('--slow_ms', envvar='FIRMS_SLOW_MS', default=100.0, help="With --trace_sql, statements slower than this many milliseconds go to the slow query log; defaults to 100")
+@click.option('--slow_log', envvar='FIRMS_SLOW_LOG', default=None, help="With --trace_sql, path of a JSON lines file to append slow statements to; also set by FIRMS_SLOW_LOG")
+@click.pass_context
+def cli(ctx, profile, cprofile, trace_sql, slow_ms, slow_log):
     """
     FIRMS: Fuzzy Information Retrieval for Musical Scores
     
@@ -547,12 +1350,33 @@ def cli():
     See https://github.com/axiomabsolute/cs410-information-retrieval/blob/master/README.md
     for more deatil
     """
-    pass
+    if profile or cprofile:
+        profiler.enable(cprofile=bool(cprofile))
+        ctx.call_on_close(partial(finish_profile, profile, cprofile))
+    if trace_sql:
+        sql_tracer.enable(slow_ms, slow_log)
+        ctx.call_on_close(sql_tracer.save)
+
+def finish_profile(profile, cprofile):
+    """
+    Stop profiling and write out what was recorded
+        :param profile: Path to write the JSON report to, or None
+        :param cprofile: Path to dump cProfile statistics to, or None
+    """
+    profiler.disable(cprofile)
+    if profile:
+        profiler.write_report(profile)
+        print("Profile written to %s" % profile)
+    if cprofile:
+        print("cProfile statistics written to %s" % cprofile)
 
 # Build command groups
 info.add_command(info_pieces)
 info.add_command(info_general)
 info.add_command(info_piece)
+info.add_command(info_stems)
+info.add_command(info_sql)
+info.add_command(info_filters)
 
 add.add_command(add_piece)
 add.add_command(add_composer)
@@ -561,6 +1385,7 @@ add.add_command(add_directory)
 
 query.add_command(query_tiny)
 query.add_command(query_piece)
+query.add_command(query_batch)
 
 midi.add_command(midi_tiny)
 midi.add_command(midi_xml)
@@ -573,8 +1398,14 @@ cli.add_command(midi)
 
 # Add orphan commands
 cli.add_command(create)
+cli.add_command(merge)
+cli.add_command(remove)
+cli.add_command(fuzzy_index)
 cli.add_command(show_composers)
 cli.add_command(evaluate)
+cli.add_command(show_metrics)
+cli.add_command(bench)
+cli.add_command(synth)
 cli.add_command(show)
 
 if __name__ == "__main__":
@@ -0,0 +1,100 @@
+"""
+Approximate stem matching by symmetric deletion.
+
+A stem is a sequence of tokens, one per note or interval. Two stems of the same number of tokens are within
+edit distance d of each other only if deleting at most d tokens from each leaves the same sequence, so
+indexing every stem under each of its deletion variants finds all stems within distance d with a few
+indexed lookups, rather than by comparing the query with every stem.
+"""
+
+from itertools import combinations
+import re
+
+# Chords are stemmed as a bracketed group of pitches, which is a single token
+TOKEN_PATTERN = re.compile(r'\[[^\]]*\]|\S+')
+# Weight of a match is FUZZY_WEIGHT ** distance, so exact matches count fully
+FUZZY_WEIGHT = 0.5
+MAX_FUZZY_DISTANCE = 3
+# A lookup verifies at most this many candidate stems, and fetches the rows of at most this many neighbours,
+# nearest first, so short variants shared by much of a stemmer's vocabulary don't make it scan every stem
+MAX_FUZZY_CANDIDATES = 5000
+MAX_FUZZY_NEIGHBOURS = 200
+
+def tokenize_stem(stem):
+    return TOKEN_PATTERN.findall(stem)
+
+def stem_variants(stem, max_distance, min_distance=1):
+    """
+    Return the set of strings left by deleting between min_distance and max_distance tokens from a stem.
+    Stems too short to leave a token are not varied
+        :param stem: Stem string
+        :param max_distance: Largest number of tokens to delete
+        :param min_distance=1: Smallest number of tokens to delete
+    """
+    tokens = tokenize_stem(stem)
+    variants = set()
+    for number_of_deletions in range(min_distance, min(max_distance, len(tokens) - 1) + 1):
+        for deleted in combinations(range(len(tokens)), number_of_deletions):
+            variants.add(' '.join(token for position, token in enumerate(tokens) if position not in deleted))
+    return variants
+
+def token_edit_distance(first, second):
+    """
+    Levenshtein distance between two token sequences
+        :param first: List of tokens
+        :param second: List of tokens
+    """
+    previous = list(range(len(second) + 1))
+    for i, first_token in enumerate(first, 1):
+        current = [i]
+        for j, second_token in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first_token != second_token)))
+        previous = current
+    return previous[-1]
+
+def match_weight(distance):
+    """
+    Weight of a single match for graders: 1 for exact matches, decaying with the edit distance of fuzzy matches
+        :param distance: Edit distance between the matched stem and the query stem, as given by LookupResult.distance
+    """
+    return FUZZY_WEIGHT ** distance if distance else 1
+
+class StemVariants:
+    """
+    Deletion variants of a range of a stemmer's stems, kept in memory for fuzzy lookups the stored variant
+    table doesn't cover. Records the largest stem id it covers, so stems added later can be caught up incrementally.
+    """
+    def __init__(self, max_distance, after_stem_id=0, epoch=None):
+        """
+        Constructor
+            :param self:
+            :param max_distance: Largest number of tokens deleted from each stem
+            :param after_stem_id=0: Stems with ids up to this one are left to the stored variant table
+            :param epoch=None: Stem deletion epoch the variants were built in; see SqlIRSystem.stem_filter_version
+        """
+        self.max_distance = max_distance
+        self.after_stem_id = after_stem_id
+        self.max_stem_id = after_stem_id
+        self.epoch = epoch
+        # Dictionary from variant to list of (stem id, stem) it was left by
+        self.variants = {}
+
+    def add(self, stem_id, stem):
+        for variant in stem_variants(stem, self.max_distance):
+            self.variants.setdefault(variant, []).append((stem_id, stem))
+        self.max_stem_id = max(self.max_stem_id, stem_id)
+
+    def candidates(self, variants, limit):
+        """
+        Return a dictionary from stem id to stem of at most limit stems sharing a variant with a query stem
+            :param self:
+            :param variants: Deletion variants of the query stem, with at most max_distance deletions
+            :param limit: Largest number of stems to return
+        """
+        candidates = {}
+        for variant in variants:
+            for stem_id, stem in self.variants.get(variant, ()):
+                if len(candidates) >= limit:
+                    return candidates
+                candidates[stem_id] = stem
+        return candidates
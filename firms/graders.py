@@ -2,10 +2,10 @@
 Implementations of FIRMS Grader abstract class
 """
 
-from itertools import groupby
-from operator import attrgetter, itemgetter
 from math import log
-from firms.models import Grader, GraderResult
+from types import MappingProxyType
+from firms.fuzzy import match_weight
+from firms.models import Grader, GraderAccumulator, GraderResult, top_results
 
 def by(*getters):
     """
@@ -20,16 +20,66 @@ def by(*getters):
         return result
     return _by
 
-# Named tuples use attrgetter
-by_lookup_match = attrgetter('lookup_match')
-by_stemmer = attrgetter('stemmer')
+def stem_weights(lookup):
+    """
+    Weight of the matches of each stem of a lookup: 1 for the query stem, less for fuzzy matches
+        :param lookup: LookupResult
+    """
+    return {stem: match_weight(lookup.distance(stem)) for stem in set(lookup.stems)}
 
-# Dictionaries use itemgetter
-by_piece = itemgetter('piece')
-by_piece_id = itemgetter('piece_id')
-by_stem = itemgetter('stem')
-by_lookup_match_piece = by(by_lookup_match, by_piece_id)
-by_lookup_match_stem = by(by_lookup_match, by_stem)
+def match_columns(lookup, multiplicity):
+    """
+    Copy the piece ids and stem ids of a lookup's matches into numpy arrays, along with the weight
+    of each match times the multiplicity of its lookup.
+    Returns (piece ids, stem ids, weights)
+        :param lookup: LookupResult
+        :param multiplicity: Number of times the lookup's stem occurred in the query
+    """
+    import numpy as np
+    # Copied rather than viewed, since an array exporting its buffer can't be extended
+    piece_ids = np.array(lookup.piece_ids, dtype=np.int64)
+    stems = np.array(lookup.stems, dtype=np.int64)
+    if lookup.matched_stems:
+        stem_values, stem_index = np.unique(stems, return_inverse=True)
+        weights = np.array([match_weight(lookup.distance(stem)) for stem in stem_values.tolist()])[stem_index] * multiplicity
+    else:
+        weights = np.full(len(stems), float(multiplicity))
+    return piece_ids, stems, weights
+
+def sum_by_pair(keys, values, weights):
+    """
+    Sum weights over each distinct (key, value) pair, where values are dense indices below the number of values.
+    Returns (keys of the pairs, values of the pairs, sums), the pairs ordered by key then value
+        :param keys: Numpy array of non-negative dense indices
+        :param values: Numpy array of dense indices, as long as keys
+        :param weights: Numpy array of weights, as long as keys
+    """
+    import numpy as np
+    number_of_values = int(values.max()) + 1
+    pairs, pair_index = np.unique(keys * number_of_values + values, return_inverse=True)
+    pair_keys, pair_values = np.divmod(pairs, number_of_values)
+    return pair_keys, pair_values, np.bincount(pair_index, weights=weights)
+
+def grade_results(piece_ids, grades, topk=None):
+    """
+    Make GraderResults from arrays of piece ids and their grades.
+    With topk, only the topk best graded pieces are kept, found with argpartition, best first; ties go to the lower piece id
+        :param piece_ids: Numpy array of piece ids
+        :param grades: Numpy array of grades, as long as piece_ids
+        :param topk=None: Number of results to keep; every piece, in piece id order, if None
+    """
+    import numpy as np
+    if topk is not None:
+        if topk <= 0:
+            return []
+        if topk < len(grades):
+            kth_grade = grades[np.argpartition(-grades, topk - 1)[topk - 1]]
+            best = np.flatnonzero(grades >= kth_grade)
+        else:
+            best = np.arange(len(grades))
+        best = best[np.lexsort((piece_ids[best], -grades[best]))][:topk]
+        piece_ids, grades = piece_ids[best], grades[best]
+    return [GraderResult(piece=piece, grade=grade, meta={}) for piece, grade in zip(piece_ids.tolist(), grades.tolist())]
 
 def bm25_idf(N, df):
     """
@@ -84,61 +134,181 @@ class Bm25Grader(Grader):
     Implementation of FIRMS grader as Oakpi BM25 without document length normalization
         :param Grader: FIRMS Grader abstract class
     """
-    def zero(self):
-        self.tfs = {}
-        self.dfs = {}
-    
-    def grade(self, number_of_pieces):
-        tfs = self.tfs
-        dfs = self.dfs
-        return [ GraderResult(piece=piece, grade=sum([bm25_tf(cnt) * bm25_idf(number_of_pieces, len(dfs[stem])) for stem,cnt in piece_tfs.items() ]), meta={}) for piece, piece_tfs in tfs.items()]
-
-    def aggregate(self, matches):
-        # Compute DF - Dictionary from stem -> piece count
-        dfs = {}
-        for stem, stem_matches in groupby(sorted(matches, key=by_lookup_match_stem), by_lookup_match_stem):
-            dfs[stem] = set(map(by_lookup_match_piece, stem_matches))
-
-        # For each piece compute TF scores - Dictionary from piece to Dictionary from stem to count
-        tfs = {}
-        for piece, piece_matches in groupby(sorted(matches, key=by_lookup_match_piece), by_lookup_match_piece):
-            tfs[piece] = {}
-            for stem, stem_matches in groupby(sorted(piece_matches, key=by_lookup_match_stem), by_lookup_match_stem):
-                tfs[piece][stem] = len(list(stem_matches))
-
-        # Merge existing with this iteration
-        update_with_union(self.dfs, dfs)
-        for piece, piece_stems in tfs.items():
-            if piece not in self.tfs:
-                self.tfs[piece] = {}
-            update_with_sum(self.tfs[piece], piece_stems)
+    def __init__(self, k=1.2):
+        """
+        Constructor
+            :param self:
+            :param k=1.2: K parameter for BM25 term frequency
+        """
+        self.k = k
+
+    def accumulator(self):
+        return Bm25Accumulator(self.k)
+
+class Bm25Accumulator(GraderAccumulator):
+    """
+    Per-query state for Bm25Grader. Matches are kept as numpy arrays and scored together when graded
+        :param GraderAccumulator: FIRMS GraderAccumulator abstract class
+    """
+    def __init__(self, k):
+        self.k = k
+        # Lists of numpy arrays, one of each per lookup with matches
+        self.piece_ids = []
+        self.stems = []
+        self.weights = []
+
+    def grade(self, number_of_pieces, topk=None):
+        if not self.piece_ids:
+            return []
+        import numpy as np
+        # Dense piece and stem indices, so TF and DF are sums over small arrays
+        piece_ids, piece_index = np.unique(np.concatenate(self.piece_ids), return_inverse=True)
+        stem_index = np.unique(np.concatenate(self.stems), return_inverse=True)[1]
+        # TF of each (piece, stem) pair, where fuzzy matches count less the further they are from the query stem,
+        # and DF of each stem - the number of pieces it matched
+        pair_pieces, pair_stems, tfs = sum_by_pair(piece_index, stem_index, np.concatenate(self.weights))
+        dfs = np.bincount(pair_stems)
+        assert(dfs.max() <= number_of_pieces)
+        idfs = np.log((number_of_pieces - dfs + 0.5) / (dfs + 0.5))
+        grades = np.bincount(pair_pieces, weights=bm25_tf(tfs, self.k) * idfs[pair_stems], minlength=len(piece_ids))
+        return grade_results(piece_ids, grades, topk)
+
+    def aggregate(self, matches, multiplicity=1):
+        if not len(matches.lookup):
+            return
+        piece_ids, stems, weights = match_columns(matches.lookup, multiplicity)
+        self.piece_ids.append(piece_ids)
+        self.stems.append(stems)
+        self.weights.append(weights)
 
 class LogWeightedSumGrader(Grader):
     """
     Implementation of FIRMS Grader as a weighted sum of log counts
         :param Grader: FIRMS Grader abstract class
     """
+    def __init__(self, weights):
+        """
+        Constructor
+            :param self:
+            :param weights: Dictionary from stemmer name to weight
+        """
+        self.weights = MappingProxyType(dict(weights))
+
+    def accumulator(self):
+        return LogWeightedSumAccumulator(self.weights)
+
+class LogWeightedSumAccumulator(GraderAccumulator):
+    """
+    Per-query state for LogWeightedSumGrader. Matches are kept as numpy arrays and scored together when graded
+        :param GraderAccumulator: FIRMS GraderAccumulator abstract class
+    """
     def __init__(self, weights):
         self.weights = weights
-        super().__init__()
+        # Dictionary from stemmer name to its index in stemmer_index
+        self.stemmers = {}
+        # Lists of numpy arrays, one of each per lookup with matches
+        self.piece_ids = []
+        self.stemmer_index = []
+        self.match_weights = []
+
+    def grade(self, number_of_pieces, topk=None):
+        if not self.piece_ids:
+            return []
+        import numpy as np
+        piece_ids, piece_index = np.unique(np.concatenate(self.piece_ids), return_inverse=True)
+        # Weighted count of the matches of each (piece, stemmer) pair
+        pair_pieces, pair_stemmers, counts = sum_by_pair(piece_index, np.concatenate(self.stemmer_index), np.concatenate(self.match_weights))
+        stemmer_weights = np.array([self.weights[stemmer] for stemmer in self.stemmers], dtype=np.float64)
+        grades = np.bincount(pair_pieces, weights=stemmer_weights[pair_stemmers] * np.log(counts), minlength=len(piece_ids))
+        return grade_results(piece_ids, grades, topk)
+
+    def aggregate(self, matches, multiplicity=1):
+        if not len(matches.lookup):
+            return
+        import numpy as np
+        piece_ids, _, weights = match_columns(matches.lookup, multiplicity)
+        stemmer_index = self.stemmers.setdefault(matches.stemmer, len(self.stemmers))
+        self.piece_ids.append(piece_ids)
+        self.stemmer_index.append(np.full(len(piece_ids), stemmer_index, dtype=np.int64))
+        self.match_weights.append(weights)
+
+class AlignmentGrader(Grader):
+    """
+    Implementation of FIRMS Grader scoring where matches occur rather than how many there are.
+    A passage matching the query shows up as a chain of matches whose offsets in one part advance
+    with their offsets in the query, across stemmers. Each piece is graded by its best chain,
+    found with a dynamic programming pass over the matches of each part
+        :param Grader: FIRMS Grader abstract class
+    """
+    def __init__(self, weights=None, max_gap=2, max_shift=1, gap_penalty=0.5):
+        """
+        Constructor
+            :param self:
+            :param weights=None: Dictionary from stemmer name to the score of one of its matches; 1 for stemmers not given
+            :param max_gap=2: Largest number of query offsets a chain may skip between two matches
+            :param max_shift=1: Largest number of notes the piece may have inserted or deleted between two matches of a chain
+            :param gap_penalty=0.5: Score lost for each skipped query offset and each inserted or deleted note
+        """
+        self.weights = MappingProxyType(dict(weights or {}))
+        self.max_gap = max_gap
+        self.max_shift = max_shift
+        self.gap_penalty = gap_penalty
+
+    def accumulator(self):
+        return AlignmentAccumulator(self)
+
+class AlignmentAccumulator(GraderAccumulator):
+    """
+    Per-query state for AlignmentGrader
+        :param GraderAccumulator: FIRMS GraderAccumulator abstract class
+    """
+    def __init__(self, grader):
+        self.grader = grader
+        # Dictionary from piece to dictionary from (part, query offset, piece offset) to summed match score
+        self.cells_by_piece = {}
+
+    def aggregate(self, matches, multiplicity=1):
+        # Every occurrence of a stem in the query is a separate query offset, so multiplicity is already counted
+        lookup = matches.lookup
+        stemmer_weight = self.grader.weights.get(matches.stemmer, 1)
+        scores = {stem: stemmer_weight * weight for stem, weight in stem_weights(lookup).items()}
+        for piece, part, offset, stem in zip(lookup.piece_ids, lookup.parts, lookup.offsets, lookup.stems):
+            score = scores[stem]
+            cells = self.cells_by_piece.setdefault(piece, {})
+            for query_offset in matches.query_offsets:
+                cell = (part, query_offset, offset)
+                cells[cell] = cells.get(cell, 0) + score
+
+    def best_chain(self, cells):
+        """
+        Find the highest scoring chain of cells.
+        Returns (score, (part, query offset, piece offset) of the chain's first cell)
+            :param self:
+            :param cells: Dictionary from (part, query offset, piece offset) to score
+        """
+        max_gap, max_shift, gap_penalty = self.grader.max_gap, self.grader.max_shift, self.grader.gap_penalty
+        chains = {}
+        best = (float('-inf'), None)
+        # Sorted by part, then query offset, so every predecessor of a cell is scored before it
+        for cell in sorted(cells):
+            part, query_offset, piece_offset = cell
+            chain = (cells[cell], cell)
+            for query_step in range(1, max_gap + 2):
+                for piece_step in range(max(1, query_step - max_shift), query_step + max_shift + 1):
+                    previous = chains.get((part, query_offset - query_step, piece_offset - piece_step))
+                    if previous is None:
+                        continue
+                    score = previous[0] + cells[cell] - gap_penalty * (query_step - 1 + abs(piece_step - query_step))
+                    if score > chain[0]:
+                        chain = (score, previous[1])
+            chains[cell] = chain
+            if chain[0] > best[0]:
+                best = chain
+        return best
 
-    def zero(self):
-        self.stemmer_counts_by_piece = {}
-    
-    def grade(self, number_of_pieces):
+    def grade(self, number_of_pieces, topk=None):
         grades = []
-        for piece, stemmer_counts in self.stemmer_counts_by_piece.items():
-            piece_grade = 0
-            for stemmer, count in stemmer_counts.items():
-                piece_grade = piece_grade + ( self.weights[stemmer] * log(count))
-            grades.append( GraderResult(piece=piece, grade=piece_grade, meta={}) )
-        return grades
-    
-    def aggregate(self, matches):
-        for piece, piece_matches in groupby(sorted(matches, key=by_lookup_match_piece), by_lookup_match_piece):
-            if piece not in self.stemmer_counts_by_piece:
-                self.stemmer_counts_by_piece[piece] = {}
-            for stemmer, stemmer_matches in groupby(sorted(piece_matches, key=by_stemmer), by_stemmer):
-                if stemmer not in self.stemmer_counts_by_piece[piece]:
-                    self.stemmer_counts_by_piece[piece][stemmer] = 0
-                self.stemmer_counts_by_piece[piece][stemmer] = self.stemmer_counts_by_piece[piece][stemmer] + len(list(stemmer_matches))
+        for piece, cells in self.cells_by_piece.items():
+            score, (part, query_offset, piece_offset) = self.best_chain(cells)
+            grades.append(GraderResult(piece=piece, grade=score, meta={'part': part, 'query_offset': query_offset, 'offset': piece_offset}))
+        return top_results(grades, topk)
@@ -0,0 +1,62 @@
+"""
+Statistics describing how stems are spread over an index.
+
+A stem's posting length is the number of entries, i.e. snippets, indexed under it. Lookup cost grows
+with posting length, so a stemmer whose common stems have long postings (such as rhythm or contour)
+makes queries slow, while rare stems are cheap but match little. Every function takes a NumPy array
+of posting lengths with one entry per stem.
+"""
+
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+# Fraction of the most frequent stems whose share of all postings is reported
+TOP_FRACTION = 0.01
+
+def log2_buckets(posting_lengths):
+    """
+    Count stems by posting length in power of two buckets: 1, 2-3, 4-7, ...
+    Returns a list of counts, the i'th counting lengths from 2^i to 2^(i+1) - 1
+        :param posting_lengths: Array of posting lengths
+    """
+    if not len(posting_lengths):
+        return []
+    return np.bincount(np.floor(np.log2(posting_lengths)).astype(np.int64)).tolist()
+
+def bucket_label(bucket):
+    low, high = 2 ** bucket, 2 ** (bucket + 1) - 1
+    return str(low) if low == high else "%s-%s" % (low, high)
+
+def top_share(posting_lengths, fraction=TOP_FRACTION):
+    """
+    Share of all postings held by the most frequent fraction of stems, at least one stem
+        :param posting_lengths: Array of posting lengths
+        :param fraction=TOP_FRACTION: Fraction of stems to include
+    """
+    total = posting_lengths.sum()
+    if not total:
+        return 0.0
+    number_of_stems = max(1, int(len(posting_lengths) * fraction))
+    return float(np.partition(posting_lengths, len(posting_lengths) - number_of_stems)[-number_of_stems:].sum() / total)
+
+def summarize_postings(posting_lengths, number_of_snippets):
+    """
+    Summarize the posting lengths of one stemmer
+        :param posting_lengths: Array of posting lengths
+        :param number_of_snippets: Number of distinct snippets indexed by the stemmer
+    """
+    postings = int(posting_lengths.sum())
+    summary = {
+        'stems': len(posting_lengths),
+        'postings': postings,
+        'snippets': number_of_snippets,
+        'stems_per_snippet': postings / number_of_snippets if number_of_snippets else 0.0,
+        'mean': float(posting_lengths.mean()) if len(posting_lengths) else 0.0,
+        'max': int(posting_lengths.max()) if len(posting_lengths) else 0,
+        'singletons': float((posting_lengths == 1).mean()) if len(posting_lengths) else 0.0,
+        'top_share': top_share(posting_lengths),
+        'buckets': log2_buckets(posting_lengths)
+    }
+    for percentile, value in zip(PERCENTILES, np.percentile(posting_lengths, PERCENTILES) if len(posting_lengths) else [0] * len(PERCENTILES)):
+        summary['p%s' % percentile] = float(value)
+    return summary
@@ -0,0 +1,191 @@
+"""
+Evaluation metrics over the rank of the true piece in each sample's results.
+
+Ranks are 0 based positions in a grader's results ordered by descending grade, ties keeping
+the order the grader returned them in, or NOT_FOUND when the true piece wasn't returned at all.
+Every metric takes a NumPy array of ranks with one entry per sample.
+"""
+
+import numpy as np
+
+NOT_FOUND = -1
+DEFAULT_KS = (1, 5, 10)
+
+def rank_true_pieces(results_lists, true_pieces):
+    """
+    Find the rank and grade of the true piece in each sample's results without sorting them.
+    The rank is the number of results graded above the true piece, plus ties returned before it.
+    Returns an array of ranks and an array of grades, NaN where the true piece wasn't returned
+        :param results_lists: Sequence of lists of GraderResult, one per sample
+        :param true_pieces: Sequence of the true piece id of each sample
+    """
+    number_of_samples = len(results_lists)
+    lengths = np.fromiter((len(results) for results in results_lists), np.int64, number_of_samples)
+    total = int(lengths.sum())
+    pieces = np.fromiter((result.piece for results in results_lists for result in results), np.int64, total)
+    grades = np.fromiter((result.grade for results in results_lists for result in results), np.float64, total)
+    sample_idxs = np.repeat(np.arange(number_of_samples), lengths)
+    # Position of the first result matching each sample's true piece; assigning in reverse leaves the first
+    matches = np.flatnonzero(pieces == np.asarray(true_pieces, np.int64)[sample_idxs])[::-1]
+    true_positions = np.full(number_of_samples, NOT_FOUND, np.int64)
+    true_positions[sample_idxs[matches]] = matches
+    found = true_positions != NOT_FOUND
+    true_grades = np.full(number_of_samples, np.nan)
+    true_grades[found] = grades[true_positions[found]]
+    sample_true_grades = true_grades[sample_idxs]
+    ahead = (grades > sample_true_grades) | ((grades == sample_true_grades) & (np.arange(total) < true_positions[sample_idxs]))
+    ranks = np.bincount(sample_idxs, weights=ahead, minlength=number_of_samples).astype(np.int64)
+    ranks[~found] = NOT_FOUND
+    return ranks, true_grades
+
+def reciprocal_ranks(ranks):
+    """
+    Reciprocal rank of each sample, 0 when the true piece wasn't found
+        :param ranks: Array of ranks
+    """
+    ranks = np.asarray(ranks)
+    return np.where(ranks != NOT_FOUND, 1.0 / (np.maximum(ranks, 0) + 1), 0.0)
+
+def mean_reciprocal_rank(ranks):
+    return float(reciprocal_ranks(ranks).mean()) if len(ranks) else 0.0
+
+def recall_at_k(ranks, k):
+    """
+    Fraction of samples whose true piece is in the top k results
+        :param ranks: Array of ranks
+        :param k: Number of results considered
+    """
+    ranks = np.asarray(ranks)
+    return float(((ranks != NOT_FOUND) & (ranks < k)).mean()) if len(ranks) else 0.0
+
+def ndcg(ranks, k=None):
+    """
+    Mean normalized discounted cumulative gain. With a single relevant piece per sample the ideal
+    DCG is 1, so each sample scores 1 / log2(rank + 2), or 0 if the true piece is missing or ranked k or below
+        :param ranks: Array of ranks
+        :param k=None: Number of results considered; all if None
+    """
+    ranks = np.asarray(ranks)
+    if not len(ranks):
+        return 0.0
+    counted = ranks != NOT_FOUND
+    if k is not None:
+        counted = counted & (ranks < k)
+    return float(np.where(counted, 1.0 / np.log2(np.maximum(ranks, 0) + 2), 0.0).mean())
+
+def rank_distribution(ranks, percentiles=(50, 90, 95, 99)):
+    """
+    Summarize the ranks of found pieces: count found and missing, mean and percentiles
+        :param ranks: Array of ranks
+        :param percentiles: Percentiles to report
+    """
+    ranks = np.asarray(ranks)
+    found = ranks[ranks != NOT_FOUND]
+    distribution = {'found': int(len(found)), 'missing': int(len(ranks) - len(found))}
+    distribution['mean'] = float(found.mean()) if len(found) else np.nan
+    for percentile, value in zip(percentiles, np.percentile(found, percentiles) if len(found) else [np.nan] * len(percentiles)):
+        distribution['p%s' % percentile] = float(value)
+    return distribution
+
+def summarize(ranks, ks=DEFAULT_KS):
+    """
+    Compute every metric for one grader's ranks
+        :param ranks: Array of ranks
+        :param ks: Cutoffs for recall@k and nDCG@k
+    """
+    summary = {'samples': int(len(ranks)), 'MRR': mean_reciprocal_rank(ranks), 'nDCG': ndcg(ranks)}
+    for k in ks:
+        summary['recall@%s' % k] = recall_at_k(ranks, k)
+    for k in ks:
+        summary['nDCG@%s' % k] = ndcg(ranks, k)
+    summary.update(rank_distribution(ranks))
+    return summary
+
+class EvaluationRun:
+    """
+    Ranks and grades of the true piece for every sample of an evaluation, one column per grader
+    """
+    def __init__(self, piece_ids, ranks, grades, result_counts):
+        """
+        Constructor
+            :param self:
+            :param piece_ids: Array of the true piece id of each sample
+            :param ranks: Dictionary from grader name to array of ranks
+            :param grades: Dictionary from grader name to array of true piece grades
+            :param result_counts: Dictionary from grader name to array of the number of results per sample
+        """
+        self.piece_ids = piece_ids
+        self.ranks = ranks
+        self.grades = grades
+        self.result_counts = result_counts
+
+    @classmethod
+    def from_results(cls, piece_ids, query_results):
+        """
+        Build a run from the query results of each sample
+            :param piece_ids: Sequence of the true piece id of each sample
+            :param query_results: Sequence of dictionaries from grader name to list of GraderResult, one per sample
+        """
+        graders = sorted(set(grader for grader_results in query_results for grader in grader_results))
+        ranks, grades, result_counts = {}, {}, {}
+        for grader in graders:
+            results_lists = [grader_results.get(grader, []) for grader_results in query_results]
+            ranks[grader], grades[grader] = rank_true_pieces(results_lists, piece_ids)
+            result_counts[grader] = np.array([len(results) for results in results_lists], np.int64)
+        return cls(np.asarray(piece_ids, np.int64), ranks, grades, result_counts)
+
+    def graders(self):
+        return sorted(self.ranks.keys())
+
+    def summarize(self, ks=DEFAULT_KS):
+        """
+        Dictionary from grader name to its metrics
+            :param self:
+            :param ks: Cutoffs for recall@k and nDCG@k
+        """
+        return {grader: summarize(self.ranks[grader], ks) for grader in self.graders()}
+
+    def save(self, path):
+        """
+        Write the run to a compressed NumPy .npz file, with a samples x graders column for ranks,
+        grades and result counts
+            :param self:
+            :param path: File path to write to
+        """
+        graders = self.graders()
+        np.savez_compressed(
+            path,
+            graders=np.array(graders, dtype=str),
+            piece_ids=self.piece_ids,
+            ranks=self.columns(self.ranks, np.int64),
+            grades=self.columns(self.grades, np.float64),
+            result_counts=self.columns(self.result_counts, np.int64)
+        )
+
+    def columns(self, arrays_by_grader, dtype):
+        """
+        Stack per grader arrays into a samples x graders matrix, graders in name order
+            :param self:
+            :param arrays_by_grader: Dictionary from grader name to array
+            :param dtype: NumPy dtype of the matrix
+        """
+        graders = self.graders()
+        matrix = np.empty((len(self.piece_ids), len(graders)), dtype)
+        for i, grader in enumerate(graders):
+            matrix[:, i] = arrays_by_grader[grader]
+        return matrix
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a run written by save
+            :param path: File path to read from
+        """
+        with np.load(path) as data:
+            graders = [str(grader) for grader in data['graders']]
+            return cls(
+                data['piece_ids'],
+                {grader: data['ranks'][:, i] for i, grader in enumerate(graders)},
+                {grader: data['grades'][:, i] for i, grader in enumerate(graders)},
+                {grader: data['result_counts'][:, i] for i, grader in enumerate(graders)}
+            )
@@ -2,27 +2,249 @@
 Collection of models and functions for interacting with them.
 """
 
-from collections import defaultdict, namedtuple
+from array import array
+from collections import defaultdict, namedtuple, Counter
 from abc import ABCMeta, abstractmethod
+from heapq import nlargest
+from itertools import islice
 import os
+import threading
+import time
 
-import music21
+from firms.profiling import profiler
 
 # A part of a musical score, represented by a music21 stream
 # and lineage information
 Part = namedtuple('Part', ['piece', 'name', 'part'])
 
-# A single query match row
-LookupMatch = namedtuple('LookupMatch', [
-    'id', 'piece', 'part', 'offset', 'stem', 'path', 'piece_id'
-])
-
-# A LookupMatch and the stemmer name that caused the match
-GraderMatch = namedtuple('GraderMatch', ['stemmer', 'lookup_match'])
+# The LookupResult of one stem, the stemmer name that caused the matches, and the note offsets in the query of the stem
+GraderLookup = namedtuple('GraderLookup', ['stemmer', 'lookup', 'query_offsets'], defaults=[()])
 
 # A single result from grading a piece
 GraderResult = namedtuple('GraderResult', ['piece', 'grade', 'meta'])
 
+def top_results(results, topk=None):
+    """
+    Keep the best graded results, best first; ties go to the lower piece id
+        :param results: List of GraderResult
+        :param topk=None: Number of results to keep; every result, in the given order, if None
+    """
+    if topk is None:
+        return results
+    return nlargest(topk, results, key=lambda result: (result.grade, -result.piece))
+
+# A distinct stem to look up, the index that produced it, and the snippet length it was produced at
+QueryStem = namedtuple('QueryStem', ['stemmer', 'length', 'stem'])
+
+# The outcome of a single query within a batch: grades by grader (None if the query failed),
+# a dictionary of seconds spent per stage and lookup counts, and the exception raised, if any
+BatchQueryResult = namedtuple('BatchQueryResult', ['grades', 'stats', 'error'])
+
+# Number of notes in a snippet when a stemmer is not configured otherwise
+DEFAULT_SNIPPET_LENGTH = 5
+# Number of pieces kept by the first stage of a two stage query
+DEFAULT_CANDIDATES = 50
+
+class LookupResult:
+    """
+    The matches of a lookup, stored by column: for each matching snippet, its id, piece id, part id,
+    offset within the part and stem id are at the same position of five arrays of 64 bit integers.
+    Piece names and paths are not repeated per match; look them up once by piece id, as with pieces().
+    Fuzzy lookups also match stems other than the query's; matched_stems maps each of their stem ids
+    to (edit distance, stem string)
+    """
+    __slots__ = ('ids', 'piece_ids', 'parts', 'offsets', 'stems', 'matched_stems')
+    COLUMNS = ('ids', 'piece_ids', 'parts', 'offsets', 'stems')
+
+    def __init__(self, ids=(), piece_ids=(), parts=(), offsets=(), stems=(), matched_stems=None):
+        """
+        Constructor
+            :param self:
+            :param ids=(): Snippet ids
+            :param piece_ids=(): Piece ids
+            :param parts=(): Part ids
+            :param offsets=(): Offsets of the snippets within their parts
+            :param stems=(): Stem ids
+            :param matched_stems=None: Dictionary from the stem id of a fuzzy match to (distance, stem)
+        """
+        self.ids = array('q', ids)
+        self.piece_ids = array('q', piece_ids)
+        self.parts = array('q', parts)
+        self.offsets = array('q', offsets)
+        self.stems = array('q', stems)
+        self.matched_stems = dict(matched_stems or {})
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __eq__(self, other):
+        return isinstance(other, LookupResult) and self.rows() == other.rows() and self.matched_stems == other.matched_stems
+
+    def __repr__(self):
+        return "LookupResult(%s matches)" % len(self)
+
+    def extend_rows(self, rows):
+        """
+        Append rows of (snippet id, piece id, part id, offset, stem id)
+            :param self:
+            :param rows: List of row tuples, as fetched from sqlite
+        """
+        if not rows:
+            return
+        for column, values in zip(self.COLUMNS, zip(*rows)):
+            getattr(self, column).extend(values)
+
+    def extend(self, other):
+        """
+        Append the matches of another LookupResult
+            :param self:
+            :param other: LookupResult to append
+        """
+        for column in self.COLUMNS:
+            getattr(self, column).extend(getattr(other, column))
+        self.matched_stems.update(other.matched_stems)
+
+    def rows(self):
+        return list(zip(self.ids, self.piece_ids, self.parts, self.offsets, self.stems))
+
+    def select(self, positions):
+        """
+        Return a new LookupResult holding the matches at some positions
+            :param self:
+            :param positions: Iterable of positions
+        """
+        positions = list(positions)
+        return LookupResult(*[[getattr(self, column)[position] for position in positions] for column in self.COLUMNS], self.matched_stems)
+
+    def head(self, number_of_matches):
+        """
+        Return a new LookupResult holding the first matches
+            :param self:
+            :param number_of_matches: Number of matches to keep
+        """
+        return LookupResult(*[getattr(self, column)[:number_of_matches] for column in self.COLUMNS], self.matched_stems)
+
+    def in_pieces(self, piece_ids):
+        """
+        Return a new LookupResult holding the matches of some pieces
+            :param self:
+            :param piece_ids: Set of piece ids
+        """
+        return self.select(position for position, piece_id in enumerate(self.piece_ids) if piece_id in piece_ids)
+
+    def distance(self, stem_id):
+        """
+        Edit distance between the query stem and a matched stem; 0 for the query stem itself
+            :param self:
+            :param stem_id: Id of a matched stem
+        """
+        matched = self.matched_stems.get(stem_id)
+        return matched[0] if matched else 0
+
+class QueryResults(dict):
+    """
+    A dictionary from grader name to list of GraderResult, flagged as truncated when
+    a QueryBudget cut lookups short, so some matches are missing from the grades
+    """
+    truncated = False
+
+class QueryBudget:
+    """
+    Limits on the posting rows a single query fetches and the time it takes. Lookups ask the budget
+    before fetching each batch of rows and stop once it is spent, so a pathological query returns
+    partial results rather than holding a worker. Shared by the lookups of one query, which may run in
+    several threads
+    """
+    def __init__(self, max_rows_per_stem=None, max_rows=None, deadline=None):
+        """
+        Constructor
+            :param self:
+            :param max_rows_per_stem=None: Largest number of rows fetched by a single lookup; unlimited if None
+            :param max_rows=None: Largest number of rows fetched by all the query's lookups; unlimited if None
+            :param deadline=None: Seconds from now after which no more rows are fetched; unlimited if None
+        """
+        self.max_rows_per_stem = max_rows_per_stem
+        self.max_rows = max_rows
+        self.deadline = time.perf_counter() + deadline if deadline is not None else None
+        self.rows = 0
+        # Dictionary from QueryStem to the rows kept by its lookups, which may run in several shards
+        self.stem_rows = {}
+        self.truncated = False
+        self.lock = threading.Lock()
+
+    def exhausted(self):
+        """
+        Whether no more rows may be fetched. A lookup skipped because of this truncates the query
+            :param self:
+        """
+        with self.lock:
+            if (self.max_rows is not None and self.rows >= self.max_rows) or (self.deadline is not None and time.perf_counter() > self.deadline):
+                self.truncated = True
+                return True
+            return False
+
+    def take(self, rows, query_stem=None):
+        """
+        Ask to keep a batch of rows fetched by one lookup. Returns the number of rows that may be kept,
+        fewer than asked for if the budget ran out, which marks the query as truncated
+            :param self:
+            :param rows: Number of rows in the batch
+            :param query_stem=None: QueryStem looked up; rows kept for it by every batch and shard count against
+                max_rows_per_stem. Without one, the batch is counted as a whole lookup
+        """
+        with self.lock:
+            allowed = rows
+            if self.deadline is not None and time.perf_counter() > self.deadline:
+                allowed = 0
+            if self.max_rows_per_stem is not None:
+                allowed = min(allowed, self.max_rows_per_stem - self.stem_rows.get(query_stem, 0))
+            if self.max_rows is not None:
+                allowed = min(allowed, self.max_rows - self.rows)
+            allowed = max(0, allowed)
+            if allowed < rows:
+                self.truncated = True
+            self.rows = self.rows + allowed
+            if query_stem is not None:
+                self.stem_rows[query_stem] = self.stem_rows.get(query_stem, 0) + allowed
+            return allowed
+
+    def stem_rows_left(self, query_stem):
+        """
+        Number of rows lookups of a QueryStem may still keep under max_rows_per_stem, or None if it is unlimited
+            :param self:
+            :param query_stem: QueryStem looked up
+        """
+        if self.max_rows_per_stem is None:
+            return None
+        with self.lock:
+            return max(0, self.max_rows_per_stem - self.stem_rows.get(query_stem, 0))
+
+class QueryPlan(Counter):
+    """
+    A Counter from QueryStem to the number of times the stem occurs in a query, which also
+    records the note offsets in the query each stem occurs at
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.offsets = {}
+
+    def add(self, query_stem, offset):
+        self[query_stem] = self[query_stem] + 1
+        self.offsets.setdefault(query_stem, []).append(offset)
+
+    def subset(self, predicate):
+        """
+        Return a plan holding only the stems a predicate accepts
+            :param self:
+            :param predicate: Function from QueryStem to bool
+        """
+        plan = QueryPlan()
+        for query_stem, multiplicity in self.items():
+            if predicate(query_stem):
+                plan[query_stem] = multiplicity
+                plan.offsets[query_stem] = self.offsets.get(query_stem, [])
+        return plan
+
 def flatten(toflatten):
     """
     Flattens nested iterable by one level
@@ -34,6 +256,7 @@ def get_part_details(general_stream):
     """
     Gets a tuple of title, partName, and part for each part in a list of pieces
     """
+    import music21
     for piece in general_stream.recurse(classFilter=music21.stream.Score, skipSelf=False):
         piece_title = (piece and piece.metadata and piece.metadata.title) or "Untitled"
         for idx, part in enumerate(piece.recurse().parts):
@@ -56,13 +279,24 @@ def get_snippets_for_piece(piece_name, part_name, notes, snippet_length):
     """
     return (Snippet(piece_name, part_name, notes[i: i+snippet_length], i) for i in range(0, 1 + len(notes) - snippet_length))
 
-def get_snippets_for_part(part):
+def get_snippets_for_part(part, snippet_length=DEFAULT_SNIPPET_LENGTH):
     """
     Generate all snippets for a part
     Can expand repeated sections by converting the part to MIDI and back. May be slow.
         :param part: The music21 part to generate snippets from
+        :param snippet_length=DEFAULT_SNIPPET_LENGTH: Number of notes in each snippet
     """
-    return get_snippets_for_piece(part.piece, part.name, get_notes_and_rests(part.part), 5)
+    return get_snippets_for_piece(part.piece, part.name, get_notes_and_rests(part.part), snippet_length)
+
+def get_snippets_by_length(piece_name, part_name, notes, snippet_lengths):
+    """
+    Generate the snippets for a flat sequence of notes at each of several lengths
+        :param piece_name: Name of the source piece
+        :param part_name: Name of the source part
+        :param notes: Seq of notes
+        :param snippet_lengths: Iterable of snippet lengths
+    """
+    return {length: list(get_snippets_for_piece(piece_name, part_name, notes, length)) for length in set(snippet_lengths)}
 
 class IRSystem(metaclass=ABCMeta):
     """
@@ -82,6 +316,7 @@ class IRSystem(metaclass=ABCMeta):
         self.grader_methods = graders
         self.indexes = {k:self.make_empty_index(v, k) for k, v in index_methods.items()}
         if rebuild:
+            import music21
             for idx, piece_path in enumerate(piece_paths):
                 print("Adding piece #%s: %s" % (idx, piece_path))
                 piece = music21.corpus.parse(piece_path)
@@ -125,41 +360,297 @@ class IRSystem(metaclass=ABCMeta):
         """
         pass
 
-    def raw_query(self, query, *args):
+    def plan_query(self, query):
         """
-        Perform a query without aggregating and grading results
+        Stem a query and collapse identical stems into a single lookup.
+        Returns a QueryPlan from QueryStem to the number of times the stem occurs in the query,
+        ordered by first occurrence.
             :param self:
-            :param query: Query represented by a Music21 stream
-            :param *args: Extra arguments passed on to index lookup methods
+            :param query: Query represented by a Music21 stream or tiny notation string
         """
-        for grader in self.grader_methods.values():
-            grader.zero()
         query_stream = None
         try:
             assert 'Stream' in query.classSet or 'StreamIterator' in query.classSet
             query_stream = query
         except AssertionError:
-            query_stream = music21.tinyNotation.Converter.parse(query)
-        query_part = Part("query", "query", query_stream)
-        # This needs to be a list because it gets iterated over for every index type
-        query_snippets = list(get_snippets_for_part(query_part))
-        for index_name, index in self.indexes.items():
-            for snippet in query_snippets:
-                lookup_results = index.lookup(snippet, *args)
-                for grader in self.grader_methods.values():
-                    grader.aggregate([GraderMatch(stemmer=index_name, lookup_match=lookup_result) for lookup_result in lookup_results])
+            import music21
+            with profiler.stage('query.parse'):
+                query_stream = music21.tinyNotation.Converter.parse(query)
+        with profiler.stage('query.plan'):
+            query_notes = get_notes_and_rests(query_stream)
+            # Each index is queried with the longest snippet length it has indexed that fits the query
+            query_lengths = {index_name: index.query_length(len(query_notes)) for index_name, index in self.indexes.items()}
+            query_snippets = {
+                length: list(get_snippets_for_piece("query", "query", query_notes, length))
+                for length in set(query_lengths.values()) if length
+            }
+            plan = QueryPlan()
+            for index_name, index in self.indexes.items():
+                length = query_lengths[index_name]
+                if not length:
+                    continue
+                with profiler.stage(index.stem_stage):
+                    for snippet in query_snippets[length]:
+                        for stem in index.keyfn(snippet):
+                            plan.add(QueryStem(index_name, length, stem), snippet.offset)
+        profiler.count('query stems', sum(plan.values()))
+        profiler.count('distinct query stems', len(plan))
+        return plan
 
-    def query(self, query, *args):
+    def estimate_lookups(self, plan, *args):
         """
-        Perform a query, aggregate, and rank results
+        Estimate the number of matches each lookup of a query plan will fetch.
+        Returns a dictionary from QueryStem to estimated rows, omitting stems that can't be estimated
+            :param self:
+            :param plan: QueryPlan to estimate
+            :param *args: Extra arguments the lookups will be made with, as passed to execute_plan
+        """
+        return {}
+
+    def choose_lookups(self, plan, planner, *args):
+        """
+        Let a planner choose and order the lookups of a query plan from their estimated rows.
+        Returns the chosen QueryPlan and a list of PlanStep describing every stem of the plan
+            :param self:
+            :param plan: QueryPlan, as returned by plan_query
+            :param planner: Planner such as firms.planner.CostPlanner
+            :param *args: Extra arguments the lookups will be made with, as passed to execute_plan
+        """
+        with profiler.stage('query.cost_plan'):
+            chosen, steps = planner.choose(plan, self.estimate_lookups(plan, *args), self.corpus_size())
+        profiler.count('lookups skipped by planner', len(plan) - len(chosen))
+        return chosen, steps
+
+    def raw_query(self, query, *args, planner=None, budget=None):
+        """
+        Perform a query without grading results.
+        Returns a dictionary from grader name to a new GraderAccumulator holding this query's matches
+            :param self:
+            :param query: Query represented by a Music21 stream
+            :param *args: Extra arguments passed on to index lookup methods
+            :param planner=None: Planner choosing which stems to look up; every stem is looked up if None
+            :param budget=None: QueryBudget limiting the rows fetched and the time spent; unlimited if None
+        """
+        plan = self.plan_query(query)
+        if planner is not None:
+            plan, _ = self.choose_lookups(plan, planner, *args)
+        return self.accumulate(self.execute_plan(plan, *args, budget=budget), plan.offsets)
+
+    def execute_plan(self, plan, *args, piece_ids=None, budget=None):
+        """
+        Look up every stem in a query plan.
+        Yields (QueryStem, multiplicity, LookupResult) tuples in plan order
+            :param self:
+            :param plan: Counter from QueryStem to multiplicity, as returned by plan_query
+            :param *args: Extra arguments passed on to index lookup methods
+            :param piece_ids=None: Collection of piece ids to keep matches of; defaults to every piece
+            :param budget=None: QueryBudget limiting the rows kept and the time spent; unlimited if None
+        """
+        for query_stem, multiplicity in plan.items():
+            if budget is not None and budget.exhausted():
+                yield query_stem, multiplicity, LookupResult()
+                continue
+            lookup_results = self.indexes[query_stem.stemmer].lookup_stem(query_stem.stem, query_stem.length, *args)
+            if piece_ids is not None:
+                lookup_results = lookup_results.in_pieces(set(piece_ids))
+            if budget is not None:
+                lookup_results = lookup_results.head(budget.take(len(lookup_results), query_stem))
+            yield query_stem, multiplicity, lookup_results
+
+    async def aexecute_plan(self, plan, *args, executor=None):
+        """
+        Look up every stem in a query plan without blocking the running event loop.
+        Returns a list of (QueryStem, multiplicity, LookupResult) tuples in plan order
+            :param self:
+            :param plan: Counter from QueryStem to multiplicity, as returned by plan_query
+            :param *args: Extra arguments passed on to index lookup methods
+            :param executor=None: Executor to run lookups in; defaults to the event loop's default executor
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, lambda: list(self.execute_plan(plan, *args)))
+
+    def accumulate(self, lookups, query_offsets=None, graders=None):
+        """
+        Aggregate lookup results into a new accumulator for each grader
+            :param self:
+            :param lookups: Iterable of (QueryStem, multiplicity, LookupResult) tuples
+            :param query_offsets=None: Dictionary from QueryStem to its note offsets in the query, as in QueryPlan.offsets
+            :param graders=None: Dictionary of graders to accumulate for; defaults to the system's graders
+        """
+        query_offsets = query_offsets or {}
+        graders = self.grader_methods if graders is None else graders
+        accumulators = {grader_name: grader.accumulator() for grader_name, grader in graders.items()}
+        stage_names = {grader_name: 'grader.aggregate:%s' % grader_name for grader_name in accumulators}
+        for query_stem, multiplicity, lookup_results in lookups:
+            matches = GraderLookup(stemmer=query_stem.stemmer, lookup=lookup_results, query_offsets=tuple(query_offsets.get(query_stem, ())))
+            for grader_name, accumulator in accumulators.items():
+                with profiler.stage(stage_names[grader_name]):
+                    accumulator.aggregate(matches, multiplicity)
+        return accumulators
+
+    def grade(self, accumulators, corpus_size=None, topk=None):
+        """
+        Grade the accumulators of a single query
+            :param self:
+            :param accumulators: Dictionary from grader name to GraderAccumulator
+            :param corpus_size=None: Number of pieces in the corpus; looked up if not given
+            :param topk=None: Number of best graded pieces to keep per grader, best first; every piece if None
+        """
+        corpus_size = corpus_size or self.corpus_size()
+        grades = {}
+        for grader_name, accumulator in accumulators.items():
+            with profiler.stage('grader.grade:%s' % grader_name):
+                grades[grader_name] = accumulator.grade(corpus_size, topk)
+        return grades
+
+    def query(self, query, *args, planner=None, max_rows_per_stem=None, max_rows=None, deadline=None, topk=None):
+        """
+        Perform a query, aggregate, and rank results.
+        Returns QueryResults, flagged as truncated if a limit cut lookups short
             :param self:
             :param query: Query represented by Music21 stream
             :param *args: Additional args passed on to raw_query, then to individual index queries
+            :param planner=None: Planner choosing which stems to look up; every stem is looked up if None
+            :param max_rows_per_stem=None: Largest number of matches fetched by a single lookup; unlimited if None
+            :param max_rows=None: Largest number of matches fetched by the whole query; unlimited if None
+            :param deadline=None: Seconds after which no more matches are fetched, and the matches so far are graded
+            :param topk=None: Number of best graded pieces to keep per grader, best first; every piece if None
+        """
+        with profiler.stage('query'):
+            budget = None
+            if max_rows_per_stem is not None or max_rows is not None or deadline is not None:
+                budget = QueryBudget(max_rows_per_stem, max_rows, deadline)
+            results = QueryResults(self.grade(self.raw_query(query, *args, planner=planner, budget=budget), topk=topk))
+            if budget is not None and budget.truncated:
+                results.truncated = True
+                profiler.count('queries truncated')
+            return results
+
+    def explain_query(self, query, *args, planner, budget=None):
+        """
+        Perform a query with a planner, recording the rows each chosen lookup actually fetched.
+        Returns the grades, as returned by query, and the list of PlanStep describing every stem of the query
+            :param self:
+            :param query: Query represented by Music21 stream or tiny notation string
+            :param *args: Additional args passed on to individual index queries
+            :param planner: Planner choosing which stems to look up
+            :param budget=None: QueryBudget limiting the rows fetched and the time spent; unlimited if None
+        """
+        with profiler.stage('query'):
+            plan, steps = self.choose_lookups(self.plan_query(query), planner, *args)
+            lookups = list(self.execute_plan(plan, *args, budget=budget))
+            actual_rows = {query_stem: len(lookup_results) for query_stem, _, lookup_results in lookups}
+            steps = [step._replace(actual_rows=actual_rows.get(step.query_stem)) for step in steps]
+            results = QueryResults(self.grade(self.accumulate(lookups, plan.offsets)))
+            results.truncated = budget is not None and budget.truncated
+            return results, steps
+
+    def two_stage_query(self, query, *args, reranker, candidates=DEFAULT_CANDIDATES, stage_one_stemmers=None, stage_one_grader=None):
+        """
+        Perform a query in two stages. Stage one looks up the stems of a subset of cheap, selective stemmers
+        and grades them to choose candidate pieces. Stage two looks up the remaining stems in the candidates
+        only, then grades the candidates with a reranker that sees every stemmer's matches, such as AlignmentGrader.
+        Returns a dictionary from 'Reranked' to the candidates' GraderResults, each with its stage one grade
+        in meta['stage_one']
+            :param self:
+            :param query: Query represented by Music21 stream or tiny notation string
+            :param *args: Additional args passed on to individual index queries
+            :param reranker: Grader ranking the candidates
+            :param candidates=DEFAULT_CANDIDATES: Number of pieces kept by stage one
+            :param stage_one_stemmers=None: Names of the stemmers looked up by stage one; defaults to every stemmer
+            :param stage_one_grader=None: Name of the grader choosing candidates; defaults to the first grader
+        """
+        with profiler.stage('query'):
+            plan = self.plan_query(query)
+            stage_one_stemmers = set(stage_one_stemmers or self.indexes)
+            stage_one_grader = stage_one_grader or next(iter(self.grader_methods))
+            with profiler.stage('query.stage_one'):
+                stage_one_lookups = list(self.execute_plan(plan.subset(lambda query_stem: query_stem.stemmer in stage_one_stemmers), *args))
+                accumulators = self.accumulate(stage_one_lookups, plan.offsets, {stage_one_grader: self.grader_methods[stage_one_grader]})
+                stage_one_grades = {
+                    result.piece: result.grade
+                    for result in self.grade(accumulators, topk=candidates)[stage_one_grader]
+                }
+            profiler.count('candidates', len(stage_one_grades))
+            with profiler.stage('query.stage_two'):
+                candidate_ids = set(stage_one_grades)
+                lookups = [
+                    (query_stem, multiplicity, lookup_results.in_pieces(candidate_ids))
+                    for query_stem, multiplicity, lookup_results in stage_one_lookups
+                ]
+                if candidate_ids:
+                    lookups.extend(self.execute_plan(plan.subset(lambda query_stem: query_stem.stemmer not in stage_one_stemmers), *args, piece_ids=candidate_ids))
+                accumulators = self.accumulate(lookups, plan.offsets, {'Reranked': reranker})
+                results = self.grade(accumulators)['Reranked']
+            return {'Reranked': [
+                GraderResult(piece=result.piece, grade=result.grade, meta=dict(result.meta, stage_one=stage_one_grades[result.piece]))
+                for result in results
+            ]}
+
+    def batch_query(self, queries, *args, chunk_size=None, topk=None):
         """
+        Perform many queries, looking up each distinct stem only once per chunk of queries.
+        Yields a BatchQueryResult for each query, in order. A query that fails yields its
+        exception rather than ending the batch.
+        Grades are identical to those returned by query.
+            :param self:
+            :param queries: Iterable of queries represented by Music21 streams or tiny notation strings
+            :param *args: Additional args passed on to individual index queries
+            :param chunk_size=None: Number of queries sharing lookup results; lookups are held in memory
+                until the chunk finishes. Defaults to the whole batch
+            :param topk=None: Number of best graded pieces to keep per grader, best first; every piece if None
+        """
+        queries = iter(queries)
         corpus_size = self.corpus_size()
-        self.raw_query(query, *args)
-        grades_by_grader = {grader_name: grader.grade(corpus_size) for grader_name, grader in self.grader_methods.items()}
-        return grades_by_grader
+        while True:
+            chunk = list(islice(queries, chunk_size)) if chunk_size else list(queries)
+            if not chunk:
+                return
+            lookup_cache = {}
+            for query in chunk:
+                stats = {}
+                try:
+                    start = time.perf_counter()
+                    plan = self.plan_query(query)
+                    stats['plan_sec'] = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    missing = Counter({query_stem: multiplicity for query_stem, multiplicity in plan.items() if query_stem not in lookup_cache})
+                    for query_stem, _, lookup_results in self.execute_plan(missing, *args):
+                        lookup_cache[query_stem] = lookup_results
+                    stats['lookup_sec'] = time.perf_counter() - start
+                    stats['lookups'] = len(missing)
+                    stats['cached_lookups'] = len(plan) - len(missing)
+
+                    start = time.perf_counter()
+                    accumulators = self.accumulate(((query_stem, multiplicity, lookup_cache[query_stem]) for query_stem, multiplicity in plan.items()), plan.offsets)
+                    grades = self.grade(accumulators, corpus_size, topk)
+                    stats['grade_sec'] = time.perf_counter() - start
+                    yield BatchQueryResult(grades, stats, None)
+                except Exception as e:
+                    yield BatchQueryResult(None, stats, e)
+            if not chunk_size:
+                return
+
+    async def aquery(self, query, *args, deadline=None, executor=None):
+        """
+        Perform a query, aggregate, and rank results without blocking the running event loop.
+        Parsing, stemming and grading run in an executor and lookups run through aexecute_plan.
+        Cancelling the awaiting task cancels any lookups still in progress.
+            :param self:
+            :param query: Query represented by Music21 stream or tiny notation string
+            :param *args: Additional args passed on to individual index queries
+            :param deadline=None: Seconds the query may take before raising asyncio.TimeoutError
+            :param executor=None: Executor for parsing, stemming and grading; defaults to the event loop's default executor
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        async def run_query():
+            plan = await loop.run_in_executor(executor, self.plan_query, query)
+            lookups = await self.aexecute_plan(plan, *args)
+            return await loop.run_in_executor(executor, lambda: self.grade(self.accumulate(lookups, plan.offsets)))
+        return await asyncio.wait_for(run_query(), deadline)
 
 class Snippet:
     """
@@ -205,20 +696,35 @@ class FirmIndex(metaclass=ABCMeta):
     A single stemming method
         :param metaclass=ABCMeta: Abscract MetaClass
     """
-    def __init__(self, snippets, keyfn, name=""):
+    def __init__(self, snippets, keyfn, name="", snippet_lengths=None):
         """
         Constructor
             :param self:
             :param snippets: List of snippets to add to index
             :param keyfn: Stemming method
             :param name="": Name of the stemming method
+            :param snippet_lengths=None: Snippet lengths indexed by this method; defaults to DEFAULT_SNIPPET_LENGTH
         """
         self.index = defaultdict(set)
         self.keyfn = keyfn
         self.name = name
+        self.snippet_lengths = sorted(set(snippet_lengths or [DEFAULT_SNIPPET_LENGTH]))
+        # Profiler stage covering this method's stemming
+        self.stem_stage = 'stem:%s' % name
         for snippet in snippets:
             self.add_snippet(snippet)
 
+    def query_length(self, number_of_notes):
+        """
+        Choose the snippet length to query with. Longer snippets are more selective, so
+        the longest indexed length that fits within the query is used.
+        Returns None if the query is shorter than every indexed length.
+            :param self:
+            :param number_of_notes: Number of notes and rests in the query
+        """
+        fitting = [length for length in self.snippet_lengths if length <= number_of_notes]
+        return fitting[-1] if fitting else None
+
     @abstractmethod
     def add_snippet(self, snippet, *args):
         """
@@ -232,44 +738,64 @@ class FirmIndex(metaclass=ABCMeta):
     @abstractmethod
     def lookup(self, snippet, *args):
         """
-        Look up a single snippet and return a list of LookupMatch tuples
+        Look up a single snippet and return a LookupResult
             :param self:
             :param snippet: Snippet to lookup
             :param *args: Arbitrary extra args
         """
         pass
 
+    @abstractmethod
+    def lookup_stem(self, stem, snippet_length, *args):
+        """
+        Look up a single stem produced by this index's stemming method and return a LookupResult
+            :param self:
+            :param stem: Stem to lookup
+            :param snippet_length: Length of the snippet the stem was produced from
+            :param *args: Arbitrary extra args
+        """
+        pass
+
 class Grader(metaclass=ABCMeta):
     """
-    An implementation of a LookupMatch aggregation, grading, and ranking method.
-    This is a *stateful* object, allowing results to be incrementally collected
-    before aggregation.
+    An implementation of a LookupResult aggregation, grading, and ranking method.
+    A grader holds only configuration and is never modified by a query, so a single
+    instance can be shared by concurrent queries. Each query aggregates its results
+    in a separate GraderAccumulator.
         :param metaclass=ABCMeta: Abstract MetaClass
     """
-    def __init__(self):
-        self.zero()
-
     @abstractmethod
-    def zero(self):
+    def accumulator(self):
         """
-        Reset the grader's aggregator
+        Create a new, empty GraderAccumulator for a single query
+            :param self:
         """
         pass
 
+class GraderAccumulator(metaclass=ABCMeta):
+    """
+    The state of a single query for one grader.
+    This is a *stateful* object, allowing results to be incrementally collected
+    before grading.
+        :param metaclass=ABCMeta: Abstract MetaClass
+    """
     @abstractmethod
-    def grade(self, number_of_pieces):
+    def grade(self, number_of_pieces, topk=None):
         """
         Compute grades for the pieces currently stored
             :param self:
             :param number_of_pieces: The total number of pieces in the corpus
+            :param topk=None: Number of best graded pieces to return, best first, as top_results; every piece if None
         """
         pass
 
     @abstractmethod
-    def aggregate(self, matches):
+    def aggregate(self, matches, multiplicity=1):
         """
-        Add a set of results to the grader's aggregator
+        Add the results of one lookup to the accumulator
             :param self:
-            :param matches: List of LookupMatch tuples to add to the aggregator
+            :param matches: GraderLookup holding the LookupResult of one stem
+            :param multiplicity=1: Number of times the matches occurred; a stem repeated
+                within a query is looked up once and aggregated with its repeat count
         """
         pass
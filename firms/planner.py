@@ -0,0 +1,105 @@
+"""
+Cost-based choice of the stem lookups a query makes.
+
+Every distinct stem of a query is one lookup, whose cost grows with the number of posting rows it fetches.
+Stems with long postings, typical of the contour and rhythm stemmers, are slow to fetch and say little about
+which piece matches. The planner estimates each lookup's rows from the index, then orders lookups by value per
+unit of cost and skips those that don't fit a budget of rows or seconds.
+"""
+
+from collections import namedtuple
+from math import log
+
+from firms.models import QueryPlan
+
+# Seconds per lookup, and per posting row fetched, measured on a synthetic index of 300 pieces
+LOOKUP_SECONDS = 13e-6
+ROW_SECONDS = 2.2e-6
+
+# A lookup considered by the planner, its estimated rows, cost in seconds and value, whether it was chosen,
+# and the rows it actually fetched (None until it has run)
+PlanStep = namedtuple('PlanStep', [
+    'query_stem', 'multiplicity', 'estimated_rows', 'cost', 'value', 'chosen', 'actual_rows'
+], defaults=[None])
+
+def lookup_value(estimated_rows, multiplicity, number_of_pieces, weight=1):
+    """
+    Value of a lookup: the inverse document frequency of the stem, were each posting row in a different piece,
+    counted once for each time the stem occurs in the query. Stems with no rows are worthless
+        :param estimated_rows: Estimated number of posting rows
+        :param multiplicity: Number of times the stem occurs in the query
+        :param number_of_pieces: Number of pieces in the corpus
+        :param weight=1: Weight of the stemmer
+    """
+    if not estimated_rows:
+        return 0.0
+    document_frequency = min(estimated_rows, number_of_pieces)
+    return weight * multiplicity * log(1 + number_of_pieces / document_frequency)
+
+class CostPlanner:
+    """
+    Chooses which lookups of a query plan to make, and in which order. Holds only configuration,
+    so one planner can be shared by concurrent queries
+    """
+    def __init__(self, max_rows=None, max_seconds=None, weights=None, lookup_seconds=LOOKUP_SECONDS, row_seconds=ROW_SECONDS):
+        """
+        Constructor
+            :param self:
+            :param max_rows=None: Largest number of estimated rows a query may fetch; unlimited if None
+            :param max_seconds=None: Largest estimated seconds a query may spend on lookups; unlimited if None
+            :param weights=None: Dictionary from stemmer name to the weight of its lookups' value; 1 for stemmers not given
+            :param lookup_seconds=LOOKUP_SECONDS: Estimated seconds per lookup
+            :param row_seconds=ROW_SECONDS: Estimated seconds per posting row
+        """
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.weights = dict(weights or {})
+        self.lookup_seconds = lookup_seconds
+        self.row_seconds = row_seconds
+
+    def cost(self, estimated_rows):
+        return self.lookup_seconds + self.row_seconds * estimated_rows
+
+    def choose(self, plan, estimates, number_of_pieces):
+        """
+        Choose lookups greedily by value per second until the budget is spent. Lookups estimated to fetch no rows
+        are skipped, since they can't match; without a budget every other lookup is made, most valuable first.
+        Returns a QueryPlan of the chosen stems in order, and a list of PlanStep for every stem of the plan
+            :param self:
+            :param plan: QueryPlan to choose from
+            :param estimates: Dictionary from QueryStem to estimated rows; stems not given are assumed to fit
+            :param number_of_pieces: Number of pieces in the corpus
+        """
+        number_of_pieces = max(1, number_of_pieces)
+        steps = []
+        for query_stem, multiplicity in plan.items():
+            estimated_rows = estimates.get(query_stem)
+            if estimated_rows is None:
+                # No estimate; assume the stem is as rare as it can be
+                value = lookup_value(1, multiplicity, number_of_pieces, self.weights.get(query_stem.stemmer, 1))
+                cost = self.cost(0)
+            else:
+                value = lookup_value(estimated_rows, multiplicity, number_of_pieces, self.weights.get(query_stem.stemmer, 1))
+                cost = self.cost(estimated_rows)
+            steps.append(PlanStep(query_stem, multiplicity, estimated_rows, cost, value, False))
+        steps.sort(key=lambda step: step.value / step.cost, reverse=True)
+        budgeted = self.max_rows is not None or self.max_seconds is not None
+        rows = 0
+        seconds = 0.0
+        for position, step in enumerate(steps):
+            if step.estimated_rows == 0 or (budgeted and step.value <= 0):
+                continue
+            step_rows = step.estimated_rows or 0
+            if self.max_rows is not None and rows + step_rows > self.max_rows:
+                continue
+            if self.max_seconds is not None and seconds + step.cost > self.max_seconds:
+                continue
+            rows = rows + step_rows
+            seconds = seconds + step.cost
+            steps[position] = step._replace(chosen=True)
+        chosen = QueryPlan()
+        for step in steps:
+            if step.chosen:
+                chosen[step.query_stem] = step.multiplicity
+                chosen.offsets[step.query_stem] = plan.offsets.get(step.query_stem, [])
+        return chosen, steps
@@ -0,0 +1,151 @@
+"""
+Lightweight instrumentation for finding where indexing and query time goes.
+
+Code is instrumented with the shared `profiler`:
+
+    with profiler.stage('sql.lookup'):
+        ...
+    profiler.count('rows fetched', len(rows))
+
+While the profiler is disabled, `stage` returns a shared no-op context manager and `count` returns
+immediately, so instrumented code pays little more than a method call. Once enabled, the profiler
+records the call count and inclusive wall time of each stage and the total of each counter, across
+all threads of the process. Stages may nest; a stage's time includes the stages inside it.
+"""
+
+import cProfile
+from collections import Counter
+import json
+import threading
+import time
+
+class NullStage:
+    """
+    Context manager that does nothing, used for every stage while profiling is disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_STAGE = NullStage()
+
+class Stage:
+    """
+    Context manager timing a single run of a named stage
+    """
+    __slots__ = ['profiler', 'name', 'start']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+class Profiler:
+    """
+    Collects per-stage wall time and call counts, and named counters such as rows fetched
+    """
+    def __init__(self):
+        """
+        Constructor
+            :param self:
+        """
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = Counter()
+        self.cprofile = None
+
+    def stage(self, name):
+        """
+        Context manager timing the enclosed block as a run of the named stage
+            :param self:
+            :param name: Stage name, e.g. `sql.lookup`
+        """
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def count(self, name, amount=1):
+        """
+        Add to a named counter
+            :param self:
+            :param name: Counter name, e.g. `rows fetched`
+            :param amount=1: Amount to add
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += amount
+
+    def record(self, name, seconds):
+        with self.lock:
+            calls_and_seconds = self.stages.setdefault(name, [0, 0.0])
+            calls_and_seconds[0] += 1
+            calls_and_seconds[1] += seconds
+
+    def enable(self, cprofile=False):
+        """
+        Start recording, discarding anything recorded before
+            :param self:
+            :param cprofile=False: Also run the cProfile profiler until disabled
+        """
+        self.reset()
+        self.enabled = True
+        if cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def disable(self, cprofile_path=None):
+        """
+        Stop recording. Recorded stages and counters are kept until the profiler is enabled again
+            :param self:
+            :param cprofile_path=None: Path to dump cProfile statistics to, readable by pstats
+        """
+        self.enabled = False
+        if self.cprofile:
+            self.cprofile.disable()
+            if cprofile_path:
+                self.cprofile.dump_stats(cprofile_path)
+            self.cprofile = None
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = Counter()
+
+    def report(self):
+        """
+        Return the recorded stages, slowest first, and counters as a JSON serializable dictionary
+            :param self:
+        """
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda stage: stage[1][1], reverse=True)
+            return {
+                'stages': {
+                    name: {'calls': calls, 'seconds': seconds, 'mean_ms': 1000 * seconds / calls}
+                    for name, (calls, seconds) in stages
+                },
+                'counters': dict(self.counters)
+            }
+
+    def write_report(self, path):
+        """
+        Write the report as JSON
+            :param self:
+            :param path: Path to write to
+        """
+        with open(path, 'w') as outf:
+            json.dump(self.report(), outf, indent=2)
+
+# The profiler shared by all instrumented code
+profiler = Profiler()
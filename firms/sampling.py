@@ -0,0 +1,289 @@
+"""
+Compact note sequences stored alongside the index, and functions for sampling evaluation
+queries from them without reading or parsing the original score files.
+
+A part is stored as a string of space separated tokens, one per note or rest, of the form
+`measure|pitches|quarterLength`. Pitches are `r` for a rest, `u` for an unpitched note, or
+one or more pitch names with octave joined by `.` for notes and chords, e.g. `3|C#4|0.5` or
+`3|C4.E4.G4|1/3`.
+"""
+
+from array import array
+from collections import namedtuple
+from fractions import Fraction
+
+REST = 'r'
+UNPITCHED = 'u'
+
+note_names = list('CDEFGAB')
+accidentals = ['', '#', '-']
+octaves = list(range(1, 7))
+quarter_lengths = [4.0, 2.0, 1.0, 0.25, 0.125]
+# Relative weights of add, remove, replace and transposition errors
+DEFAULT_ERROR_RATES = (0.25, 0.25, 0.25, 0.25)
+
+# Semitones above C for each pitch step and accidental
+step_semitones = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+accidental_semitones = {'#': 1, '-': -1, '~': 0, '`': 0}
+sharp_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+# A part sampled from the index, and where it came from
+PartSample = namedtuple('PartSample', ['piece_name', 'part_name', 'measure', 'piece_path', 'piece_id'])
+
+def encode_quarter_length(quarter_length):
+    """
+    Encode a quarter length, keeping fractional lengths (e.g. triplets) exact
+        :param quarter_length: float or Fraction quarter length
+    """
+    if isinstance(quarter_length, Fraction):
+        return '%s/%s' % (quarter_length.numerator, quarter_length.denominator)
+    return repr(float(quarter_length))
+
+def decode_quarter_length(text):
+    """
+    Decode a quarter length produced by encode_quarter_length, restoring its original type
+        :param text: Encoded quarter length
+    """
+    return Fraction(text) if '/' in text else float(text)
+
+def encode_pitches(general_note):
+    """
+    Encode the pitch content of a music21 note, chord or rest
+        :param general_note: music21 GeneralNote
+    """
+    if general_note.isRest:
+        return REST
+    if general_note.isNote:
+        return general_note.pitch.nameWithOctave
+    if general_note.isChord and general_note.pitches:
+        return '.'.join(pitch.nameWithOctave for pitch in general_note.pitches)
+    return UNPITCHED
+
+def encode_notes(notes):
+    """
+    Encode a flat sequence of music21 notes and rests as a compact string
+        :param notes: Sequence of music21 GeneralNote objects
+    """
+    return ' '.join(
+        '%s|%s|%s' % (general_note.measureNumber or 0, encode_pitches(general_note), encode_quarter_length(general_note.duration.quarterLength))
+        for general_note in notes
+    )
+
+def decode_notes(text):
+    """
+    Decode a string produced by encode_notes into a NoteSequence
+        :param text: Encoded notes
+    """
+    tokens = [token.split('|') for token in text.split(' ')] if text else []
+    return NoteSequence(
+        array('l', [int(measure) for measure, pitches, quarter_length in tokens]),
+        [pitches for measure, pitches, quarter_length in tokens],
+        [decode_quarter_length(quarter_length) for measure, pitches, quarter_length in tokens]
+    )
+
+def pitch_to_semitones(name):
+    """
+    Convert a pitch name with octave, e.g. `C#4`, to a number of semitones above C0
+        :param name: Pitch name with octave
+    """
+    step = name[0]
+    octave_start = len(name.rstrip('0123456789'))
+    octave = int(name[octave_start:]) if octave_start < len(name) else 4
+    alteration = sum(accidental_semitones.get(accidental, 0) for accidental in name[1:octave_start])
+    return 12 * octave + step_semitones[step] + alteration
+
+def semitones_to_pitch(semitones):
+    """
+    Convert a number of semitones above C0 to a pitch name with octave, spelled with sharps
+        :param semitones: Semitones above C0
+    """
+    return '%s%s' % (sharp_names[semitones % 12], semitones // 12)
+
+class NoteSequence:
+    """
+    A flat sequence of notes and rests held as parallel arrays of measure numbers, encoded
+    pitches and quarter lengths. Cheap to slice and modify; converted to music21 only when queried.
+    """
+    def __init__(self, measures, pitches, quarter_lengths):
+        """
+        Constructor
+            :param self:
+            :param measures: array of measure numbers, one per note
+            :param pitches: List of encoded pitches, one per note
+            :param quarter_lengths: List of quarter lengths, one per note
+        """
+        self.measures = measures
+        self.pitches = pitches
+        self.quarter_lengths = quarter_lengths
+
+    def __len__(self):
+        return len(self.pitches)
+
+    def number_of_measures(self):
+        """
+        Returns the highest measure number in the sequence
+            :param self:
+        """
+        return max(self.measures) if self.measures else 0
+
+    def slice_measures(self, start, end):
+        """
+        Returns a new NoteSequence with the notes from measures start through end, inclusive
+            :param self:
+            :param start: First measure number
+            :param end: Last measure number
+        """
+        indexes = [idx for idx, measure in enumerate(self.measures) if start <= measure <= end]
+        if not indexes:
+            return NoteSequence(array('l'), [], [])
+        first, last = indexes[0], indexes[-1] + 1
+        return NoteSequence(self.measures[first:last], self.pitches[first:last], self.quarter_lengths[first:last])
+
+    def copy(self):
+        return NoteSequence(array('l', self.measures), list(self.pitches), list(self.quarter_lengths))
+
+    def encode(self):
+        """
+        Encode the sequence in the format produced by encode_notes
+            :param self:
+        """
+        return ' '.join(
+            '%s|%s|%s' % (measure, pitches, encode_quarter_length(quarter_length))
+            for measure, pitches, quarter_length in zip(self.measures, self.pitches, self.quarter_lengths)
+        )
+
+    def to_notes(self):
+        """
+        Build a list of music21 notes, chords and rests, outside of any stream
+            :param self:
+        """
+        from music21 import chord, note
+        notes = []
+        for pitches, quarter_length in zip(self.pitches, self.quarter_lengths):
+            if pitches == REST:
+                notes.append(note.Rest(quarterLength=quarter_length))
+            elif pitches == UNPITCHED:
+                notes.append(note.Unpitched(quarterLength=quarter_length))
+            elif '.' in pitches:
+                notes.append(chord.Chord(pitches.split('.'), quarterLength=quarter_length))
+            else:
+                notes.append(note.Note(pitches, quarterLength=quarter_length))
+        return notes
+
+    def to_stream(self):
+        """
+        Build a music21 stream of the notes in this sequence
+            :param self:
+        """
+        from music21 import stream
+        result = stream.Stream()
+        for general_note in self.to_notes():
+            result.append(general_note)
+        return result
+
+def new_random_pitches_and_length(rng):
+    """
+    Draw a random encoded note or rest and quarter length
+        :param rng: random.Random instance
+    """
+    quarter_length = rng.choice(quarter_lengths)
+    if rng.random() < .5:
+        return '%s%s%s' % (rng.choice(note_names), rng.choice(accidentals), rng.choice(octaves)), quarter_length
+    return REST, quarter_length
+
+def add_note_error(sequence, rng):
+    result = sequence.copy()
+    idx = rng.randint(0, len(result))
+    pitches, quarter_length = new_random_pitches_and_length(rng)
+    result.measures.insert(idx, result.measures[min(idx, len(result) - 1)] if len(result) else 0)
+    result.pitches.insert(idx, pitches)
+    result.quarter_lengths.insert(idx, quarter_length)
+    return result
+
+def remove_note_error(sequence, rng):
+    result = sequence.copy()
+    if len(result):
+        idx = rng.randrange(len(result))
+        del result.measures[idx]
+        del result.pitches[idx]
+        del result.quarter_lengths[idx]
+    return result
+
+def replace_note_error(sequence, rng):
+    result = sequence.copy()
+    if len(result):
+        idx = rng.randrange(len(result))
+        result.pitches[idx], result.quarter_lengths[idx] = new_random_pitches_and_length(rng)
+    return result
+
+def transposition_error(sequence, rng):
+    result = sequence.copy()
+    semitones = rng.randint(-5, 5)
+    result.pitches = [
+        pitches if pitches in (REST, UNPITCHED) else
+        '.'.join(semitones_to_pitch(pitch_to_semitones(pitch) + semitones) for pitch in pitches.split('.'))
+        for pitches in result.pitches
+    ]
+    return result
+
+# Error functions in the same order as command_line.build_error_types
+error_functions = [add_note_error, remove_note_error, replace_note_error, transposition_error]
+
+def introduce_error(sequence, erate, error_rates, rng):
+    """
+    With probability erate, introduce one error chosen using the relative weights in error_rates
+        :param sequence: NoteSequence to modify
+        :param erate: Rate at which to introduce an error
+        :param error_rates: Relative weights of add, remove, replace and transposition errors
+        :param rng: random.Random instance
+    """
+    if rng.random() > erate:
+        return sequence
+    cumulative_error_type = 0
+    error_type_sample = rng.random()
+    for error_rate, error_function in zip(error_rates, error_functions):
+        cumulative_error_type = cumulative_error_type + error_rate
+        if error_type_sample <= cumulative_error_type:
+            return error_function(sequence, rng)
+    return sequence
+
+class IndexSampler:
+    """
+    Draws evaluation queries from the note sequences stored in a SqlIRSystem.
+    Decoded parts are cached, so repeated samples from the same part don't touch the database.
+    """
+    def __init__(self, sql_ir_system):
+        """
+        Constructor
+            :param self:
+            :param sql_ir_system: SqlIRSystem with stored part notes
+        """
+        self.sql_ir_system = sql_ir_system
+        self.parts_by_piece = sql_ir_system.parts_with_notes()
+        self.pieces = list(self.parts_by_piece.keys())
+        self.sequences = {}
+
+    def part_notes(self, part_id):
+        if part_id not in self.sequences:
+            self.sequences[part_id] = decode_notes(self.sql_ir_system.part_notes(part_id))
+        return self.sequences[part_id]
+
+    def sample(self, piece, rng, minsize, maxsize, erate=0.0, error_rates=DEFAULT_ERROR_RATES):
+        """
+        Sample a query from a random part of a piece, mirroring the measure based sampling of `firms evaluate`.
+        Returns a PartSample and the sampled NoteSequence
+            :param self:
+            :param piece: (name, path, id) piece row
+            :param rng: random.Random instance
+            :param minsize: Minimum sample size (in measures)
+            :param maxsize: Maximum sample size (in measures)
+            :param erate=0.0: Rate at which to introduce errors
+            :param error_rates: Relative weights of add, remove, replace and transposition errors
+        """
+        piece_name, piece_path, piece_id = piece
+        part_id, part_name = rng.choice(self.parts_by_piece[piece])
+        sequence = self.part_notes(part_id)
+        sample_size = rng.randint(minsize, maxsize)
+        idx = rng.randint(0, max(0, sequence.number_of_measures() - sample_size))
+        sample = introduce_error(sequence.slice_measures(idx, idx + sample_size), erate, error_rates, rng)
+        return PartSample(piece_name, part_name, idx, piece_path, piece_id), sample
@@ -0,0 +1,334 @@
+"""
+A FIRMS index partitioned across several Sqlite3 files.
+
+A sharded index is a directory of shard files, each a complete SqlIRSystem database. Every piece is
+stored in exactly one shard, chosen by a stable hash of its path. Queries look up each stem in every
+shard concurrently and merge the matches before aggregation, so graders see the same matches as they
+would from a single file: BM25 document frequencies and the corpus size are counted across all shards.
+
+Ids stored in a shard are only unique within it. Piece, part, snippet and stem ids returned by a
+ShardedIRSystem are global ids, `local id * number of shards + shard number`.
+"""
+
+import os
+import threading
+import traceback
+import zlib
+
+from firms.models import IRSystem, LookupResult
+from firms.profiling import profiler
+from firms.sql_irsystems import SqlIRSystem
+
+SHARD_FILE_FORMAT = 'shard%03d.sqlite.db'
+
+def shard_paths(dirpath):
+    """
+    List the shard files of a sharded index, in shard order
+        :param dirpath: Directory holding the shards
+    """
+    return sorted(
+        os.path.join(dirpath, filename) for filename in os.listdir(dirpath)
+        if filename.startswith('shard') and filename.endswith('.sqlite.db')
+    )
+
+def shard_for_path(piece_path, number_of_shards):
+    """
+    Choose the shard storing a piece. Stable across processes and runs, unlike hash()
+        :param piece_path: Path identifying the piece
+        :param number_of_shards: Number of shards
+    """
+    return zlib.crc32(str(piece_path).encode('utf-8')) % number_of_shards
+
+def parse_scores(piece_path):
+    """
+    Parse a score file, yielding every score it contains
+        :param piece_path: Path to a score file
+    """
+    from music21 import converter
+    from music21 import stream as m21stream
+    with profiler.stage('parse'):
+        parsed = converter.parse(piece_path)
+    yield from parsed.recurse(classFilter=m21stream.Score, skipSelf=False)
+
+def ingest_shard(dbpath, index_methods, snippet_lengths, piece_paths, explicit_repeats=False, replace=False):
+    """
+    Add score files to one shard. Run in a worker process, one per shard, so shards are written in parallel.
+    Returns the number of files added and a list of (path, error) for files that failed
+        :param dbpath: Path to the shard file
+        :param index_methods: Dictionary of stemmers
+        :param snippet_lengths: Dictionary from stemmer name to list of snippet lengths
+        :param piece_paths: List of score file paths belonging to the shard
+        :param explicit_repeats=False: Expand repeats before indexing
+        :param replace=False: Delete pieces previously added from each path first
+    """
+    shard = SqlIRSystem(dbpath, index_methods, {}, [], False, snippet_lengths)
+    added = 0
+    failures = []
+    for piece_path in piece_paths:
+        try:
+            shard.add_scores(list(parse_scores(piece_path)), piece_path, explicit_repeats, replace)
+            added = added + 1
+        except Exception:
+            failures.append((piece_path, traceback.format_exc()))
+    return added, failures
+
+class ShardedIRSystem(IRSystem):
+    """
+    An IRSystem whose pieces are partitioned across several SqlIRSystem shards
+        :param IRSystem:
+    """
+    def __init__(self, dirpath, index_methods, graders=None, number_of_shards=None, snippet_lengths=None, query_workers=1):
+        """
+        Constructor
+            :param self:
+            :param dirpath: Directory holding the shard files; created if missing
+            :param index_methods: Dictionary of stemmers
+            :param graders=None: Dictionary of graders
+            :param number_of_shards=None: Number of shards to create; defaults to the shards already in dirpath
+            :param snippet_lengths=None: Dictionary from stemmer name to list of snippet lengths to index, as for SqlIRSystem
+            :param query_workers=1: Number of threads each shard uses to look up its stemmers concurrently
+        """
+        os.makedirs(dirpath, exist_ok=True)
+        self.dbpath = dirpath
+        existing = shard_paths(dirpath)
+        if number_of_shards and existing and len(existing) != number_of_shards:
+            raise ValueError("%s already has %s shards, not %s" % (dirpath, len(existing), number_of_shards))
+        if not number_of_shards and not existing:
+            raise ValueError("%s holds no shards" % dirpath)
+        paths = existing or [os.path.join(dirpath, SHARD_FILE_FORMAT % shard) for shard in range(number_of_shards)]
+        self.shards = [SqlIRSystem(path, index_methods, graders, [], False, snippet_lengths, query_workers) for path in paths]
+        self.number_of_shards = len(self.shards)
+        self.query_executor = None
+        self.query_executor_lock = threading.Lock()
+        super().__init__(index_methods, graders, [], False)
+
+    def make_empty_index(self, indexfn, name):
+        # Queries are planned once for all shards, using the first shard's snippet lengths
+        return self.shards[0].indexes[name]
+
+    def global_id(self, local_id, shard_number):
+        return local_id * self.number_of_shards + shard_number
+
+    def local_id(self, global_id):
+        """
+        Split a global id into (shard, id within the shard)
+            :param self:
+            :param global_id: Global id
+        """
+        local_id, shard_number = divmod(int(global_id), self.number_of_shards)
+        return self.shards[shard_number], local_id
+
+    def shard_for(self, piece_path):
+        return self.shards[shard_for_path(piece_path, self.number_of_shards)]
+
+    def add_piece(self, piece, piece_path, explicit_repeats=False):
+        self.shard_for(piece_path).add_piece(piece, piece_path, explicit_repeats)
+
+    def add_scores(self, scores, piece_path, explicit_repeats=False, replace=False):
+        self.shard_for(piece_path).add_scores(scores, piece_path, explicit_repeats, replace)
+
+    def add_parts(self, piece_path, piece_name, parts):
+        """
+        Add a piece from parts whose notes have already been extracted, as for SqlIRSystem.add_parts.
+        Returns the global id of the piece
+            :param self:
+            :param piece_path: Path identifying the piece
+            :param piece_name: Name of the piece
+            :param parts: List of (part name, list of music21 notes and rests, encoded notes) tuples
+        """
+        shard_number = shard_for_path(piece_path, self.number_of_shards)
+        return self.global_id(self.shards[shard_number].add_parts(piece_path, piece_name, parts), shard_number)
+
+    def piece_ids_by_path(self, piece_path):
+        shard_number = shard_for_path(piece_path, self.number_of_shards)
+        return [self.global_id(piece_id, shard_number) for piece_id in self.shards[shard_number].piece_ids_by_path(piece_path)]
+
+    def remove_pieces(self, piece_ids):
+        """
+        Delete pieces from the shards holding them, as for SqlIRSystem.remove_pieces.
+        Returns a dictionary with the number of rows deleted from each table, summed over shards
+            :param self:
+            :param piece_ids: Global ids of the pieces to delete
+        """
+        ids_by_shard = {}
+        for piece_id in piece_ids:
+            shard, local_id = self.local_id(piece_id)
+            ids_by_shard.setdefault(shard, []).append(local_id)
+        counts = {}
+        for shard, local_ids in ids_by_shard.items():
+            for table, count in shard.remove_pieces(local_ids).items():
+                counts[table] = counts.get(table, 0) + count
+        return counts
+
+    def remove_path(self, piece_path):
+        return self.shard_for(piece_path).remove_path(piece_path)
+
+    def replace_piece(self, piece, piece_path, explicit_repeats=False):
+        self.shard_for(piece_path).replace_piece(piece, piece_path, explicit_repeats)
+
+    def build_fuzzy_indexes(self, max_distance):
+        for shard in self.shards:
+            shard.build_fuzzy_indexes(max_distance)
+
+    def add_paths(self, piece_paths, explicit_repeats=False, replace=False):
+        """
+        Parse and add score files, running one writer process per shard.
+        Returns the number of files added and a list of (path, error) for files that failed
+            :param self:
+            :param piece_paths: List of score file paths
+            :param explicit_repeats=False: Expand repeats before indexing
+            :param replace=False: Delete pieces previously added from each path first
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        paths_by_shard = [[] for _ in self.shards]
+        for piece_path in piece_paths:
+            paths_by_shard[shard_for_path(piece_path, self.number_of_shards)].append(str(piece_path))
+        added = 0
+        failures = []
+        with ProcessPoolExecutor(self.number_of_shards) as executor:
+            futures = [
+                executor.submit(ingest_shard, shard.dbpath, self.index_methods, shard.snippet_lengths, paths, explicit_repeats, replace)
+                for shard, paths in zip(self.shards, paths_by_shard) if paths
+            ]
+            for future in futures:
+                shard_added, shard_failures = future.result()
+                added = added + shard_added
+                failures.extend(shard_failures)
+        return added, failures
+
+    def lookup_shard(self, shard_number, plan, *args, piece_ids=None, budget=None):
+        return shard_number, {query_stem: lookup_results for query_stem, _, lookup_results in self.shards[shard_number].execute_plan(plan, *args, piece_ids=piece_ids, budget=budget)}
+
+    def execute_plan(self, plan, *args, piece_ids=None, budget=None):
+        """
+        Look up every stem in a query plan in all shards concurrently, merging each stem's matches.
+        Yields (QueryStem, multiplicity, LookupResult) tuples in plan order, with global ids.
+        A stem's id is taken from the first shard that holds it, so each stem has one id across shards.
+        With global piece_ids, only the shards holding those pieces are looked up. A budget is shared by every shard,
+        which also share each stem's rows per stem, so a merged lookup keeps at most max_rows_per_stem rows.
+        """
+        # Dictionary from shard number to the local ids of pieces to look up there, or None for every piece
+        if piece_ids is None:
+            shard_piece_ids = {shard_number: None for shard_number in range(self.number_of_shards)}
+        else:
+            shard_piece_ids = {}
+            for piece_id in piece_ids:
+                local_id, shard_number = divmod(int(piece_id), self.number_of_shards)
+                shard_piece_ids.setdefault(shard_number, []).append(local_id)
+        if len(shard_piece_ids) <= 1:
+            shard_results = [self.lookup_shard(shard_number, plan, *args, piece_ids=local_ids, budget=budget) for shard_number, local_ids in shard_piece_ids.items()]
+        else:
+            with self.query_executor_lock:
+                if self.query_executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self.query_executor = ThreadPoolExecutor(self.number_of_shards, thread_name_prefix='firms-shard')
+            futures = [self.query_executor.submit(self.lookup_shard, shard_number, plan, *args, piece_ids=local_ids, budget=budget) for shard_number, local_ids in shard_piece_ids.items()]
+            shard_results = [future.result() for future in futures]
+        number_of_shards = self.number_of_shards
+        for query_stem, multiplicity in plan.items():
+            matches = LookupResult()
+            # Dictionary from matched stem to global stem id; None is the query stem itself, other keys are fuzzy matches
+            stem_ids = {}
+            for shard_number, results in shard_results:
+                lookup_results = results[query_stem]
+                # Dictionary from the shard's stem ids to global stem ids
+                local_stem_ids = {}
+                for stem_id in set(lookup_results.stems):
+                    distance, matched_stem = lookup_results.matched_stems.get(stem_id, (None, None))
+                    if matched_stem not in stem_ids:
+                        stem_ids[matched_stem] = stem_id * number_of_shards + shard_number
+                        if matched_stem is not None:
+                            matches.matched_stems[stem_ids[matched_stem]] = (distance, matched_stem)
+                    local_stem_ids[stem_id] = stem_ids[matched_stem]
+                matches.ids.extend(x * number_of_shards + shard_number for x in lookup_results.ids)
+                matches.piece_ids.extend(x * number_of_shards + shard_number for x in lookup_results.piece_ids)
+                matches.parts.extend(x * number_of_shards + shard_number for x in lookup_results.parts)
+                matches.offsets.extend(lookup_results.offsets)
+                matches.stems.extend(local_stem_ids[x] for x in lookup_results.stems)
+            yield query_stem, multiplicity, matches
+
+    def corpus_size(self):
+        return sum(shard.corpus_size() for shard in self.shards)
+
+    def estimate_lookups(self, plan, *args):
+        estimates = {}
+        for shard in self.shards:
+            for query_stem, rows in shard.estimate_lookups(plan, *args).items():
+                estimates[query_stem] = estimates.get(query_stem, 0) + rows
+        return estimates
+
+    def piece_by_id(self, piece_id):
+        """
+        Lookup a single piece by global ID
+            :param self:
+            :param piece_id: Global id of the piece to retrieve
+        """
+        shard, local_id = self.local_id(piece_id)
+        return [(piece_id,) + tuple(row[1:]) for row in shard.piece_by_id(local_id)]
+
+    def pieces(self):
+        """
+        Return basic information on all pieces, with global ids
+            :param self:
+        """
+        return [
+            (name, path, self.global_id(piece_id, shard_number))
+            for shard_number, shard in enumerate(self.shards)
+            for name, path, piece_id in shard.pieces()
+        ]
+
+    def parts_with_notes(self):
+        """
+        Return a dictionary from (name, path, id) piece row to a list of (part id, part name)
+        for every part with a stored note sequence, with global ids
+            :param self:
+        """
+        return {
+            (name, path, self.global_id(piece_id, shard_number)): [(self.global_id(part_id, shard_number), part_name) for part_id, part_name in parts]
+            for shard_number, shard in enumerate(self.shards)
+            for (name, path, piece_id), parts in shard.parts_with_notes().items()
+        }
+
+    def part_notes(self, part_id):
+        """
+        Return the encoded note sequence stored for a part
+            :param self:
+            :param part_id: Global id of the part
+        """
+        shard, local_id = self.local_id(part_id)
+        return shard.part_notes(local_id)
+
+    def stemmers(self):
+        return self.shards[0].stemmers()
+
+    def graders(self):
+        return self.grader_methods.keys()
+
+    def stem_filter_stats(self):
+        """
+        Return the Bloom filter statistics of each stemmer, as for SqlIRSystem.stem_filter_stats, summed over shards.
+        Each shard has its own filters; the false positive rate is the highest of any shard
+            :param self:
+        """
+        stats = {}
+        for shard in self.shards:
+            for shard_stats in shard.stem_filter_stats():
+                key = (shard_stats['stemmer'], shard_stats['snippet_length'])
+                if key not in stats:
+                    stats[key] = dict(shard_stats)
+                else:
+                    for name in ('stems', 'capacity', 'bytes'):
+                        stats[key][name] = stats[key][name] + shard_stats[name]
+                    stats[key]['false_positive_rate'] = max(stats[key]['false_positive_rate'], shard_stats['false_positive_rate'])
+        return list(stats.values())
+
+    def info(self):
+        """
+        Return general information about the data in all shards. Stems are counted once per shard
+            :param self:
+        """
+        results = {'shards': self.number_of_shards}
+        for shard in self.shards:
+            for table, count in shard.info().items():
+                results[table] = count if table == 'stemmers' else results.get(table, 0) + count
+        return results
@@ -2,56 +2,240 @@
 A Sqlite3 based implementation of FIRMS
 """
 
-from itertools import chain
+from array import array
+from itertools import chain, groupby
+from operator import itemgetter
+import os
 import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
 
-from music21.repeat import ExpanderException
+from firms.models import IRSystem, FirmIndex, LookupResult, QueryStem, get_part_details, get_notes_and_rests, get_snippets_by_length, DEFAULT_SNIPPET_LENGTH
+from firms.profiling import profiler
+from firms.sampling import encode_notes
+from firms.fuzzy import MAX_FUZZY_CANDIDATES, MAX_FUZZY_DISTANCE, MAX_FUZZY_NEIGHBOURS, StemVariants, stem_variants, token_edit_distance, tokenize_stem
+from firms.sql_tracing import sql_tracer
+from firms.stem_filters import StemFilter
 
-from firms.models import IRSystem, FirmIndex, get_part_details, get_snippets_for_part
+# Stored in PRAGMA user_version once ensure_db has run; bump it whenever ensure_db changes,
+# so existing databases are upgraded the next time they are opened
+SCHEMA_VERSION = 4
+# Tables every FIRMS database has had since the first schema; merge copies from these
+BASE_TABLES = ('pieces', 'parts', 'snippets', 'stemmers', 'stems', 'entries')
+# Number of values bound to one IN (...) list, below sqlite's limit on statement parameters
+MAX_SQL_PARAMETERS = 900
 
 class SqlIRSystem(IRSystem):
     """
     A Sqlite3 based implementation of IRSystem
         :param IRSystem:
     """
-    def __init__(self, dbpath, index_methods, graders=None, piece_paths=None, rebuild=True):
+    def __init__(self, dbpath, index_methods, graders=None, piece_paths=None, rebuild=True, snippet_lengths=None, query_workers=1,
+                 async_pool_size=None, stem_filters=True):
+        """
+        Constructor
+            :param self:
+            :param dbpath: Path to the sqlite database file
+            :param index_methods: Dictionary of stemmers
+            :param graders=None: Dictionary of graders
+            :param piece_paths=None: List of file paths to pieces
+            :param rebuild=True: Boolean flag erases existing FIRMS index if true
+            :param snippet_lengths=None: Dictionary from stemmer name to list of snippet lengths to index.
+                Stemmers not included use the lengths already stored in the database, or DEFAULT_SNIPPET_LENGTH
+            :param query_workers=1: Number of threads used to look up stemmers concurrently within a query.
+                With 1, lookups run sequentially on the calling thread
+            :param async_pool_size=None: Number of connections shared by queries made through aquery;
+                defaults to one per stemmer
+            :param stem_filters=True: Check each stem against a Bloom filter of indexed stems before looking it up
+        """
         piece_paths = piece_paths or []
+        snippet_lengths = snippet_lengths or {}
         self.dbpath = dbpath
-        with sqlite3.connect(self.dbpath) as conn:
-            self.ensure_db(conn)
-            self.stemmer_ids = self.ensure_stemmers(index_methods, conn)
+        self.query_workers = query_workers
+        self.stem_filters = stem_filters
+        self.query_executor = None
+        self.query_executor_lock = threading.Lock()
+        self.read_connections = threading.local()
+        self.async_pool = AsyncConnectionPool(dbpath, async_pool_size or len(index_methods))
+        with sql_tracer.connect(self.dbpath) as conn:
+            if self.schema_version(conn) != SCHEMA_VERSION:
+                self.ensure_db(conn)
+            stored_lengths = self.get_snippet_lengths(conn)
+            self.snippet_lengths = {
+                name: sorted(set(snippet_lengths.get(name) or stored_lengths.get(name) or [DEFAULT_SNIPPET_LENGTH]))
+                for name in index_methods.keys()
+            }
+            self.stemmer_ids = self.ensure_stemmers(self.snippet_lengths, conn)
         super().__init__(index_methods, graders, piece_paths, rebuild)
 
     def make_empty_index(self, indexfn, name):
-        return SqlIndex(self.dbpath, [], indexfn, name, self.stemmer_ids[name])
+        stemmer_ids = {length: self.stemmer_ids[(name, length)] for length in self.snippet_lengths[name]}
+        return SqlIndex(self.dbpath, [], indexfn, name, stemmer_ids, self.stem_filters)
 
     def add_piece(self, piece, piece_path, explicit_repeats=False):
-        with sqlite3.connect(self.dbpath) as conn:
+        self.add_scores([piece], piece_path, explicit_repeats)
+
+    def add_scores(self, scores, piece_path, explicit_repeats=False, replace=False):
+        """
+        Add every score read from one file in a single transaction, so a score that fails to index
+        leaves the database as it was
+            :param self:
+            :param scores: List of music21 streams, each added as a piece
+            :param piece_path: Original path to the scores
+            :param explicit_repeats=False: Expand repeats before indexing
+            :param replace=False: Delete every piece previously added from the path, in the same transaction
+        """
+        with profiler.stage('ingest.add_piece'), sql_tracer.connect(self.dbpath) as conn:
             cursor = conn.cursor()
             cursor.execute("PRAGMA synchronous = OFF")
-            cursor.execute("PRAGMA journal_mode = OFF")
-            piece_id = None
-            if explicit_repeats:
-                try:
+            # Kept in memory rather than turned off, so a failed piece can be rolled back
+            cursor.execute("PRAGMA journal_mode = MEMORY")
+            if replace:
+                self.delete_pieces(conn, [row[0] for row in cursor.execute("SELECT id FROM pieces WHERE path=?", (piece_path, )).fetchall()])
+            for piece in scores:
+                self.insert_piece(piece, piece_path, explicit_repeats, conn, cursor)
+            self.update_stem_filters(conn, cursor)
+            self.update_fuzzy_indexes(conn, cursor)
+            cursor.close()
+
+    def insert_piece(self, piece, piece_path, explicit_repeats, conn, cursor):
+        """
+        Index a piece, without committing
+            :param self:
+            :param piece: Music21 stream representing the piece
+            :param piece_path: Original path to the piece
+            :param explicit_repeats: Expand repeats before indexing
+            :param conn: Connection to sqlite instance
+            :param cursor: Cursor to use
+        """
+        piece_id = None
+        if explicit_repeats:
+            from music21.repeat import ExpanderException
+            try:
+                with profiler.stage('ingest.expand_repeats'):
                     piece = piece.expandRepeats()
-                except ExpanderException:
-                    print("\tUnable to expand piece. Continuing with original")
-            for part in get_part_details(piece):
-                piece_name = part.piece
-                part_name = part.name
-                if not piece_id:
-                    piece_id = self.ensure_piece(piece_path, piece_name, conn, cursor)
-                part_id = self.ensure_part(piece_id, part_name, conn, cursor)
-                snippets = list(get_snippets_for_part(part))
-                snippet_ids = self.ensure_snippets(snippets, piece_id, part_id, conn, cursor)
-                for idx in self.indexes.values():
-                    idx.add_snippets(snippets, snippet_ids, conn, cursor)
+            except ExpanderException:
+                print("\tUnable to expand piece. Continuing with original")
+        for part in get_part_details(piece):
+            piece_name = part.piece
+            part_name = part.name
+            if not piece_id:
+                piece_id = self.ensure_piece(piece_path, piece_name, conn, cursor)
+            with profiler.stage('ingest.notes'):
+                notes = get_notes_and_rests(part.part)
+                encoded_notes = encode_notes(notes)
+            self.add_part(piece_id, piece_name, part_name, notes, encoded_notes, conn, cursor)
+
+    def add_parts(self, piece_path, piece_name, parts):
+        """
+        Add a piece from parts whose notes have already been extracted, without a music21 score.
+        Returns the id of the piece
+            :param self:
+            :param piece_path: Path identifying the piece
+            :param piece_name: Name of the piece
+            :param parts: List of (part name, list of music21 notes and rests, encoded notes) tuples
+        """
+        with sql_tracer.connect(self.dbpath) as conn:
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA synchronous = OFF")
+            cursor.execute("PRAGMA journal_mode = MEMORY")
+            piece_id = self.ensure_piece(piece_path, piece_name, conn, cursor)
+            for part_name, notes, encoded_notes in parts:
+                self.add_part(piece_id, piece_name, part_name, notes, encoded_notes, conn, cursor)
+            self.update_stem_filters(conn, cursor)
+            self.update_fuzzy_indexes(conn, cursor)
+            cursor.close()
+        return piece_id
+
+    def add_part(self, piece_id, piece_name, part_name, notes, encoded_notes, conn, cursor):
+        """
+        Store a part's notes and index its snippets at every configured length
+            :param self:
+            :param piece_id: Id of source piece
+            :param piece_name: Name of source piece
+            :param part_name: Name of the part
+            :param notes: List of music21 notes and rests in the part
+            :param encoded_notes: The notes, encoded for storage by firms.sampling
+            :param conn: Connection to sqlite instance
+            :param cursor: Cursor to use
+        """
+        with profiler.stage('sql.insert_part'):
+            part_id = self.ensure_part(piece_id, part_name, conn, cursor)
+            self.ensure_part_notes(part_id, encoded_notes, conn, cursor)
+        with profiler.stage('ingest.snippets'):
+            snippets_by_length = get_snippets_by_length(piece_name, part_name, notes, chain.from_iterable(self.snippet_lengths.values()))
+        # Snippet rows identify a starting offset within the part; the shortest length covers every offset
+        with profiler.stage('sql.insert_snippets'):
+            snippet_ids = self.ensure_snippets(snippets_by_length[min(snippets_by_length)], piece_id, part_id, conn, cursor)
+        for idx in self.indexes.values():
+            for length in idx.snippet_lengths:
+                snippets = snippets_by_length[length]
+                idx.add_snippets(snippets, [snippet_ids[snippet.offset] for snippet in snippets], conn, cursor)
+
+    def update_stem_filters(self, conn, cursor):
+        """
+        Add newly indexed stems to every stem filter, building filters not yet stored, and store them.
+        Queries keep the filters they build or update in memory, so only ingest writes them
+            :param self:
+            :param conn: Connection to sqlite instance
+            :param cursor: Cursor to use
+        """
+        if not self.stem_filters:
+            return
+        with profiler.stage('sql.update_stem_filters'):
+            version = self.stem_filter_version(cursor)
+            for idx in self.indexes.values():
+                for stemmer_id in idx.stemmer_ids.values():
+                    idx.sync_filter(stemmer_id, version, conn, cursor, save=True)
+
+    def update_fuzzy_indexes(self, conn, cursor):
+        """
+        Add the deletion variants of newly indexed stems to every fuzzy index built so far.
+        Fuzzy indexes are built by build_fuzzy_indexes
+            :param self:
+            :param conn: Connection to sqlite instance
+            :param cursor: Cursor to use
+        """
+        built = dict(cursor.execute("SELECT stemmer_id, max_distance FROM fuzzy_indexes").fetchall())
+        if not built:
+            return
+        with profiler.stage('sql.update_fuzzy_indexes'):
+            for idx in self.indexes.values():
+                for stemmer_id in idx.stemmer_ids.values():
+                    if stemmer_id in built:
+                        idx.ensure_fuzzy_index(stemmer_id, built[stemmer_id], conn, cursor)
+
+    def build_fuzzy_indexes(self, max_distance):
+        """
+        Store the deletion variants of every stemmer's stems, so fuzzy queries up to max_distance look them up
+        in the database. Fuzzy queries without a stored index vary the stems in memory, in every process
+            :param self:
+            :param max_distance: Largest edit distance fuzzy queries will use, capped at MAX_FUZZY_DISTANCE
+        """
+        max_distance = min(max_distance, MAX_FUZZY_DISTANCE)
+        with sql_tracer.connect(self.dbpath) as conn:
+            cursor = conn.cursor()
+            # Take the write lock before reading what is built, so concurrent builds don't store variants twice
+            cursor.execute("BEGIN IMMEDIATE")
+            for idx in self.indexes.values():
+                for stemmer_id in idx.stemmer_ids.values():
+                    idx.ensure_fuzzy_index(stemmer_id, max_distance, conn, cursor)
             cursor.close()
 
+    @staticmethod
+    def stem_filter_version(cursor):
+        """
+        Return the (largest stem id, stem deletion epoch) stem filters must be synced to. Both only grow,
+        so comparing them with a loaded filter detects changes made by any connection
+            :param cursor: Cursor to use
+        """
+        return cursor.execute("SELECT (SELECT coalesce(max(id), 0) FROM stems), (SELECT coalesce(max(epoch), 0) FROM stem_filter_epoch)").fetchone()
+
     @staticmethod
     def ensure_db(conn):
         """
-        Ensure base tables setup
+        Ensure base tables setup, and record the schema version they match
             :param conn: Connection to sqlite instance
         """
         cursor = conn.cursor()
@@ -64,8 +248,13 @@ class SqlIRSystem(IRSystem):
                                                 name TEXT NOT NULL,
                         FOREIGN KEY (piece_id) REFERENCES pieces(id))""")
         cursor.execute("""CREATE TABLE IF NOT EXISTS stemmers (id INTEGER PRIMARY KEY ASC,
-                                                    name TEXT NOT NULL
-                        )""")
+                                                    name TEXT NOT NULL,
+                                                    snippet_length INTEGER NOT NULL DEFAULT %s
+                        )""" % DEFAULT_SNIPPET_LENGTH)
+        # Databases created before snippet lengths were configurable only indexed the default length
+        stemmer_columns = [r[1] for r in cursor.execute("PRAGMA table_info(stemmers)").fetchall()]
+        if 'snippet_length' not in stemmer_columns:
+            cursor.execute("ALTER TABLE stemmers ADD COLUMN snippet_length INTEGER NOT NULL DEFAULT %s" % DEFAULT_SNIPPET_LENGTH)
         cursor.execute("""CREATE TABLE IF NOT EXISTS snippets (id INTEGER PRIMARY KEY ASC,
                                                     piece_id INTEGER NOT NULL,
                                                     part_id INTEGER NOT NULL,
@@ -87,6 +276,32 @@ class SqlIRSystem(IRSystem):
                                                 FOREIGN KEY (snippet_id) REFERENCES snippets(id),
                                                 CONSTRAINT unique_entry UNIQUE (stem_id, snippet_id)
                         )""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS part_notes (part_id INTEGER PRIMARY KEY,
+                                                notes TEXT NOT NULL,
+                                                FOREIGN KEY (part_id) REFERENCES parts(id)
+                        )""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS stem_filters (stemmer_id INTEGER PRIMARY KEY,
+                                                capacity INTEGER NOT NULL,
+                                                hashes INTEGER NOT NULL,
+                                                stems INTEGER NOT NULL,
+                                                max_stem_id INTEGER NOT NULL,
+                                                bits BLOB NOT NULL,
+                                                FOREIGN KEY (stemmer_id) REFERENCES stemmers(id)
+                        )""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS stem_filter_epoch (id INTEGER PRIMARY KEY,
+                                                epoch INTEGER NOT NULL
+                        )""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS fuzzy_indexes (stemmer_id INTEGER PRIMARY KEY,
+                                                max_distance INTEGER NOT NULL,
+                                                max_stem_id INTEGER NOT NULL,
+                                                FOREIGN KEY (stemmer_id) REFERENCES stemmers(id)
+                        )""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS stem_variants (stemmer_id INTEGER NOT NULL,
+                                                variant TEXT NOT NULL,
+                                                stem_id INTEGER NOT NULL,
+                                                FOREIGN KEY (stemmer_id) REFERENCES stemmers(id),
+                                                FOREIGN KEY (stem_id) REFERENCES stems(id)
+                        )""")
         conn.commit()
         cursor.execute("""CREATE INDEX IF NOT EXISTS piece_path_idx ON pieces(path)""")
         cursor.execute("""CREATE INDEX IF NOT EXISTS stemmer_name_idx ON stemmers(name)""")
@@ -96,25 +311,139 @@ class SqlIRSystem(IRSystem):
         cursor.execute("""CREATE INDEX IF NOT EXISTS stem_stemmer_idx ON stems(stemmer_id)""")
         cursor.execute("""CREATE INDEX IF NOT EXISTS stem_stem_idx ON stems(stem)""")
         cursor.execute("""CREATE INDEX IF NOT EXISTS entry_stem_idx ON entries(stem_id)""")
+        # Lets a piece's entries be deleted without scanning every posting list
+        cursor.execute("""CREATE INDEX IF NOT EXISTS entry_snippet_idx ON entries(snippet_id)""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS stem_variant_idx ON stem_variants(stemmer_id, variant)""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS stem_variant_stem_idx ON stem_variants(stem_id)""")
+        cursor.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        conn.commit()
+
+    @staticmethod
+    def schema_version(conn):
+        """
+        Get the version of the schema last ensured in this database, or 0 if it has never been ensured
+            :param conn: Connection to sqlite instance
+        """
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    @staticmethod
+    def get_snippet_lengths(conn):
+        """
+        Get the snippet lengths currently indexed for each stemmer
+            :param conn: Connection to sqlite instance
+        """
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, snippet_length FROM stemmers ORDER BY name, snippet_length")
+        return {name: [length for _, length in rows] for name, rows in groupby(cursor.fetchall(), itemgetter(0))}
 
     @staticmethod
-    def ensure_stemmers(stemmers, conn):
+    def ensure_stemmers(snippet_lengths, conn):
         """
-        Ensure the given stemmers are included in the stemmers table
-            :param stemmers: Stemmers to verify
+        Ensure each stemmer is included in the stemmers table once per snippet length.
+        Returns a dictionary from (stemmer name, snippet length) to stemmer id
+            :param snippet_lengths: Dictionary from stemmer name to list of snippet lengths
             :param conn: Connection to sqlite instance
         """
         cursor = conn.cursor()
         stemmer_ids = {}
-        for stemmer_name in stemmers.keys():
-            cursor.execute("SELECT id FROM stemmers WHERE name=?", (stemmer_name, ))
-            results = cursor.fetchall()
-            if not results:
-                cursor.execute("INSERT INTO stemmers (name) VALUES (?)", (stemmer_name, ))
-            stemmer_ids[stemmer_name] = cursor.lastrowid
+        for stemmer_name, lengths in snippet_lengths.items():
+            for length in lengths:
+                cursor.execute("SELECT id FROM stemmers WHERE name=? AND snippet_length=?", (stemmer_name, length))
+                results = cursor.fetchall()
+                if results:
+                    stemmer_ids[(stemmer_name, length)] = results[0][0]
+                else:
+                    cursor.execute("INSERT INTO stemmers (name, snippet_length) VALUES (?, ?)", (stemmer_name, length))
+                    stemmer_ids[(stemmer_name, length)] = cursor.lastrowid
         conn.commit()
         return stemmer_ids
 
+    @staticmethod
+    def merge(conn, source_path):
+        """
+        Copy every piece in another FIRMS database into this one, as one transaction.
+        Pieces whose path is already indexed are skipped. Stemmers are matched by name and snippet length
+        and stems by stemmer and text; all other rows get new ids, offset past the largest id in use.
+        Rows are copied with INSERT ... SELECT between attached databases and mapped through temporary
+        tables, so memory use does not grow with the size of either database.
+        The source is attached read-only and never modified. Sources of an older schema are read as they are,
+        taking the default snippet length for stemmers that predate snippet lengths; sources of a newer
+        schema, or that are not FIRMS databases, raise ValueError.
+        Returns a dictionary with the number of pieces added and skipped, and of entries added
+            :param conn: Connection to the sqlite instance receiving the pieces, opened with uri=True
+            :param source_path: Path to the sqlite database to copy from
+        """
+        cursor = conn.cursor()
+        cursor.execute("ATTACH DATABASE ? AS source", ('file:%s?mode=ro' % pathname2url(os.path.abspath(source_path)),))
+        try:
+            source_version = cursor.execute("PRAGMA source.user_version").fetchone()[0]
+            source_tables = {r[0] for r in cursor.execute("SELECT name FROM source.sqlite_master WHERE type='table'")}
+            if source_version > SCHEMA_VERSION:
+                raise ValueError("%s has schema version %s, newer than this version of firms (%s)" % (source_path, source_version, SCHEMA_VERSION))
+            if not set(BASE_TABLES) <= source_tables:
+                raise ValueError("%s is not a FIRMS database" % source_path)
+            stemmer_columns = [r[1] for r in cursor.execute("PRAGMA source.table_info(stemmers)")]
+            cursor.execute("CREATE TEMP VIEW merge_stemmers AS SELECT id, name, %s AS snippet_length FROM source.stemmers" % (
+                'snippet_length' if 'snippet_length' in stemmer_columns else DEFAULT_SNIPPET_LENGTH))
+            offsets = {
+                table: cursor.execute("SELECT coalesce(max(id), 0) FROM main.%s" % table).fetchone()[0]
+                for table in ('pieces', 'parts', 'snippets')
+            }
+            cursor.execute("CREATE TEMP TABLE merge_pieces (id INTEGER PRIMARY KEY)")
+            cursor.execute("""INSERT INTO temp.merge_pieces (id)
+                           SELECT id FROM source.pieces WHERE path NOT IN (SELECT path FROM main.pieces)""")
+            added = cursor.execute("SELECT count(*) FROM temp.merge_pieces").fetchone()[0]
+            skipped = cursor.execute("SELECT count(*) FROM source.pieces").fetchone()[0] - added
+
+            cursor.execute("""INSERT INTO main.stemmers (name, snippet_length)
+                           SELECT DISTINCT name, snippet_length FROM temp.merge_stemmers AS s WHERE NOT EXISTS
+                           (SELECT 1 FROM main.stemmers AS m WHERE m.name=s.name AND m.snippet_length=s.snippet_length)""")
+            # Only the stems of the pieces being added, so skipped pieces leave no orphan stems behind
+            cursor.execute("CREATE TEMP TABLE merge_stems (id INTEGER PRIMARY KEY, new_id INTEGER)")
+            cursor.execute("""INSERT INTO temp.merge_stems (id)
+                           SELECT DISTINCT e.stem_id FROM source.entries AS e
+                           JOIN source.snippets AS sn ON sn.id=e.snippet_id
+                           WHERE sn.piece_id IN temp.merge_pieces""")
+            cursor.execute("""INSERT OR IGNORE INTO main.stems (stemmer_id, stem)
+                           SELECT m.id, s.stem FROM source.stems AS s
+                           JOIN temp.merge_stemmers AS ss ON ss.id=s.stemmer_id
+                           JOIN main.stemmers AS m ON m.name=ss.name AND m.snippet_length=ss.snippet_length
+                           WHERE s.id IN (SELECT id FROM temp.merge_stems)""")
+            cursor.execute("""UPDATE temp.merge_stems SET new_id=(
+                               SELECT ms.id FROM source.stems AS s
+                               JOIN temp.merge_stemmers AS ss ON ss.id=s.stemmer_id
+                               JOIN main.stemmers AS m ON m.name=ss.name AND m.snippet_length=ss.snippet_length
+                               JOIN main.stems AS ms ON ms.stemmer_id=m.id AND ms.stem=s.stem
+                               WHERE s.id=temp.merge_stems.id)""")
+
+            cursor.execute("""INSERT INTO main.pieces (id, path, name)
+                           SELECT id + :pieces, path, name FROM source.pieces WHERE id IN temp.merge_pieces""", offsets)
+            cursor.execute("""INSERT INTO main.parts (id, piece_id, name)
+                           SELECT id + :parts, piece_id + :pieces, name FROM source.parts WHERE piece_id IN temp.merge_pieces""", offsets)
+            if 'part_notes' in source_tables:
+                cursor.execute("""INSERT INTO main.part_notes (part_id, notes)
+                               SELECT n.part_id + :parts, n.notes FROM source.part_notes AS n
+                               JOIN source.parts AS p ON p.id=n.part_id WHERE p.piece_id IN temp.merge_pieces""", offsets)
+            cursor.execute("""INSERT INTO main.snippets (id, piece_id, part_id, offset)
+                           SELECT id + :snippets, piece_id + :pieces, part_id + :parts, offset FROM source.snippets
+                           WHERE piece_id IN temp.merge_pieces""", offsets)
+            cursor.execute("""INSERT INTO main.entries (stem_id, snippet_id)
+                           SELECT ms.new_id, e.snippet_id + :snippets FROM source.entries AS e
+                           JOIN temp.merge_stems AS ms ON ms.id=e.stem_id
+                           JOIN source.snippets AS sn ON sn.id=e.snippet_id
+                           WHERE sn.piece_id IN temp.merge_pieces""", offsets)
+            entries = cursor.rowcount
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.execute("DROP TABLE IF EXISTS temp.merge_pieces")
+            cursor.execute("DROP TABLE IF EXISTS temp.merge_stems")
+            cursor.execute("DROP VIEW IF EXISTS temp.merge_stemmers")
+            cursor.execute("DETACH DATABASE source")
+        return {'pieces': added, 'skipped': skipped, 'entries': entries}
+
     @staticmethod
     def ensure_piece(piece_path, piece_name, conn, cursor):
         """
@@ -133,7 +462,6 @@ class SqlIRSystem(IRSystem):
         cursor.execute("INSERT INTO pieces (path, name) VALUES (?, ?)",
                        (piece_path, piece_name)
                       )
-        conn.commit()
         return cursor.lastrowid
 
     @staticmethod
@@ -150,9 +478,19 @@ class SqlIRSystem(IRSystem):
         if results:
             return results[0][0]
         cursor.execute("INSERT INTO parts (piece_id, name) VALUES (?, ?)", (piece_id, part_name))
-        conn.commit()
         return cursor.lastrowid
 
+    @staticmethod
+    def ensure_part_notes(part_id, encoded_notes, conn, cursor):
+        """
+        Store the flat note sequence of a part, used to sample evaluation queries from the index
+            :param part_id: Id of the part
+            :param encoded_notes: Notes and rests in the part, encoded by firms.sampling.encode_notes
+            :param conn: Connection to sqlite instance
+            :param cursor: Cursor to use
+        """
+        cursor.execute("INSERT OR REPLACE INTO part_notes (part_id, notes) VALUES (?, ?)", (part_id, encoded_notes))
+
     @staticmethod
     def ensure_snippet(snippet, piece_id, part_id, conn, cursor):
         """
@@ -168,13 +506,13 @@ class SqlIRSystem(IRSystem):
         if results:
             return results[0][0]
         cursor.execute("INSERT INTO snippets (piece_id, part_id, offset) VALUES (?, ?, ?)", (piece_id, part_id, snippet.offset))
-        conn.commit()
         return cursor.lastrowid
 
     @staticmethod
     def ensure_snippets(snippets, piece_id, part_id, conn, cursor):
         """
-        Ensure several snippets from the same piece and part are included
+        Ensure several snippets from the same piece and part are included.
+        Returns a dictionary from snippet offset to snippet id
             :param snippets: List of snippets to include
             :param piece_id: Id of source piece
             :param part_id: Id of source part
@@ -183,16 +521,15 @@ class SqlIRSystem(IRSystem):
         """
         values = [(piece_id, part_id, snippet.offset) for snippet in snippets]
         cursor.executemany("INSERT OR IGNORE INTO snippets (piece_id, part_id, offset) VALUES (?, ?, ?)", values)
-        conn.commit()
-        cursor.execute("SELECT id FROM snippets WHERE piece_id=? AND part_id=?", (piece_id, part_id))
-        return [r[0] for r in cursor.fetchall()]
+        cursor.execute("SELECT offset, id FROM snippets WHERE piece_id=? AND part_id=?", (piece_id, part_id))
+        return dict(cursor.fetchall())
 
     def get_number_of_pieces(self):
         """
         Get the total number of pieces
             :param self:
         """
-        conn = sqlite3.connect(self.dbpath)
+        conn = sql_tracer.connect(self.dbpath)
         cursor = conn.cursor()
         cursor.execute("""SELECT count(*) FROM pieces""")
         result = cursor.fetchone()
@@ -200,17 +537,124 @@ class SqlIRSystem(IRSystem):
         return result[0]
 
     def lookup(self, snippet):
-        conn = sqlite3.connect(self.dbpath)
+        conn = sql_tracer.connect(self.dbpath)
         cursor = conn.cursor()
         return super().lookup(snippet, conn, cursor)
 
-    def raw_query(self, query, *args):
-        conn = sqlite3.connect(self.dbpath)
+    def read_connection(self):
+        """
+        Get the read connection owned by the current thread, opening it on first use.
+        Each query worker thread keeps its own connection, since sqlite connections can't be shared across threads
+            :param self:
+        """
+        conn = getattr(self.read_connections, 'conn', None)
+        if conn is None:
+            conn = sql_tracer.connect(self.dbpath)
+            self.read_connections.conn = conn
+        return conn
+
+    def lookup_stems(self, query_stems, *args, conn=None, piece_ids=None, budget=None):
+        """
+        Look up several stems on one connection.
+        Returns a dictionary from QueryStem to list of matches
+            :param self:
+            :param query_stems: Sequence of QueryStem tuples
+            :param *args: Extra arguments passed on to index lookup methods
+            :param conn=None: Connection to use; defaults to the current thread's read connection
+            :param piece_ids=None: Collection of piece ids to fetch matches from; defaults to every piece
+            :param budget=None: QueryBudget limiting the rows fetched and the time spent; unlimited if None
+        """
+        conn = conn or self.read_connection()
         cursor = conn.cursor()
-        return super().raw_query(query, conn, cursor, *args)
+        if self.stem_filters:
+            with profiler.stage('sql.sync_stem_filters'):
+                version = self.stem_filter_version(cursor)
+                for stemmer, length in {(query_stem.stemmer, query_stem.length) for query_stem in query_stems}:
+                    idx = self.indexes[stemmer]
+                    idx.sync_filter(idx.stemmer_ids[length], version, conn, cursor)
+        results = {
+            query_stem: self.indexes[query_stem.stemmer].lookup_stem(query_stem.stem, query_stem.length, conn, cursor, *args, piece_ids=piece_ids, budget=budget)
+            for query_stem in query_stems
+        }
+        cursor.close()
+        return results
+
+    def execute_plan(self, plan, *args, piece_ids=None, budget=None):
+        """
+        Look up every stem in a query plan, dispatching each stemmer's stems to a worker thread.
+        sqlite releases the GIL while executing statements, so stemmers are looked up concurrently.
+        Results are yielded grouped by stemmer, in the order stemmers first appear in the plan,
+        as soon as that stemmer's lookups finish; the order never depends on which worker finishes first.
+        With piece_ids, only the postings of those pieces are fetched. A budget is shared by every lookup.
+        """
+        stems_by_stemmer = {}
+        for query_stem in plan.keys():
+            stems_by_stemmer.setdefault(query_stem.stemmer, []).append(query_stem)
+        if self.query_workers <= 1 or len(stems_by_stemmer) <= 1:
+            pending = [self.lookup_stems(plan.keys(), *args, piece_ids=piece_ids, budget=budget)]
+        else:
+            with self.query_executor_lock:
+                if self.query_executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self.query_executor = ThreadPoolExecutor(self.query_workers, thread_name_prefix='firms-query')
+            futures = [self.query_executor.submit(self.lookup_stems, query_stems, *args, piece_ids=piece_ids, budget=budget) for query_stems in stems_by_stemmer.values()]
+            pending = (future.result() for future in futures)
+        for results in pending:
+            for query_stem, lookup_results in results.items():
+                yield query_stem, plan[query_stem], lookup_results
+
+    async def aexecute_plan(self, plan, *args):
+        """
+        Look up every stem in a query plan without blocking the running event loop.
+        Each stemmer's stems are looked up concurrently on a connection borrowed from the async pool, rather than
+        in an executor, so that cancelling the query interrupts its statements; the pool's size bounds the lookups in flight
+            :param self:
+            :param plan: Counter from QueryStem to multiplicity, as returned by plan_query
+            :param *args: Extra arguments passed on to index lookup methods
+        """
+        import asyncio
+        stems_by_stemmer = {}
+        for query_stem in plan.keys():
+            stems_by_stemmer.setdefault(query_stem.stemmer, []).append(query_stem)
+        results = await asyncio.gather(*[
+            self.async_pool.run(lambda conn, query_stems=query_stems: self.lookup_stems(query_stems, *args, conn=conn))
+            for query_stems in stems_by_stemmer.values()
+        ])
+        return [(query_stem, plan[query_stem], lookup_results) for stemmer_results in results for query_stem, lookup_results in stemmer_results.items()]
+
+    def estimate_lookups(self, plan, max_distance=0, *args):
+        """
+        Count the posting rows of every stem in a query plan, from the entries index without fetching them.
+        Stems that are not indexed are estimated at 0 rows. Fuzzy lookups also fetch neighbouring stems,
+        so for them the count is a lower bound, and a stem that is not indexed may still match its
+        neighbours; such stems are left out, as their rows can't be estimated
+            :param self:
+            :param plan: QueryPlan to estimate
+            :param max_distance=0: Largest edit distance of the fuzzy lookups, as passed to lookup_stem
+            :param *args: Other lookup arguments, which don't change the estimates
+        """
+        cursor = self.read_connection().cursor()
+        stems_by_stemmer_id = {}
+        for query_stem in plan.keys():
+            stemmer_id = self.indexes[query_stem.stemmer].stemmer_ids[query_stem.length]
+            stems_by_stemmer_id.setdefault(stemmer_id, {})[query_stem.stem] = query_stem
+        estimates = {query_stem: 0 for query_stem in plan.keys()}
+        with profiler.stage('sql.estimate_lookups'):
+            for stemmer_id, query_stems_by_stem in stems_by_stemmer_id.items():
+                stems = list(query_stems_by_stem)
+                for start in range(0, len(stems), MAX_SQL_PARAMETERS):
+                    chunk = stems[start:start + MAX_SQL_PARAMETERS]
+                    cursor.execute("""SELECT stems.stem, (SELECT count(*) FROM entries WHERE entries.stem_id=stems.id) FROM stems
+                                   WHERE stems.stemmer_id=? AND stems.stem IN (%s)""" % ','.join('?' * len(chunk)), [stemmer_id] + chunk)
+                    for stem, rows in cursor.fetchall():
+                        estimates[query_stems_by_stem[stem]] = rows
+        cursor.close()
+        if max_distance:
+            return {query_stem: rows for query_stem, rows in estimates.items() if rows}
+        return estimates
 
     def corpus_size(self):
-        conn = sqlite3.connect(self.dbpath)
+        conn = sql_tracer.connect(self.dbpath)
         cursor = conn.cursor()
         cursor.execute("SELECT count(*) FROM pieces")
         result = cursor.fetchone()
@@ -222,27 +666,164 @@ class SqlIRSystem(IRSystem):
             :param self:
             :param piece_id: Id of the piece to retrieve
         """
-        conn = sqlite3.connect(self.dbpath)
+        conn = sql_tracer.connect(self.dbpath)
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM pieces WHERE pieces.id=?", (piece_id, ))
         return cursor.fetchall()
 
+    def piece_ids_by_path(self, piece_path):
+        """
+        Return the ids of every piece added from a path; a file holding several scores adds several pieces
+            :param self:
+            :param piece_path: Path the pieces were added from
+        """
+        with sql_tracer.connect(self.dbpath) as conn:
+            return [row[0] for row in conn.execute("SELECT id FROM pieces WHERE path=? ORDER BY id", (piece_path, ))]
+
+    def remove_pieces(self, piece_ids):
+        """
+        Delete pieces with their parts, snippets and entries, and any stems left without entries.
+        Returns a dictionary with the number of rows deleted from each table
+            :param self:
+            :param piece_ids: Ids of the pieces to delete
+        """
+        with profiler.stage('sql.remove_pieces'), sql_tracer.connect(self.dbpath) as conn:
+            return self.delete_pieces(conn, piece_ids)
+
+    def remove_path(self, piece_path):
+        """
+        Delete every piece added from a path, as for remove_pieces
+            :param self:
+            :param piece_path: Path the pieces were added from
+        """
+        return self.remove_pieces(self.piece_ids_by_path(piece_path))
+
+    def replace_piece(self, piece, piece_path, explicit_repeats=False):
+        """
+        Update a piece in place, deleting every piece previously added from its path in the same transaction as adding it
+            :param self:
+            :param piece: Music21 stream representing the piece
+            :param piece_path: Original path to the piece
+            :param explicit_repeats=False: Expand repeats before indexing
+        """
+        self.add_scores([piece], piece_path, explicit_repeats, replace=True)
+
+    @staticmethod
+    def delete_pieces(conn, piece_ids):
+        """
+        Delete pieces and everything indexed from them, working outward from the piece ids through
+        piece_id and snippet_id indexes. Stems are deleted once their last entry is, so posting lists and
+        stem counts match a database the pieces were never added to. The caller commits, so the deletion
+        can share a transaction with adding the pieces back; on failure the transaction is rolled back.
+        Returns a dictionary with the number of rows deleted from each table
+            :param conn: Connection to sqlite instance
+            :param piece_ids: Ids of the pieces to delete
+        """
+        cursor = conn.cursor()
+        counts = {}
+        try:
+            cursor.execute("CREATE TEMP TABLE remove_pieces (id INTEGER PRIMARY KEY)")
+            cursor.executemany("INSERT OR IGNORE INTO temp.remove_pieces (id) VALUES (?)", [(int(piece_id), ) for piece_id in piece_ids])
+            cursor.execute("""CREATE TEMP TABLE remove_snippets AS
+                           SELECT id FROM snippets WHERE piece_id IN temp.remove_pieces""")
+            cursor.execute("""CREATE TEMP TABLE remove_stems AS
+                           SELECT DISTINCT stem_id AS id FROM entries WHERE snippet_id IN temp.remove_snippets""")
+            cursor.execute("DELETE FROM entries WHERE snippet_id IN temp.remove_snippets")
+            counts['entries'] = cursor.rowcount
+            cursor.execute("DELETE FROM snippets WHERE piece_id IN temp.remove_pieces")
+            counts['snippets'] = cursor.rowcount
+            cursor.execute("DELETE FROM part_notes WHERE part_id IN (SELECT id FROM parts WHERE piece_id IN temp.remove_pieces)")
+            cursor.execute("DELETE FROM parts WHERE piece_id IN temp.remove_pieces")
+            counts['parts'] = cursor.rowcount
+            cursor.execute("DELETE FROM pieces WHERE id IN temp.remove_pieces")
+            counts['pieces'] = cursor.rowcount
+            cursor.execute("""DELETE FROM stems WHERE id IN temp.remove_stems
+                           AND NOT EXISTS (SELECT 1 FROM entries WHERE entries.stem_id=stems.id)""")
+            counts['stems'] = cursor.rowcount
+            cursor.execute("""DELETE FROM stem_variants WHERE stem_id IN temp.remove_stems
+                           AND NOT EXISTS (SELECT 1 FROM stems WHERE stems.id=stem_variants.stem_id)""")
+            SqlIRSystem.invalidate_stem_filters(cursor)
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            for table in ('remove_pieces', 'remove_snippets', 'remove_stems'):
+                cursor.execute("DROP TABLE IF EXISTS temp.%s" % table)
+        return counts
+
+    @staticmethod
+    def delete_orphan_stems(conn):
+        """
+        Delete every stem without entries, as left by merging sources whose pieces were skipped
+        or by databases edited outside FIRMS. Returns the number of stems deleted
+            :param conn: Connection to sqlite instance
+        """
+        cursor = conn.execute("DELETE FROM stems WHERE NOT EXISTS (SELECT 1 FROM entries WHERE entries.stem_id=stems.id)")
+        deleted = cursor.rowcount
+        cursor.execute("DELETE FROM stem_variants WHERE NOT EXISTS (SELECT 1 FROM stems WHERE stems.id=stem_variants.stem_id)")
+        SqlIRSystem.invalidate_stem_filters(cursor)
+        conn.commit()
+        return deleted
+
+    @staticmethod
+    def invalidate_stem_filters(cursor):
+        """
+        After deleting stems, lower the stem id stored filters and fuzzy indexes are caught up to, and start a
+        new deletion epoch so loaded filters are reloaded. Sqlite reuses the ids of deleted rows at the end of
+        a table, so stems added later may get ids a filter or fuzzy index would otherwise skip
+            :param cursor: Cursor to use
+        """
+        cursor.execute("UPDATE stem_filters SET max_stem_id=min(max_stem_id, (SELECT coalesce(max(id), 0) FROM stems))")
+        cursor.execute("UPDATE fuzzy_indexes SET max_stem_id=min(max_stem_id, (SELECT coalesce(max(id), 0) FROM stems))")
+        cursor.execute("INSERT OR REPLACE INTO stem_filter_epoch (id, epoch) SELECT 0, coalesce(max(epoch), 0) + 1 FROM stem_filter_epoch")
+
     def pieces(self):
         """
         Return basic information on all pieces
             :param self:
         """
-        conn = sqlite3.connect(self.dbpath)
+        conn = sql_tracer.connect(self.dbpath)
         cursor = conn.cursor()
         cursor.execute("SELECT name, path, id FROM pieces")
         return cursor.fetchall()
 
+    def parts_with_notes(self):
+        """
+        Return a dictionary from (name, path, id) piece row to a list of (part id, part name)
+        for every part with a stored note sequence
+            :param self:
+        """
+        conn = sql_tracer.connect(self.dbpath)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT pieces.name, pieces.path, pieces.id, parts.id, parts.name FROM parts
+                        JOIN part_notes ON part_notes.part_id=parts.id
+                        JOIN pieces ON pieces.id=parts.piece_id
+                        ORDER BY pieces.id, parts.id""")
+        parts_by_piece = {}
+        for piece_name, piece_path, piece_id, part_id, part_name in cursor.fetchall():
+            parts_by_piece.setdefault((piece_name, piece_path, piece_id), []).append((part_id, part_name))
+        conn.close()
+        return parts_by_piece
+
+    def part_notes(self, part_id):
+        """
+        Return the encoded note sequence stored for a part
+            :param self:
+            :param part_id: Id of the part
+        """
+        conn = sql_tracer.connect(self.dbpath)
+        cursor = conn.cursor()
+        cursor.execute("SELECT notes FROM part_notes WHERE part_id=?", (part_id, ))
+        result = cursor.fetchone()
+        conn.close()
+        return result[0]
+
     def stemmers(self):
         """
         Return basic information on all stemmers
             :param self:
         """
-        conn = sqlite3.connect(self.dbpath)
+        conn = sql_tracer.connect(self.dbpath)
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM stemmers")
         return cursor.fetchall()
@@ -261,7 +842,7 @@ class SqlIRSystem(IRSystem):
         """
         tables = ["stemmers", "pieces", "parts", "snippets", "stems", "entries"]
         results = {}
-        conn = sqlite3.connect(self.dbpath)
+        conn = sql_tracer.connect(self.dbpath)
         cursor = conn.cursor()
         for table in tables:
             print("Querying table %s" % table)
@@ -269,19 +850,260 @@ class SqlIRSystem(IRSystem):
             results[table] = cursor.fetchone()[0]
         return results
 
+    def stem_filter_stats(self):
+        """
+        Return the size and estimated false positive rate of each stemmer's Bloom filter, building any not yet stored
+            :param self:
+        """
+        conn = self.read_connection()
+        cursor = conn.cursor()
+        version = self.stem_filter_version(cursor)
+        stats = []
+        for name, idx in self.indexes.items():
+            for snippet_length, stemmer_id in sorted(idx.stemmer_ids.items()):
+                idx.sync_filter(stemmer_id, version, conn, cursor)
+                stem_filter = idx.stem_filters.get(stemmer_id)
+                if stem_filter is not None:
+                    stats.append({
+                        'stemmer': name, 'snippet_length': snippet_length, 'stems': stem_filter.stems,
+                        'capacity': stem_filter.capacity, 'hashes': stem_filter.number_of_hashes,
+                        'bytes': stem_filter.memory_bytes(), 'false_positive_rate': stem_filter.false_positive_rate()
+                    })
+        cursor.close()
+        return stats
+
+    def stem_stats(self, top=10):
+        """
+        Return the posting length distribution and most frequent stems of each stemmer, and the bytes
+        used by each table and index, or None for the sizes if sqlite was built without dbstat.
+        Posting lengths are counted in one aggregate scan of the entries index, rather than per stem
+            :param self:
+            :param top=10: Number of most frequent stems to return per stemmer
+        """
+        import numpy as np
+        from firms.index_stats import summarize_postings
+        conn = sql_tracer.connect(self.dbpath)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name, snippet_length FROM stemmers ORDER BY name, snippet_length")
+        stemmers = cursor.fetchall()
+        stem_ids = {stemmer_id: array('q') for stemmer_id, _, _ in stemmers}
+        posting_lengths = {stemmer_id: array('q') for stemmer_id, _, _ in stemmers}
+        cursor.arraysize = 10000
+        cursor.execute("""SELECT stems.stemmer_id, entries.stem_id, count(*) FROM entries
+                          JOIN stems ON stems.id=entries.stem_id
+                          GROUP BY entries.stem_id""")
+        rows = cursor.fetchmany()
+        while rows:
+            for stemmer_id, stem_id, count in rows:
+                stem_ids[stemmer_id].append(stem_id)
+                posting_lengths[stemmer_id].append(count)
+            rows = cursor.fetchmany()
+        cursor.execute("""SELECT stems.stemmer_id, count(DISTINCT entries.snippet_id) FROM entries
+                          JOIN stems ON stems.id=entries.stem_id
+                          GROUP BY stems.stemmer_id""")
+        snippet_counts = dict(cursor.fetchall())
+        summaries = []
+        top_stem_ids = {}
+        for stemmer_id, name, snippet_length in stemmers:
+            lengths = np.frombuffer(posting_lengths[stemmer_id], np.int64)
+            summary = summarize_postings(lengths, snippet_counts.get(stemmer_id, 0))
+            summary.update(stemmer=name, snippet_length=snippet_length)
+            summaries.append(summary)
+            most_frequent = np.argsort(-lengths, kind='stable')[:top]
+            top_stem_ids[(name, snippet_length)] = [(stem_ids[stemmer_id][idx], int(lengths[idx])) for idx in most_frequent]
+        wanted = [stem_id for stems in top_stem_ids.values() for stem_id, _ in stems]
+        stem_names = {}
+        for idx in range(0, len(wanted), 500):
+            chunk = wanted[idx:idx + 500]
+            cursor.execute("SELECT id, stem FROM stems WHERE id IN (%s)" % ",".join("?" * len(chunk)), chunk)
+            stem_names.update(cursor.fetchall())
+        top_stems = {key: [(stem_names[stem_id], count) for stem_id, count in stems] for key, stems in top_stem_ids.items()}
+        try:
+            cursor.execute("SELECT name, sum(pgsize) FROM dbstat GROUP BY name ORDER BY sum(pgsize) DESC")
+            sizes = cursor.fetchall()
+        except sqlite3.OperationalError:
+            sizes = None
+        return {'stemmers': summaries, 'top_stems': top_stems, 'sizes': sizes}
+
+    def sql_stats(self, top, order_by='seconds'):
+        """
+        Return statistics saved by SQL tracing as lists of (statement, calls, seconds, max seconds, rows, plan),
+        (stemmer, snippet length, stem, calls, seconds, rows) and (stemmer, calls, seconds, rows) rows,
+        or None if nothing has been saved
+            :param self:
+            :param top: Number of statements and stems to return
+            :param order_by='seconds': Column to order statements and stems by, descending; one of seconds, calls or rows
+        """
+        if order_by not in ('seconds', 'calls', 'rows'):
+            raise ValueError("Cannot order SQL statistics by %s" % order_by)
+        conn = sql_tracer.connect(self.dbpath)
+        cursor = conn.cursor()
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='sql_statement_stats'")
+        if not cursor.fetchone()[0]:
+            return None
+        cursor.execute("SELECT statement, calls, seconds, max_seconds, rows, plan FROM sql_statement_stats ORDER BY %s DESC LIMIT ?" % order_by, (top,))
+        statements = cursor.fetchall()
+        cursor.execute("SELECT stemmer, snippet_length, stem, calls, seconds, rows FROM sql_stem_stats ORDER BY %s DESC LIMIT ?" % order_by, (top,))
+        stems = cursor.fetchall()
+        cursor.execute("""SELECT stemmer, sum(calls), sum(seconds), sum(rows) FROM sql_stem_stats
+                          GROUP BY stemmer ORDER BY sum(seconds) DESC""")
+        stemmers = cursor.fetchall()
+        return statements, stems, stemmers
+
+    def reset_sql_stats(self):
+        """
+        Discard statistics saved by SQL tracing
+            :param self:
+        """
+        conn = sql_tracer.connect(self.dbpath)
+        conn.execute("DROP TABLE IF EXISTS sql_statement_stats")
+        conn.execute("DROP TABLE IF EXISTS sql_stem_stats")
+        conn.commit()
+
+class AsyncConnectionPool:
+    """
+    A fixed-size pool of sqlite connections shared by asyncio tasks.
+    Blocking work borrows a connection and runs on one of the pool's threads. If the awaiting
+    task is cancelled, the running statement is interrupted and the connection is returned to
+    the pool once its thread finishes.
+    The pool is bound to the event loop that first uses it.
+    """
+    def __init__(self, dbpath, size):
+        """
+        Constructor
+            :param self:
+            :param dbpath: Path to the sqlite database file
+            :param size: Number of connections and threads
+        """
+        self.dbpath = dbpath
+        self.size = size
+        self.executor = None
+        self.connections = None
+
+    async def run(self, fn):
+        """
+        Run fn(conn) on a pool thread with a borrowed connection, waiting for a free connection if needed
+            :param self:
+            :param fn: Function from connection to result
+        """
+        import asyncio
+        if self.connections is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(self.size, thread_name_prefix='firms-aquery')
+            self.connections = asyncio.Queue()
+            for _ in range(self.size):
+                self.connections.put_nowait(sql_tracer.connect(self.dbpath, check_same_thread=False))
+        conn = await self.connections.get()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, fn, conn)
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            conn.interrupt()
+            future.add_done_callback(lambda done: self.release(conn, done))
+            raise
+        except Exception:
+            self.connections.put_nowait(conn)
+            raise
+        self.connections.put_nowait(conn)
+        return result
+
+    def release(self, conn, done):
+        """
+        Return a connection whose work was abandoned, discarding the interrupted result
+            :param self:
+            :param conn: Connection to return
+            :param done: Finished future of the abandoned work
+        """
+        done.exception()
+        self.connections.put_nowait(conn)
+
 class SqlIndex(FirmIndex):
-    def __init__(self, dbpath, snippets, keyfn, name, stemmer_id):
+    def __init__(self, dbpath, snippets, keyfn, name, stemmer_ids, stem_filters=True):
+        """
+        Constructor
+            :param self:
+            :param dbpath: Path to the sqlite database file
+            :param snippets: List of snippets to add to index
+            :param keyfn: Stemming method
+            :param name: Name of the stemming method
+            :param stemmer_ids: Dictionary from snippet length to the stemmer id used for that length
+            :param stem_filters=True: Skip lookups of stems missing from the stemmer's Bloom filter
+        """
         self.dbpath = dbpath
-        self.stemmer_id = stemmer_id
-        super().__init__(snippets, keyfn, name)
-    
+        self.stemmer_ids = stemmer_ids
+        self.use_stem_filters = stem_filters
+        # Dictionary from stemmer id to StemFilter, loaded or built by sync_filter
+        self.stem_filters = {}
+        self.stem_filters_lock = threading.Lock()
+        # Dictionary from stemmer id to StemVariants of the stems the stored fuzzy index doesn't cover, built by sync_variants
+        self.fuzzy_variants = {}
+        self.fuzzy_variants_lock = threading.Lock()
+        super().__init__(snippets, keyfn, name, stemmer_ids.keys())
+
+    @staticmethod
+    def load_filter(stemmer_id, cursor):
+        row = cursor.execute("SELECT capacity, hashes, bits, stems, max_stem_id FROM stem_filters WHERE stemmer_id=?", (stemmer_id, )).fetchone()
+        return StemFilter(*row) if row else None
+
+    @staticmethod
+    def save_filter(stemmer_id, stem_filter, conn, cursor):
+        cursor.execute("INSERT OR REPLACE INTO stem_filters (stemmer_id, capacity, hashes, stems, max_stem_id, bits) VALUES (?, ?, ?, ?, ?, ?)",
+                       (stemmer_id, stem_filter.capacity, stem_filter.number_of_hashes, stem_filter.stems, stem_filter.max_stem_id, bytes(stem_filter.bits)))
+
+    @staticmethod
+    def catch_up_filter(stemmer_id, stem_filter, max_stem_id, cursor):
+        """
+        Add the stemmer's stems with ids above those the filter covers, up to max_stem_id
+        """
+        cursor.execute("SELECT id, stem FROM stems WHERE stemmer_id=? AND id>? AND id<=?", (stemmer_id, stem_filter.max_stem_id, max_stem_id))
+        for stem_id, stem in cursor.fetchall():
+            stem_filter.add(stem, stem_id)
+        stem_filter.max_stem_id = max_stem_id
+
+    def build_filter(self, stemmer_id, max_stem_id, cursor):
+        with profiler.stage('sql.build_stem_filter'):
+            number_of_stems = cursor.execute("SELECT count(*) FROM stems WHERE stemmer_id=?", (stemmer_id, )).fetchone()[0]
+            stem_filter = StemFilter.for_stems(number_of_stems)
+            self.catch_up_filter(stemmer_id, stem_filter, max_stem_id, cursor)
+        return stem_filter
+
+    def sync_filter(self, stemmer_id, version, conn, cursor, save=False):
+        """
+        Bring a stemmer's filter up to date with the stems table, loading it on first use.
+        Stems added since the filter was stored, by this or another connection, are added to it; a filter that
+        has outgrown its capacity, or was never stored, is rebuilt. Only ingest saves filters, so queries never
+        write to the database and usually only check the version. Filters loaded before stems were deleted are reloaded.
+            :param self:
+            :param stemmer_id: Id of the stemmer and snippet length
+            :param version: (Largest stem id, stem deletion epoch) as returned by SqlIRSystem.stem_filter_version
+            :param conn: Connection to sqlite instance
+            :param cursor: Cursor to use
+            :param save=False: Store the updated filter, without committing; otherwise it is only kept in memory
+        """
+        if not self.use_stem_filters:
+            return
+        max_stem_id, epoch = version
+        with self.stem_filters_lock:
+            stem_filter = self.stem_filters.get(stemmer_id)
+            if stem_filter is None or stem_filter.epoch != epoch:
+                stem_filter = self.load_filter(stemmer_id, cursor)
+            if stem_filter is not None and stem_filter.max_stem_id < max_stem_id:
+                self.catch_up_filter(stemmer_id, stem_filter, max_stem_id, cursor)
+                if save and not stem_filter.full():
+                    self.save_filter(stemmer_id, stem_filter, conn, cursor)
+            if stem_filter is None or stem_filter.full():
+                stem_filter = self.build_filter(stemmer_id, max_stem_id, cursor)
+                if save:
+                    self.save_filter(stemmer_id, stem_filter, conn, cursor)
+            stem_filter.epoch = epoch
+            self.stem_filters[stemmer_id] = stem_filter
+
     def ensure_stem(self, stemmer_id, stem, conn, cursor):
         cursor.execute("SELECT id FROM stems WHERE stemmer_id=? AND stem=? LIMIT 1", (stemmer_id, stem))
         results = cursor.fetchall()
         if results:
             return results[0][0]
         cursor.execute("INSERT INTO stems (stemmer_id, stem) VALUES (?, ?)", (stemmer_id, stem))
-        conn.commit()
         return cursor.lastrowid
 
     def ensure_entry(self, stem_id, snippet_id, conn, cursor):
@@ -290,47 +1112,275 @@ class SqlIndex(FirmIndex):
         if results:
             return results[0][0]
         cursor.execute("INSERT INTO entries (stem_id, snippet_id) VALUES (?, ?)", (stem_id, snippet_id))
-        conn.commit()
         return cursor.lastrowid
     
     def ensure_entries(self, stem_ids, snippet_ids, conn, cursor):
         values = list(zip(stem_ids, snippet_ids))
         cursor.executemany("INSERT OR IGNORE INTO entries (stem_id, snippet_id) VALUES (?, ?)", values)
-        conn.commit()
         return [r[0] for value in values for r in cursor.execute("SELECT id FROM entries WHERE stem_id=? AND snippet_id=? LIMIT 1", value)]
 
     def ensure_stems(self, stemmer_id, stems, conn, cursor):
         values = [ (stemmer_id, stem) for stem in stems ]
         cursor.executemany("INSERT OR IGNORE INTO stems (stemmer_id, stem) VALUES (?, ?)", values)
-        conn.commit()
         return [r[0] for value in values for r in cursor.execute("SELECT id FROM stems WHERE stemmer_id=? AND stem=? LIMIT 1", value)]
 
     def add_snippets(self, snippets, snippet_ids, conn, cursor):
-        stems = [self.keyfn(snippet)[0] for snippet in snippets]
-        stem_ids = self.ensure_stems(self.stemmer_id, stems, conn, cursor)
-        return self.ensure_entries(stem_ids, snippet_ids, conn, cursor)
+        """
+        Add several snippets, all of the same length
+        """
+        if not snippets:
+            return []
+        stemmer_id = self.stemmer_ids[len(snippets[0].notes)]
+        with profiler.stage(self.stem_stage):
+            stems = [self.keyfn(snippet)[0] for snippet in snippets]
+        profiler.count('stems generated', len(stems))
+        with profiler.stage('sql.insert_stems'):
+            stem_ids = self.ensure_stems(stemmer_id, stems, conn, cursor)
+            return self.ensure_entries(stem_ids, snippet_ids, conn, cursor)
 
     def add_snippet(self, snippet, snippet_id, conn, cursor):
         stems = self.keyfn(snippet)
         for stem in stems:
-            stem_id = self.ensure_stem(self.stemmer_id, stem, conn, cursor)
+            stem_id = self.ensure_stem(self.stemmer_ids[len(snippet.notes)], stem, conn, cursor)
             entry_id = self.ensure_entry(stem_id, snippet_id, conn, cursor)
         return entry_id
 
     def lookup(self, snippet, conn, cursor):
-        cursor.arraysize = 1000
-        results = []
-        stems = self.keyfn(snippet)
-        for stem in stems:
-            cursor.execute("""SELECT snippets.id, pieces.name, snippets.part_id as part, snippets.offset, stems.id, pieces.path, pieces.id FROM snippets
+        matches = LookupResult()
+        for stem in self.keyfn(snippet):
+            matches.extend(self.lookup_stem(stem, len(snippet.notes), conn, cursor))
+        return matches
+
+    def ensure_fuzzy_index(self, stemmer_id, max_distance, conn, cursor):
+        """
+        Ensure the stemmer's deletion variants are stored for every stem, for distances up to max_distance.
+        Builds the index, extends it to larger distances, and adds stems indexed since it was last updated, without committing.
+        Only ingest and SqlIRSystem.build_fuzzy_indexes call this, with the database's write lock held
+            :param self:
+            :param stemmer_id: Id of the stemmer and snippet length
+            :param max_distance: Largest edit distance fuzzy lookups will use
+            :param conn: Connection to sqlite instance
+            :param cursor: Cursor to use
+        """
+        row = cursor.execute("SELECT max_distance, max_stem_id FROM fuzzy_indexes WHERE stemmer_id=?", (stemmer_id, )).fetchone()
+        built_distance, covered_stem_id = row or (0, 0)
+        max_stem_id = cursor.execute("SELECT coalesce(max(id), 0) FROM stems").fetchone()[0]
+        if built_distance >= max_distance and covered_stem_id >= max_stem_id:
+            return
+        with profiler.stage('sql.build_fuzzy_index'):
+            if built_distance < max_distance:
+                self.add_stem_variants(stemmer_id, built_distance + 1, max_distance, 0, covered_stem_id, cursor)
+            distance = max(built_distance, max_distance)
+            self.add_stem_variants(stemmer_id, 1, distance, covered_stem_id, max_stem_id, cursor)
+            cursor.execute("INSERT OR REPLACE INTO fuzzy_indexes (stemmer_id, max_distance, max_stem_id) VALUES (?, ?, ?)",
+                           (stemmer_id, distance, max_stem_id))
+
+    def sync_variants(self, stemmer_id, max_distance, after_stem_id, version, cursor):
+        """
+        Bring the in-memory deletion variants of a stemmer's stems with ids above after_stem_id up to date
+        with the stems table, and return them. Queries never write the stored fuzzy index, so stems it doesn't
+        cover, or all of them if it isn't built for max_distance, are varied in memory instead
+            :param self:
+            :param stemmer_id: Id of the stemmer and snippet length
+            :param max_distance: Largest edit distance of the lookup
+            :param after_stem_id: Largest stem id the stored fuzzy index covers, or 0
+            :param version: (Largest stem id, stem deletion epoch) as returned by SqlIRSystem.stem_filter_version
+            :param cursor: Cursor to use
+        """
+        max_stem_id, epoch = version
+        with self.fuzzy_variants_lock:
+            variants = self.fuzzy_variants.get(stemmer_id)
+            if variants is None or variants.epoch != epoch or variants.after_stem_id != after_stem_id or variants.max_distance < max_distance:
+                variants = StemVariants(max_distance, after_stem_id, epoch)
+            if variants.max_stem_id < max_stem_id:
+                with profiler.stage('sql.build_fuzzy_variants'):
+                    cursor.execute("SELECT id, stem FROM stems WHERE stemmer_id=? AND id>? AND id<=?", (stemmer_id, variants.max_stem_id, max_stem_id))
+                    for stem_id, stem in cursor.fetchall():
+                        variants.add(stem_id, stem)
+                    variants.max_stem_id = max_stem_id
+            self.fuzzy_variants[stemmer_id] = variants
+            return variants
+
+    def fuzzy_candidates(self, stemmer_id, variants, max_distance, cursor, limit=MAX_FUZZY_CANDIDATES):
+        """
+        Return a dictionary from stem id to stem of at most limit of the stemmer's stems sharing a deletion variant with
+        a query stem, from the stored fuzzy index where it is built for max_distance, and from variants kept in memory otherwise
+            :param self:
+            :param stemmer_id: Id of the stemmer and snippet length
+            :param variants: List of deletion variants of the query stem
+            :param max_distance: Largest edit distance of the lookup
+            :param cursor: Cursor to use
+            :param limit=MAX_FUZZY_CANDIDATES: Largest number of stems to return
+        """
+        if not variants:
+            return {}
+        version = SqlIRSystem.stem_filter_version(cursor)
+        row = cursor.execute("SELECT max_distance, max_stem_id FROM fuzzy_indexes WHERE stemmer_id=?", (stemmer_id, )).fetchone()
+        built_distance, covered_stem_id = row or (0, 0)
+        if built_distance < max_distance:
+            covered_stem_id = 0
+        candidates = {}
+        if covered_stem_id:
+            for start in range(0, len(variants), MAX_SQL_PARAMETERS):
+                chunk = variants[start:start + MAX_SQL_PARAMETERS]
+                cursor.execute("""SELECT DISTINCT stems.id, stems.stem FROM stem_variants
+                               JOIN stems ON stems.id=stem_variants.stem_id
+                               WHERE stem_variants.stemmer_id=? AND stem_variants.stem_id<=? AND stem_variants.variant IN (%s)
+                               LIMIT ?""" % ','.join('?' * len(chunk)),
+                               [stemmer_id, covered_stem_id] + chunk + [limit - len(candidates)])
+                candidates.update(cursor.fetchall())
+                if len(candidates) >= limit:
+                    return candidates
+        if covered_stem_id < version[0]:
+            profiler.count('fuzzy lookups of unindexed stems')
+            stored_variants = self.sync_variants(stemmer_id, max_distance, covered_stem_id, version, cursor)
+            candidates.update(stored_variants.candidates(variants, limit - len(candidates)))
+        return candidates
+
+    @staticmethod
+    def add_stem_variants(stemmer_id, min_distance, max_distance, after_stem_id, max_stem_id, cursor):
+        """
+        Store the variants of a stemmer's stems with ids in (after_stem_id, max_stem_id], deleting
+        between min_distance and max_distance tokens
+        """
+        stems = cursor.execute("SELECT id, stem FROM stems WHERE stemmer_id=? AND id>? AND id<=?", (stemmer_id, after_stem_id, max_stem_id)).fetchall()
+        cursor.executemany("INSERT INTO stem_variants (stemmer_id, variant, stem_id) VALUES (?, ?, ?)", (
+            (stemmer_id, variant, stem_id)
+            for stem_id, stem in stems
+            for variant in stem_variants(stem, max_distance, min_distance)
+        ))
+
+    def fetch_matches(self, cursor, condition, parameters, piece_ids=None, budget=None, query_stem=None):
+        """
+        Fetch the matches of the postings meeting a condition, as a LookupResult.
+        With a budget, rows are fetched only while the budget allows, so a lookup may return part of its matches.
+        Piece ids are passed in chunks, so together with the condition's parameters they fit in MAX_SQL_PARAMETERS
+            :param self:
+            :param cursor: Cursor to use
+            :param condition: SQL condition on the snippets, entries, stems and pieces tables
+            :param parameters: Parameters of the condition
+            :param piece_ids=None: Collection of piece ids to fetch matches from; defaults to every piece
+            :param budget=None: QueryBudget of the query; unlimited if None
+            :param query_stem=None: QueryStem looked up, whose rows count against the budget's rows per stem
+        """
+        if budget is not None and budget.exhausted():
+            profiler.count('lookups truncated')
+            return LookupResult()
+        if piece_ids is None:
+            statements = [(condition, parameters)]
+        else:
+            piece_ids = list(piece_ids)
+            chunk_size = MAX_SQL_PARAMETERS - len(parameters)
+            statements = [
+                ("%s AND snippets.piece_id IN (%s)" % (condition, ','.join('?' * len(chunk))), list(parameters) + chunk)
+                for chunk in (piece_ids[start:start + chunk_size] for start in range(0, len(piece_ids), chunk_size))
+            ]
+        # A per stem limit is checked once a batch is fetched, so batches don't run far past it
+        cursor.arraysize = min(1000, budget.max_rows_per_stem + 1) if budget is not None and budget.max_rows_per_stem is not None else 1000
+        results = LookupResult()
+        for statement_condition, statement_parameters in statements:
+            cursor.execute("""SELECT snippets.id, snippets.piece_id, snippets.part_id, snippets.offset, stems.id FROM snippets
                             JOIN entries ON entries.snippet_id=snippets.id
                             JOIN stems ON stems.id=entries.stem_id
-                            JOIN pieces ON pieces.id=snippets.piece_id
-                            WHERE stems.stem=?
-                            AND stems.stemmer_id=?""", (stem, self.stemmer_id))
+                            WHERE %s""" % statement_condition, statement_parameters)
             result = cursor.fetchmany()
             while result:
-                results.append([ {'id': r[0], 'piece': r[5], 'part': r[2], 'offset': r[3], 'stem': r[4], 'path': r[5], 'piece_id': r[6]} for r in result ])
+                if budget is not None:
+                    allowed = budget.take(len(result), query_stem)
+                    if allowed < len(result):
+                        results.extend_rows(result[:allowed])
+                        profiler.count('lookups truncated')
+                        return results
+                results.extend_rows(result)
                 result = cursor.fetchmany()
+        return results
 
-        return list(chain.from_iterable(results))
+    def lookup_fuzzy(self, stem, snippet_length, conn, cursor, max_distance, piece_ids=None, budget=None):
+        """
+        Look up a stem and every indexed stem within max_distance token edits of it.
+        The distance and stem string of each other stem matched are in the result's matched_stems.
+        Variants with fewer deletions are looked up first, and at most MAX_FUZZY_CANDIDATES stems verified; the rows of at
+        most MAX_FUZZY_NEIGHBOURS of the nearest stems, or fewer if the budget's rows per stem run out first, are fetched
+            :param self:
+            :param stem: Query stem
+            :param snippet_length: Snippet length of the stem
+            :param conn: Connection to sqlite instance
+            :param cursor: Cursor to use
+            :param max_distance: Largest edit distance, capped at MAX_FUZZY_DISTANCE
+            :param piece_ids=None: Collection of piece ids to fetch matches from; defaults to every piece
+            :param budget=None: QueryBudget of the query; unlimited if None
+        """
+        max_distance = min(max_distance, MAX_FUZZY_DISTANCE)
+        stemmer_id = self.stemmer_ids[snippet_length]
+        query_stem = QueryStem(self.name, snippet_length, stem)
+        matches = self.lookup_stem(stem, snippet_length, conn, cursor, piece_ids=piece_ids, budget=budget)
+        if budget is not None and budget.exhausted():
+            profiler.count('lookups truncated')
+            return matches
+        with profiler.stage('sql.lookup_fuzzy'):
+            candidates = {}
+            for number_of_deletions in range(1, max_distance + 1):
+                variants = list(stem_variants(stem, number_of_deletions, number_of_deletions))
+                candidates.update(self.fuzzy_candidates(stemmer_id, variants, max_distance, cursor, MAX_FUZZY_CANDIDATES - len(candidates)))
+                if len(candidates) >= MAX_FUZZY_CANDIDATES:
+                    profiler.count('fuzzy candidates truncated')
+                    break
+            profiler.count('fuzzy candidates', len(candidates))
+            tokens = tokenize_stem(stem)
+            neighbours = []
+            for stem_id, candidate in candidates.items():
+                if candidate == stem:
+                    continue
+                distance = token_edit_distance(tokens, tokenize_stem(candidate))
+                if distance <= max_distance:
+                    neighbours.append((distance, stem_id, candidate))
+            # Every neighbour has postings, so no more of them than the rows left to the lookup are fetched
+            limit = MAX_FUZZY_NEIGHBOURS
+            rows_left = budget.stem_rows_left(query_stem) if budget is not None else None
+            if rows_left is not None:
+                limit = min(limit, rows_left)
+            if len(neighbours) > limit:
+                profiler.count('fuzzy neighbours truncated')
+                if budget is not None:
+                    budget.truncated = True
+                neighbours = sorted(neighbours)[:limit]
+            # Half the parameters are left to the piece ids of two-stage queries
+            chunk_size = MAX_SQL_PARAMETERS // 2
+            for start in range(0, len(neighbours), chunk_size):
+                chunk = {stem_id: (distance, candidate) for distance, stem_id, candidate in neighbours[start:start + chunk_size]}
+                # The exact and neighbouring stems share one lookup's rows per stem
+                fuzzy_matches = self.fetch_matches(cursor, "stems.id IN (%s)" % ','.join('?' * len(chunk)), list(chunk), piece_ids, budget, query_stem)
+                fuzzy_matches.matched_stems = chunk
+                profiler.count('fuzzy matches', len(fuzzy_matches))
+                matches.extend(fuzzy_matches)
+        return matches
+
+    def lookup_stem(self, stem, snippet_length, conn, cursor, max_distance=0, piece_ids=None, budget=None):
+        """
+        Look up a stem, returning a LookupResult
+            :param self:
+            :param stem: Query stem
+            :param snippet_length: Snippet length of the stem
+            :param conn: Connection to sqlite instance
+            :param cursor: Cursor to use
+            :param max_distance=0: Also match stems within this many token edits; see lookup_fuzzy
+            :param piece_ids=None: Collection of piece ids to fetch matches from; defaults to every piece
+            :param budget=None: QueryBudget limiting the rows fetched and the time spent; unlimited if None
+        """
+        if max_distance:
+            return self.lookup_fuzzy(stem, snippet_length, conn, cursor, max_distance, piece_ids, budget)
+        start = time.perf_counter()
+        stem_filter = self.stem_filters.get(self.stemmer_ids[snippet_length])
+        if stem_filter is not None and stem not in stem_filter:
+            profiler.count('lookups skipped by filter')
+            return LookupResult()
+        with profiler.stage('sql.lookup'):
+            matches = self.fetch_matches(cursor, "stems.stem=? AND stems.stemmer_id=?", (stem, self.stemmer_ids[snippet_length]), piece_ids, budget,
+                                         QueryStem(self.name, snippet_length, stem))
+        profiler.count('lookups')
+        profiler.count('rows fetched', len(matches))
+        if stem_filter is not None and not matches:
+            profiler.count('filter false positives')
+        if sql_tracer.enabled:
+            sql_tracer.record_stem(self.dbpath, self.name, snippet_length, stem, time.perf_counter() - start, len(matches))
+        return matches
@@ -0,0 +1,317 @@
+"""
+Optional tracing of the SQL statements FIRMS issues.
+
+Connections opened through `sql_tracer.connect` are plain sqlite3 connections while tracing is
+disabled. Once enabled, they time every statement from execute until its rows are exhausted,
+count rows returned or changed, capture `EXPLAIN QUERY PLAN` the first time each statement is
+seen, and log statements slower than a threshold, with their bound values, to a JSON lines file.
+Index lookups are also recorded per stemmer and stem. Statistics accumulate in memory and are
+merged into tables in the traced database by `save`, where `firms info sql` reads them.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Statements that EXPLAIN QUERY PLAN can describe
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+def normalize_statement(sql):
+    return ' '.join(sql.split())
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    Cursor reporting each statement it runs to the connection's tracer
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = None
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        tracer = self.connection.tracer
+        statement = normalize_statement(sql)
+        tracer.explain(self.connection, statement, parameters)
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self.pending = [statement, parameters, time.perf_counter() - start, 0, self.connection.last_statement]
+        if not self.description:
+            # Nothing to fetch, so the statement is already complete
+            self.pending[3] = max(self.rowcount, 0)
+            self.finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish()
+        seq_of_parameters = list(seq_of_parameters)
+        statement = normalize_statement(sql)
+        if seq_of_parameters:
+            self.connection.tracer.explain(self.connection, statement, seq_of_parameters[0])
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self.pending = [statement, seq_of_parameters[:1], time.perf_counter() - start, max(self.rowcount, 0), self.connection.last_statement]
+        self.finish()
+        return self
+
+    def fetched(self, start, rows, exhausted):
+        if self.pending:
+            self.pending[2] = self.pending[2] + time.perf_counter() - start
+            self.pending[3] = self.pending[3] + rows
+            if exhausted:
+                self.finish()
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.fetched(start, 0, True)
+            raise
+        self.fetched(start, 1, False)
+        return row
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(start, 0 if row is None else 1, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        size = self.arraysize if size is None else size
+        rows = super().fetchmany(size)
+        self.fetched(start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(start, len(rows), True)
+        return rows
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def finish(self):
+        """
+        Report the pending statement, if any
+            :param self:
+        """
+        if self.pending:
+            pending, self.pending = self.pending, None
+            self.connection.tracer.record(self.connection.dbpath, *pending)
+
+    def __del__(self):
+        try:
+            self.finish()
+        except Exception:
+            pass
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors report to a SqlTracer
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tracer = None
+        self.dbpath = None
+        self.last_statement = None
+        # Keep the statement text with bound values expanded, for the slow query log
+        self.set_trace_callback(self.on_statement)
+
+    def on_statement(self, statement):
+        self.last_statement = statement
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection's shortcuts create cursors without calling cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        super().commit()
+        self.tracer.record(self.dbpath, 'COMMIT', (), time.perf_counter() - start, 0, 'COMMIT')
+
+class SqlTracer:
+    """
+    Collects per-statement and per-stem statistics from traced connections
+    """
+    def __init__(self):
+        """
+        Constructor
+            :param self:
+        """
+        self.enabled = False
+        self.slow_seconds = None
+        self.slow_log = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self, slow_ms=100, slow_log=None):
+        """
+        Trace connections opened from now on
+            :param self:
+            :param slow_ms=100: Statements taking longer than this many milliseconds are logged
+            :param slow_log=None: Path of the JSON lines slow query log; slow statements aren't logged if None
+        """
+        self.enabled = True
+        self.slow_seconds = slow_ms / 1000
+        self.slow_log = slow_log
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            # dbpath -> statement -> [calls, seconds, max seconds, rows]
+            self.statements = {}
+            # dbpath -> (stemmer, snippet length, stem) -> [calls, seconds, rows]
+            self.stems = {}
+            # dbpath -> statement -> list of plan details
+            self.plans = {}
+
+    def connect(self, dbpath, **kwargs):
+        """
+        Open a connection, traced if tracing is enabled
+            :param self:
+            :param dbpath: Path to the sqlite database file
+            :param **kwargs: Passed on to sqlite3.connect
+        """
+        if not self.enabled:
+            return sqlite3.connect(dbpath, **kwargs)
+        conn = sqlite3.connect(dbpath, factory=TracedConnection, **kwargs)
+        conn.tracer = self
+        conn.dbpath = dbpath
+        return conn
+
+    def explain(self, conn, statement, parameters):
+        """
+        Capture the query plan of a statement the first time it is seen
+            :param self:
+            :param conn: Connection the statement runs on
+            :param statement: Normalized statement
+            :param parameters: Parameters the statement runs with
+        """
+        plans = self.plans.setdefault(conn.dbpath, {})
+        if statement in plans:
+            return
+        plan = []
+        if statement.upper().startswith(EXPLAINABLE):
+            try:
+                plan = [row[-1] for row in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()]
+            except sqlite3.Error:
+                pass
+        plans[statement] = plan
+
+    def record(self, dbpath, statement, parameters, seconds, rows, expanded_statement):
+        """
+        Record one run of a statement
+            :param self:
+            :param dbpath: Database the statement ran against
+            :param statement: Normalized statement
+            :param parameters: Parameters of the statement
+            :param seconds: Time from execute until the last row was fetched
+            :param rows: Rows returned, or changed for statements that return none
+            :param expanded_statement: Statement with bound values, as reported by the trace callback
+        """
+        with self.lock:
+            stats = self.statements.setdefault(dbpath, {}).setdefault(statement, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] += rows
+            if self.slow_log and seconds > self.slow_seconds:
+                with open(self.slow_log, 'a') as outf:
+                    outf.write(json.dumps({
+                        'time': time.time(),
+                        'db': dbpath,
+                        'ms': seconds * 1000,
+                        'rows': rows,
+                        'statement': expanded_statement or statement,
+                        'plan': self.plans.get(dbpath, {}).get(statement, [])
+                    }) + "\n")
+
+    def record_stem(self, dbpath, stemmer, snippet_length, stem, seconds, rows):
+        """
+        Record one index lookup of a stem
+            :param self:
+            :param dbpath: Database looked up
+            :param stemmer: Name of the stemmer
+            :param snippet_length: Snippet length the stem was produced at
+            :param stem: The stem
+            :param seconds: Time taken by the lookup
+            :param rows: Rows returned
+        """
+        with self.lock:
+            stats = self.stems.setdefault(dbpath, {}).setdefault((stemmer, snippet_length, stem), [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += rows
+
+    def save(self):
+        """
+        Merge collected statistics into the sql_statement_stats and sql_stem_stats tables of each
+        traced database that still exists, then clear them
+            :param self:
+        """
+        with self.lock:
+            statements, stems, plans = self.statements, self.stems, self.plans
+            self.statements, self.stems, self.plans = {}, {}, {}
+        for dbpath in set(statements) | set(stems):
+            if not os.path.exists(dbpath):
+                # e.g. a temporary index removed by `firms bench`
+                continue
+            conn = sqlite3.connect(dbpath)
+            ensure_stats_tables(conn)
+            conn.executemany("""INSERT INTO sql_statement_stats (statement, calls, seconds, max_seconds, rows, plan)
+                                VALUES (?, ?, ?, ?, ?, ?)
+                                ON CONFLICT(statement) DO UPDATE SET
+                                    calls=calls + excluded.calls,
+                                    seconds=seconds + excluded.seconds,
+                                    max_seconds=max(max_seconds, excluded.max_seconds),
+                                    rows=rows + excluded.rows,
+                                    plan=excluded.plan""",
+                             [(statement, calls, seconds, max_seconds, rows, json.dumps(plans.get(dbpath, {}).get(statement, [])))
+                              for statement, (calls, seconds, max_seconds, rows) in statements.get(dbpath, {}).items()])
+            conn.executemany("""INSERT INTO sql_stem_stats (stemmer, snippet_length, stem, calls, seconds, rows)
+                                VALUES (?, ?, ?, ?, ?, ?)
+                                ON CONFLICT(stemmer, snippet_length, stem) DO UPDATE SET
+                                    calls=calls + excluded.calls,
+                                    seconds=seconds + excluded.seconds,
+                                    rows=rows + excluded.rows""",
+                             [key + tuple(stats) for key, stats in stems.get(dbpath, {}).items()])
+            conn.commit()
+            conn.close()
+
+def ensure_stats_tables(conn):
+    """
+    Ensure the tables holding saved tracing statistics exist
+        :param conn: Connection to sqlite instance
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS sql_statement_stats (statement TEXT PRIMARY KEY,
+                                            calls INTEGER NOT NULL,
+                                            seconds REAL NOT NULL,
+                                            max_seconds REAL NOT NULL,
+                                            rows INTEGER NOT NULL,
+                                            plan TEXT NOT NULL
+                    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS sql_stem_stats (stemmer TEXT NOT NULL,
+                                            snippet_length INTEGER NOT NULL,
+                                            stem TEXT NOT NULL,
+                                            calls INTEGER NOT NULL,
+                                            seconds REAL NOT NULL,
+                                            rows INTEGER NOT NULL,
+                                            PRIMARY KEY (stemmer, snippet_length, stem)
+                    )""")
+    conn.commit()
+
+# The tracer used by every SqlIRSystem connection
+sql_tracer = SqlTracer()
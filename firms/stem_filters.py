@@ -0,0 +1,98 @@
+"""
+Bloom filters over the stems of a stemmer, used to skip lookups for stems that are not indexed
+"""
+
+from hashlib import blake2b
+import math
+
+# Target false positive rate when a filter is sized
+FALSE_POSITIVE_RATE = 0.01
+# Filters are sized for this many times the stems they start with, so ingest can add stems without a rebuild
+GROWTH = 1.5
+MINIMUM_CAPACITY = 1024
+
+def filter_shape(capacity, false_positive_rate=FALSE_POSITIVE_RATE):
+    """
+    Return the (number of bits, number of hashes) giving a false positive rate for a number of stems
+        :param capacity: Number of stems the filter must hold
+        :param false_positive_rate=FALSE_POSITIVE_RATE: Target false positive rate at capacity
+    """
+    number_of_bits = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+    number_of_bits = 8 * math.ceil(number_of_bits / 8)
+    return number_of_bits, max(1, round(number_of_bits / capacity * math.log(2)))
+
+class StemFilter:
+    """
+    A Bloom filter over stem strings. Never reports an added stem as missing; reports a missing
+    stem as present with a small probability, which only costs the lookup the filter would have saved.
+    Records the largest stem id it covers, so stems added later can be caught up incrementally.
+    """
+    def __init__(self, capacity, number_of_hashes=None, bits=None, stems=0, max_stem_id=0):
+        """
+        Constructor
+            :param self:
+            :param capacity: Number of stems the filter is sized for
+            :param number_of_hashes=None: Number of bit positions per stem; chosen from capacity if not given
+            :param bits=None: Stored bit array; empty if not given
+            :param stems=0: Number of stems added to the stored bits
+            :param max_stem_id=0: Largest stems.id added to the stored bits
+        """
+        number_of_bits, default_hashes = filter_shape(capacity)
+        self.capacity = capacity
+        self.number_of_hashes = number_of_hashes or default_hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray(number_of_bits // 8)
+        self.number_of_bits = 8 * len(self.bits)
+        self.stems = stems
+        self.max_stem_id = max_stem_id
+        # Stem deletion epoch the filter was loaded in; see SqlIRSystem.stem_filter_version
+        self.epoch = None
+
+    @classmethod
+    def for_stems(cls, number_of_stems):
+        """
+        Create an empty filter with room for a number of stems and for growth
+            :param number_of_stems: Number of stems about to be added
+        """
+        return cls(max(MINIMUM_CAPACITY, math.ceil(number_of_stems * GROWTH)))
+
+    def positions(self, stem):
+        # Double hashing: k positions from two 64 bit halves of one digest
+        digest = blake2b(stem.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.number_of_bits for i in range(self.number_of_hashes))
+
+    def add(self, stem, stem_id=0):
+        """
+        Add a stem to the filter
+            :param self:
+            :param stem: Stem string
+            :param stem_id=0: Id of the stem in the stems table
+        """
+        bits = self.bits
+        for position in self.positions(stem):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.stems = self.stems + 1
+        self.max_stem_id = max(self.max_stem_id, stem_id)
+
+    def __contains__(self, stem):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(stem))
+
+    def full(self):
+        """
+        Whether the filter holds more stems than it was sized for, so its false positive rate exceeds the target
+            :param self:
+        """
+        return self.stems > self.capacity
+
+    def memory_bytes(self):
+        return len(self.bits)
+
+    def false_positive_rate(self):
+        """
+        Estimate the chance a missing stem is reported as present, from the fraction of bits set
+            :param self:
+        """
+        bits_set = bin(int.from_bytes(self.bits, 'little')).count('1')
+        return (bits_set / self.number_of_bits) ** self.number_of_hashes
@@ -8,9 +8,7 @@ Internally, most stemming functions work on either individual notes or pairwise
 from itertools import islice, chain
 from operator import itemgetter
 from firms.models import flatten
-from music21.interval import Interval
-from music21.chord import Chord
-from music21.note import Note
+from firms.profiling import profiler
 
 def window(seq, window_size=2):
     """
@@ -38,6 +36,8 @@ def split_voices(lead, current):
         :param lead: Leading note
         :param current: Current node
     """
+    from music21.interval import Interval
+    from music21.note import Note
     num_lead = get_number_of_voices(lead)
     num_current = get_number_of_voices(current)
     if current.isNote:
@@ -57,6 +57,8 @@ def split_voice_lines(indexed_notes):
     
     returns         List of lists of tuples of the form (position, Note)
     """
+    from music21.chord import Chord
+    from music21.note import Note
     max_number_of_voices = max(get_number_of_voices(note) for idx,note in indexed_notes)
     peak = [i for i,(idx,note) in enumerate(indexed_notes) if get_number_of_voices(note) == max_number_of_voices][0]
 
@@ -101,25 +103,27 @@ def get_voice_lines(notes):
     # If everything is a rest, just wrap the line in a list and return as is
     if all(note.isRest or note.isNote for note in notes):
         return [notes]
-    indexed_notes = list(enumerate(notes))
-    indexed_non_rests = [(idx,note) for idx,note in indexed_notes if not note.isRest]
-    indexed_rests = [(idx,note) for idx,note in indexed_notes if note.isRest]
-
-    # Do voice leading IGNORING rests
-    # List[ List[ (idx, note.Note) ] ]
-    raw_voice_lines = split_voice_lines(indexed_non_rests)
-
-    # Mix the rests back in
-    voice_lines = []
-    for rvl in raw_voice_lines:
-        with_rests = chain(rvl, indexed_rests)
-        ordered = sorted(with_rests, key=itemgetter(0))
-        without_idx = [o[1] for o in ordered]
-        voice_lines.append(without_idx)
+    with profiler.stage('stem.voice_lines'):
+        indexed_notes = list(enumerate(notes))
+        indexed_non_rests = [(idx,note) for idx,note in indexed_notes if not note.isRest]
+        indexed_rests = [(idx,note) for idx,note in indexed_notes if note.isRest]
+
+        # Do voice leading IGNORING rests
+        # List[ List[ (idx, note.Note) ] ]
+        raw_voice_lines = split_voice_lines(indexed_non_rests)
+
+        # Mix the rests back in
+        voice_lines = []
+        for rvl in raw_voice_lines:
+            with_rests = chain(rvl, indexed_rests)
+            ordered = sorted(with_rests, key=itemgetter(0))
+            without_idx = [o[1] for o in ordered]
+            voice_lines.append(without_idx)
 
     return voice_lines
 
 def get_contour(note1, note2):
+    from music21.interval import Interval
     if note1.isRest and note2.isRest:
         return 's'
     elif note1.isRest and not note2.isRest:
@@ -136,6 +140,7 @@ def get_contour(note1, note2):
         return 'd'
 
 def get_interval(note1, note2):
+    from music21.interval import Interval
     if note1.isRest or note2.isRest:
         return 'rest'
     return str(Interval(note1, note2).cents)
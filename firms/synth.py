@@ -0,0 +1,147 @@
+"""
+Synthetic corpora for scale testing.
+
+Melodies are generated as NoteSequences by a first order Markov chain over melodic intervals, with
+a shared pool of motifs reused across pieces. Transitions, durations and motifs are all drawn with
+Zipf distributed weights, so a few stems are very common and most are rare, as in real corpora.
+Pieces are written straight into a SqlIRSystem without building music21 scores or MusicXML.
+"""
+
+from array import array
+from bisect import bisect
+from itertools import accumulate
+
+from firms.sampling import NoteSequence, REST, DEFAULT_ERROR_RATES, introduce_error, semitones_to_pitch
+
+# Melodic intervals, in semitones, ordered from most to least common
+INTERVALS = [0, 2, -2, 1, -1, 3, -3, 4, -4, 5, -5, 7, -7, 12, -12, 8, -8, 9, -9, 6, -6, 10, -10, 11, -11]
+# Quarter lengths, ordered from most to least common
+DURATIONS = [1.0, 0.5, 2.0, 0.25, 1.5, 4.0, 0.75, 3.0]
+# Intervals above the root added to form chords
+CHORD_SHAPES = [(4, 7), (3, 7), (7,), (4, 7, 12)]
+LOWEST_PITCH = 48
+HIGHEST_PITCH = 84
+BEATS_PER_MEASURE = 4
+
+def zipf_cumulative_weights(number_of_items, exponent):
+    """
+    Cumulative weights giving the item at rank r a weight of 1 / r^exponent
+        :param number_of_items: Number of items
+        :param exponent: Zipf exponent; larger values skew more towards the first items
+    """
+    return list(accumulate(1.0 / (rank ** exponent) for rank in range(1, number_of_items + 1)))
+
+def zipf_choice(rng, items, cumulative_weights):
+    return items[bisect(cumulative_weights, rng.random() * cumulative_weights[-1])]
+
+class MelodyGenerator:
+    """
+    Generates melodies from a Markov chain over intervals and a pool of reusable motifs.
+    A generator's chain and motifs are fixed when it is constructed from a seeded random generator,
+    so every piece in a corpus shares the same style.
+    """
+    def __init__(self, rng, zipf=1.2, motifs=200, motif_rate=0.5, chord_rate=0.0, rest_rate=0.05):
+        """
+        Constructor
+            :param self:
+            :param rng: random.Random instance
+            :param zipf=1.2: Zipf exponent of the transition, duration and motif distributions
+            :param motifs=200: Number of motifs in the shared pool
+            :param motif_rate=0.5: Probability of continuing a melody with a motif instead of a single step
+            :param chord_rate=0.0: Probability of turning a note into a chord
+            :param rest_rate=0.05: Probability of a rest
+        """
+        self.zipf = zipf
+        self.motif_rate = motif_rate
+        self.chord_rate = chord_rate
+        self.rest_rate = rest_rate
+        self.interval_weights = zipf_cumulative_weights(len(INTERVALS), zipf)
+        self.duration_weights = zipf_cumulative_weights(len(DURATIONS), zipf)
+        # Each previous interval ranks the next intervals differently, keeping small steps near the top
+        self.transitions = {}
+        for interval in INTERVALS:
+            ranked = sorted(INTERVALS, key=lambda next_interval: abs(next_interval) + rng.random() * 4)
+            self.transitions[interval] = ranked
+        self.motifs = [self.steps(rng, rng.randint(3, 8), rng.choice(INTERVALS)) for _ in range(motifs)]
+        self.motif_weights = zipf_cumulative_weights(motifs, zipf) if motifs else None
+
+    def steps(self, rng, number_of_steps, previous_interval):
+        """
+        Walk the Markov chain, returning a list of (interval, quarter length) steps
+            :param self:
+            :param rng: random.Random instance
+            :param number_of_steps: Number of steps
+            :param previous_interval: Interval the walk starts from
+        """
+        result = []
+        for _ in range(number_of_steps):
+            previous_interval = zipf_choice(rng, self.transitions[previous_interval], self.interval_weights)
+            result.append((previous_interval, zipf_choice(rng, DURATIONS, self.duration_weights)))
+        return result
+
+    def melody(self, rng, number_of_notes, start_pitch=60):
+        """
+        Generate a melody as a NoteSequence, numbering measures in 4/4
+            :param self:
+            :param rng: random.Random instance
+            :param number_of_notes: Number of notes and rests
+            :param start_pitch=60: MIDI pitch the melody starts from
+        """
+        steps = []
+        while len(steps) < number_of_notes:
+            if self.motifs and rng.random() < self.motif_rate:
+                steps.extend(zipf_choice(rng, self.motifs, self.motif_weights))
+            else:
+                steps.extend(self.steps(rng, 1, steps[-1][0] if steps else 0))
+        measures = array('l')
+        pitches = []
+        quarter_lengths = []
+        pitch = start_pitch
+        offset = 0.0
+        for interval, quarter_length in steps[:number_of_notes]:
+            pitch = pitch + interval
+            # Reflect off the edges of the range rather than drifting out of it
+            if pitch < LOWEST_PITCH or pitch > HIGHEST_PITCH:
+                pitch = pitch - 2 * interval
+            measures.append(1 + int(offset // BEATS_PER_MEASURE))
+            offset = offset + quarter_length
+            quarter_lengths.append(quarter_length)
+            if rng.random() < self.rest_rate:
+                pitches.append(REST)
+            elif rng.random() < self.chord_rate:
+                pitches.append('.'.join(semitones_to_pitch(pitch + above) for above in (0,) + rng.choice(CHORD_SHAPES)))
+            else:
+                pitches.append(semitones_to_pitch(pitch))
+        return NoteSequence(measures, pitches, quarter_lengths)
+
+    def piece(self, rng, number_of_parts, notes_per_part):
+        """
+        Generate the parts of a piece, each a NoteSequence with around notes_per_part notes.
+        Parts start an octave apart, from the top down, cycling through three octaves
+            :param self:
+            :param rng: random.Random instance
+            :param number_of_parts: Number of parts
+            :param notes_per_part: Mean number of notes in each part
+        """
+        return [
+            self.melody(rng, rng.randint(max(1, notes_per_part // 2), max(1, notes_per_part * 3 // 2)), 72 - 12 * (idx % 3))
+            for idx in range(number_of_parts)
+        ]
+
+def synth_piece_path(seed, piece_number):
+    return 'synth:%s:%s' % (seed, piece_number)
+
+def plant_query(rng, parts, minsize, maxsize, erate=0.0, error_rates=DEFAULT_ERROR_RATES):
+    """
+    Cut a query out of a generated piece, the same way evaluation samples are cut from the index
+        :param rng: random.Random instance
+        :param parts: List of NoteSequence parts of the piece
+        :param minsize: Minimum query size (in measures)
+        :param maxsize: Maximum query size (in measures)
+        :param erate=0.0: Rate at which to introduce errors
+        :param error_rates: Relative weights of add, remove, replace and transposition errors
+    """
+    sequence = rng.choice(parts)
+    sample_size = rng.randint(minsize, maxsize)
+    idx = rng.randint(1, max(1, sequence.number_of_measures() - sample_size))
+    return introduce_error(sequence.slice_measures(idx, idx + sample_size), erate, error_rates, rng)
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from firms.bench import bench_queries, compare_to_baseline, heavy_imports, sample_queries
+from firms.test_sql_irsystems import build_system
+
+def results_with(pieces_per_sec, p95_ms):
+    return {
+        'ingest': {'pieces_per_sec': pieces_per_sec, 'snippets_per_sec': None},
+        'query': {'BM25': {'p50_ms': 1.0, 'p95_ms': p95_ms, 'p99_ms': None}},
+        'db': {'bytes_per_piece': 100.0},
+        'memory': {'peak_rss_mb': 50.0}
+    }
+
+class TestCompareToBaseline(unittest.TestCase):
+    def test_regressions(self):
+        baseline = results_with(10.0, 2.0)
+        comparisons = {metric: regressed for metric, previous, current, change, regressed in
+                       compare_to_baseline(results_with(8.0, 2.1), baseline, 0.1)}
+        self.assertTrue(comparisons['ingest.pieces_per_sec'])
+        self.assertFalse(comparisons['query.BM25.p95_ms'])
+        self.assertFalse(comparisons['db.bytes_per_piece'])
+        # Metrics missing from either run are skipped
+        self.assertNotIn('ingest.snippets_per_sec', comparisons)
+        self.assertNotIn('query.BM25.p99_ms', comparisons)
+
+    def test_startup_regressions(self):
+        baseline = dict(results_with(10.0, 2.0), startup={'info general': {'p50_ms': 100.0}, 'heavy_imports': []})
+        current = dict(results_with(10.0, 2.0), startup={'info general': {'p50_ms': 150.0}, 'heavy_imports': ['music21']})
+        comparisons = {metric: regressed for metric, previous, current, change, regressed in compare_to_baseline(current, baseline, 0.1)}
+        self.assertTrue(comparisons['startup.info general.p50_ms'])
+
+    def test_improvements_are_not_regressions(self):
+        comparisons = compare_to_baseline(results_with(20.0, 1.0), results_with(10.0, 2.0), 0.1)
+        self.assertFalse(any(regressed for metric, previous, current, change, regressed in comparisons))
+
+class TestStartup(unittest.TestCase):
+    def test_command_line_defers_heavy_imports(self):
+        self.assertListEqual(heavy_imports(), [])
+
+class TestBenchQueries(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.system = build_system(os.path.join(self.directory, 'firms.sqlite.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_latency_per_grader(self):
+        queries = sample_queries(self.system, 5, 1, 1, 2)
+        self.assertEqual(len(queries), 5)
+        latencies = bench_queries(self.system, queries)
+        self.assertSetEqual(set(latencies.keys()), {'lookup', 'BM25', 'LogWeightedSumGrader'})
+        for summary in latencies.values():
+            self.assertEqual(summary['count'], 5)
+            self.assertLessEqual(summary['p50_ms'], summary['p99_ms'])
+        self.assertGreaterEqual(latencies['BM25']['p50_ms'], latencies['lookup']['p50_ms'])
+
+if __name__ == '__main__':
+    unittest.main()
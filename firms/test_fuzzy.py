@@ -0,0 +1,21 @@
+import unittest
+
+from firms.fuzzy import match_weight, stem_variants, token_edit_distance, tokenize_stem
+
+class TestFuzzy(unittest.TestCase):
+    def test_chords_are_single_tokens(self):
+        self.assertEqual(tokenize_stem("C4 [ C4 E4 G4 ] D4"), ['C4', '[ C4 E4 G4 ]', 'D4'])
+
+    def test_variants_share_deletions(self):
+        self.assertEqual(stem_variants("C4 D4 E4", 1), {"D4 E4", "C4 E4", "C4 D4"})
+        self.assertTrue(stem_variants("C4 D4 E4", 1) & stem_variants("C4 F4 E4", 1))
+        self.assertEqual(stem_variants("C4", 2), set())
+
+    def test_edit_distance(self):
+        self.assertEqual(token_edit_distance(['a', 'b', 'c'], ['a', 'x', 'c']), 1)
+        self.assertEqual(token_edit_distance(['a', 'b', 'c'], ['b', 'c', 'd']), 2)
+        self.assertEqual(match_weight(2), 0.25)
+        self.assertEqual(match_weight(0), 1)
+
+if __name__ == '__main__':
+    unittest.main()
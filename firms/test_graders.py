@@ -0,0 +1,48 @@
+import unittest
+from math import log
+
+from firms.graders import AlignmentGrader, Bm25Grader, LogWeightedSumGrader, bm25_idf, bm25_tf
+from firms.models import GraderLookup, LookupResult
+
+# Two lookups of the same stemmer; the second repeats a stem of the query and also matches stem 7 at distance 1
+LOOKUPS = [
+    (GraderLookup('By Pitch', LookupResult([1, 2, 3, 4], [10, 10, 20, 30], [0, 0, 1, 2], [0, 4, 0, 0], [5, 5, 5, 5]), (0,)), 1),
+    (GraderLookup('By Pitch', LookupResult([5, 6, 7], [10, 20, 20], [0, 1, 1], [1, 1, 2], [6, 7, 7], {7: (1, 'stem')}), (1, 3)), 2),
+    (GraderLookup('By Rythm', LookupResult([8, 9], [30, 40], [2, 3], [1, 0], [8, 8]), (1,)), 1),
+]
+N = 50
+
+def grades(grader, topk=None):
+    accumulator = grader.accumulator()
+    for matches, multiplicity in LOOKUPS:
+        accumulator.aggregate(matches, multiplicity)
+    return accumulator.grade(N, topk)
+
+class TestVectorizedGraders(unittest.TestCase):
+    def test_bm25_matches_scalar_formula(self):
+        # TF of (piece, stem), with stem 7 weighing half, and DF of each stem
+        tfs = {10: {5: 2, 6: 2}, 20: {5: 1, 7: 2}, 30: {5: 1, 8: 1}, 40: {8: 1}}
+        dfs = {5: 3, 6: 1, 7: 1, 8: 2}
+        expected = {piece: sum(bm25_tf(tf) * bm25_idf(N, dfs[stem]) for stem, tf in piece_tfs.items()) for piece, piece_tfs in tfs.items()}
+        actual = {result.piece: result.grade for result in grades(Bm25Grader())}
+        self.assertListEqual(sorted(actual), sorted(expected))
+        for piece in expected:
+            self.assertAlmostEqual(actual[piece], expected[piece])
+
+    def test_log_weighted_sum_matches_scalar_formula(self):
+        weights = {'By Pitch': 2, 'By Rythm': 0.5}
+        counts = {10: {'By Pitch': 4}, 20: {'By Pitch': 3}, 30: {'By Pitch': 1, 'By Rythm': 1}, 40: {'By Rythm': 1}}
+        actual = {result.piece: result.grade for result in grades(LogWeightedSumGrader(weights))}
+        self.assertListEqual(sorted(actual), sorted(counts))
+        for piece, stemmer_counts in counts.items():
+            self.assertAlmostEqual(actual[piece], sum(weights[stemmer] * log(count) for stemmer, count in stemmer_counts.items()))
+
+    def test_topk_is_best_first(self):
+        for grader in (Bm25Grader(), LogWeightedSumGrader({'By Pitch': 1, 'By Rythm': 1}), AlignmentGrader()):
+            ranked = sorted(grades(grader), key=lambda result: (-result.grade, result.piece))
+            self.assertListEqual(grades(grader, 2), ranked[:2])
+            self.assertListEqual(grades(grader, 10), ranked)
+            self.assertListEqual(grades(grader, 0), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from firms.index_stats import log2_buckets, bucket_label, summarize_postings, top_share
+from firms.test_sql_irsystems import INDEX_METHODS, build_system
+
+class TestPostingSummary(unittest.TestCase):
+    def test_buckets(self):
+        self.assertListEqual(log2_buckets(np.array([1, 1, 2, 3, 4, 9])), [2, 2, 1, 1])
+        self.assertListEqual([bucket_label(bucket) for bucket in range(3)], ['1', '2-3', '4-7'])
+        self.assertListEqual(log2_buckets(np.array([], np.int64)), [])
+
+    def test_summary(self):
+        lengths = np.array([1] * 99 + [101])
+        summary = summarize_postings(lengths, 100)
+        self.assertEqual(summary['postings'], 200)
+        self.assertEqual(summary['stems_per_snippet'], 2.0)
+        self.assertEqual(summary['max'], 101)
+        self.assertAlmostEqual(summary['singletons'], 0.99)
+        self.assertAlmostEqual(summary['top_share'], 101 / 200)
+        self.assertEqual(summary['p50'], 1.0)
+        self.assertEqual(top_share(np.array([], np.int64)), 0.0)
+
+class TestStemStats(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stem_stats_match_entries(self):
+        system = build_system(os.path.join(self.directory, 'firms.sqlite.db'))
+        stats = system.stem_stats(top=3)
+        self.assertSetEqual({summary['stemmer'] for summary in stats['stemmers']}, set(INDEX_METHODS))
+        entries = system.info()['entries']
+        self.assertEqual(sum(summary['postings'] for summary in stats['stemmers']), entries)
+        for summary in stats['stemmers']:
+            top_stems = stats['top_stems'][(summary['stemmer'], summary['snippet_length'])]
+            self.assertLessEqual(len(top_stems), 3)
+            self.assertEqual(top_stems[0][1], summary['max'])
+            self.assertListEqual([count for _, count in top_stems], sorted((count for _, count in top_stems), reverse=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from operator import attrgetter
+
+import numpy as np
+
+from firms.metrics import EvaluationRun, NOT_FOUND, rank_true_pieces, mean_reciprocal_rank, recall_at_k, ndcg,\
+    rank_distribution
+from firms.models import GraderResult
+
+def sorted_rank(results, true_piece):
+    ordered = sorted(results, key=attrgetter('grade'), reverse=True)
+    return next((rank for rank, result in enumerate(ordered) if result.piece == true_piece), NOT_FOUND)
+
+class TestRanks(unittest.TestCase):
+    def test_matches_sorted_ranks(self):
+        rng = random.Random(4)
+        results_lists = []
+        true_pieces = []
+        for _ in range(200):
+            pieces = rng.sample(range(50), rng.randint(0, 20))
+            # Few distinct grades, so ties are common
+            results_lists.append([GraderResult(piece, float(rng.randint(0, 4)), {}) for piece in pieces])
+            true_pieces.append(rng.randrange(50))
+        ranks, grades = rank_true_pieces(results_lists, true_pieces)
+        self.assertListEqual(list(ranks), [sorted_rank(results, piece) for results, piece in zip(results_lists, true_pieces)])
+        for results, piece, grade in zip(results_lists, true_pieces, grades):
+            expected = [result.grade for result in results if result.piece == piece]
+            if expected:
+                self.assertEqual(grade, expected[0])
+            else:
+                self.assertTrue(np.isnan(grade))
+
+    def test_no_results(self):
+        ranks, grades = rank_true_pieces([[], []], [1, 2])
+        self.assertListEqual(list(ranks), [NOT_FOUND, NOT_FOUND])
+
+class TestMetrics(unittest.TestCase):
+    ranks = np.array([0, 1, 3, NOT_FOUND, 9])
+
+    def test_mean_reciprocal_rank(self):
+        self.assertAlmostEqual(mean_reciprocal_rank(self.ranks), (1 + 1/2 + 1/4 + 0 + 1/10) / 5)
+
+    def test_recall_at_k(self):
+        self.assertAlmostEqual(recall_at_k(self.ranks, 1), 1/5)
+        self.assertAlmostEqual(recall_at_k(self.ranks, 5), 3/5)
+        self.assertAlmostEqual(recall_at_k(self.ranks, 10), 4/5)
+
+    def test_ndcg(self):
+        self.assertAlmostEqual(ndcg(self.ranks), (1 + 1/np.log2(3) + 1/np.log2(5) + 0 + 1/np.log2(11)) / 5)
+        self.assertAlmostEqual(ndcg(self.ranks, 2), (1 + 1/np.log2(3)) / 5)
+
+    def test_rank_distribution(self):
+        distribution = rank_distribution(self.ranks)
+        self.assertEqual(distribution['found'], 4)
+        self.assertEqual(distribution['missing'], 1)
+        self.assertEqual(distribution['p50'], 2.0)
+
+class TestEvaluationRun(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        query_results = [
+            {'BM25': [GraderResult(1, 2.0, {}), GraderResult(2, 3.0, {})], 'Other': [GraderResult(2, 1.0, {})]},
+            {'BM25': [GraderResult(3, 1.0, {})], 'Other': []}
+        ]
+        run = EvaluationRun.from_results([1, 3], query_results)
+        self.assertListEqual(list(run.ranks['BM25']), [1, 0])
+        self.assertListEqual(list(run.ranks['Other']), [NOT_FOUND, NOT_FOUND])
+        path = os.path.join(self.directory, 'run.npz')
+        run.save(path)
+        loaded = EvaluationRun.load(path)
+        self.assertListEqual(loaded.graders(), ['BM25', 'Other'])
+        self.assertDictEqual(loaded.summarize(), run.summarize())
+        self.assertListEqual(list(loaded.result_counts['BM25']), [2, 1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from firms.models import QueryPlan, QueryStem
+from firms.planner import CostPlanner
+from firms.test_sql_irsystems import build_system, grades_by_path, parse_query
+
+def build_plan(*stems):
+    plan = QueryPlan()
+    for offset, (stemmer, stem) in enumerate(stems):
+        plan.add(QueryStem(stemmer, 5, stem), offset)
+    return plan
+
+class TestCostPlanner(unittest.TestCase):
+    def setUp(self):
+        self.plan = build_plan(('By Contour', 'u u u u'), ('By Pitch', 'C4 D4 E4 F4 G4'), ('By Pitch', 'D4 E4 F4 G4 A4'), ('By Rythm', '1.0 1.0 1.0 1.0 1.0'))
+        self.estimates = dict(zip(self.plan, [5000, 3, 0, 800]))
+
+    def test_orders_by_value_per_cost_and_skips_missing_stems(self):
+        chosen, steps = CostPlanner().choose(self.plan, self.estimates, 100)
+        self.assertEqual([query_stem.stemmer for query_stem in chosen], ['By Pitch', 'By Rythm', 'By Contour'])
+        self.assertEqual(len(steps), 4)
+        self.assertFalse([step for step in steps if step.estimated_rows == 0][0].chosen)
+        self.assertEqual(chosen.offsets[QueryStem('By Pitch', 5, 'C4 D4 E4 F4 G4')], [1])
+
+    def test_row_budget(self):
+        chosen, steps = CostPlanner(max_rows=1000).choose(self.plan, self.estimates, 100)
+        self.assertEqual([query_stem.stemmer for query_stem in chosen], ['By Pitch', 'By Rythm'])
+        self.assertLessEqual(sum(step.estimated_rows for step in steps if step.chosen), 1000)
+
+    def test_seconds_budget(self):
+        planner = CostPlanner(max_seconds=0.0011, lookup_seconds=0.0001, row_seconds=0.000001)
+        chosen, steps = planner.choose(self.plan, self.estimates, 100)
+        self.assertEqual([query_stem.stemmer for query_stem in chosen], ['By Pitch', 'By Rythm'])
+
+class TestExplainQuery(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.system = build_system(os.path.join(self.directory, 'firms.sqlite.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_estimates_match_fetched_rows(self):
+        query = parse_query("4/4 c4 d e f g a b")
+        results, steps = self.system.explain_query(query, planner=CostPlanner())
+        for step in steps:
+            self.assertEqual(step.estimated_rows, step.actual_rows if step.chosen else 0)
+        self.assertEqual(grades_by_path(self.system, query, results), grades_by_path(self.system, query))
+
+    def test_budget_limits_rows(self):
+        query = parse_query("4/4 c4 d e f g a b")
+        results, steps = self.system.explain_query(query, planner=CostPlanner(max_rows=4))
+        self.assertLessEqual(sum(step.actual_rows for step in steps if step.chosen), 4)
+        self.assertTrue([step for step in steps if step.estimated_rows and not step.chosen])
+
+    def test_fuzzy_lookups_of_unindexed_stems_are_made(self):
+        query = parse_query("4/4 c4 d e f# g a")
+        results, steps = self.system.explain_query(query, 1, planner=CostPlanner())
+        self.assertTrue(all(step.chosen for step in steps))
+        self.assertEqual(grades_by_path(self.system, query, results), grades_by_path(self.system, query, self.system.query(query, 1)))
+
+if __name__ == '__main__':
+    unittest.main()
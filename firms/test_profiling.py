@@ -0,0 +1,57 @@
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from firms.profiling import Profiler, NULL_STAGE, profiler
+from firms.test_sql_irsystems import build_system, parse_query
+
+class TestProfiler(unittest.TestCase):
+    def test_disabled_records_nothing(self):
+        disabled = Profiler()
+        self.assertIs(disabled.stage('stage'), NULL_STAGE)
+        with disabled.stage('stage'):
+            disabled.count('counter')
+        self.assertDictEqual(disabled.report(), {'stages': {}, 'counters': {}})
+
+    def test_stages_and_counters(self):
+        enabled = Profiler()
+        enabled.enable()
+        for _ in range(3):
+            with enabled.stage('outer'):
+                with enabled.stage('inner'):
+                    enabled.count('rows', 2)
+        enabled.disable()
+        report = enabled.report()
+        self.assertEqual(report['stages']['outer']['calls'], 3)
+        self.assertGreaterEqual(report['stages']['outer']['seconds'], report['stages']['inner']['seconds'])
+        self.assertDictEqual(report['counters'], {'rows': 6})
+
+class TestQueryProfile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        profiler.disable()
+        shutil.rmtree(self.directory)
+
+    def test_query_stages(self):
+        system = build_system(os.path.join(self.directory, 'firms.sqlite.db'))
+        profiler.enable(cprofile=True)
+        system.query(parse_query("4/4 c4 d e f g a b"))
+        profiler.disable(os.path.join(self.directory, 'query.prof'))
+        profile_path = os.path.join(self.directory, 'query.json')
+        profiler.write_report(profile_path)
+        with open(profile_path) as inf:
+            report = json.load(inf)
+        self.assertEqual(report['stages']['query']['calls'], 1)
+        self.assertEqual(report['stages']['sql.lookup']['calls'], report['counters']['distinct query stems'])
+        self.assertIn('grader.grade:BM25', report['stages'])
+        self.assertIn('stem:By Pitch', report['stages'])
+        self.assertGreater(report['counters']['rows fetched'], 0)
+        self.assertGreater(pstats.Stats(os.path.join(self.directory, 'query.prof')).total_calls, 0)
+
+if __name__ == '__main__':
+    unittest.main()
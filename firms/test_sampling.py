@@ -0,0 +1,83 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from fractions import Fraction
+from music21 import converter
+
+from firms.models import get_notes_and_rests, get_snippets_for_piece
+from firms.sampling import IndexSampler, decode_notes, encode_notes, add_note_error, remove_note_error,\
+    replace_note_error, transposition_error
+from firms.stemmers import index_key_by_pitch, index_key_by_rythm
+from firms.test_sql_irsystems import PIECES, build_system
+
+def parse_notes(tiny):
+    return get_notes_and_rests(converter.parse("tinynotation: %s" % tiny))
+
+class TestNoteEncoding(unittest.TestCase):
+    def test_round_trip(self):
+        notes = parse_notes("4/4 c4 d#8 e-8 r4 trip{c8 d e} f2 g1")
+        sequence = decode_notes(encode_notes(notes))
+        rebuilt = decode_notes(encode_notes(sequence.to_stream().notesAndRests))
+        self.assertListEqual(rebuilt.pitches, sequence.pitches)
+        self.assertListEqual(rebuilt.quarter_lengths, sequence.quarter_lengths)
+        self.assertListEqual(list(sequence.measures), [1, 1, 1, 1, 1, 1, 1, 2, 2])
+        self.assertEqual(sequence.quarter_lengths[4], Fraction(1, 3))
+
+    def test_stems_match_original(self):
+        notes = parse_notes(PIECES['repeated'])
+        sequence = decode_notes(encode_notes(notes))
+        for keyfn in [index_key_by_pitch, index_key_by_rythm]:
+            expected = [keyfn(snippet) for snippet in get_snippets_for_piece("piece", "part", notes, 5)]
+            stems = [keyfn(snippet) for snippet in get_snippets_for_piece("piece", "part", list(sequence.to_stream().notesAndRests), 5)]
+            self.assertListEqual(stems, expected)
+
+    def test_slice_measures(self):
+        sequence = decode_notes(encode_notes(parse_notes(PIECES['scale'])))
+        self.assertEqual(sequence.number_of_measures(), 5)
+        self.assertListEqual(sequence.slice_measures(2, 3).pitches, ['G4', 'A4', 'B4', 'C5', 'D5', 'C5', 'B4', 'A4'])
+        self.assertEqual(len(sequence.slice_measures(7, 9)), 0)
+
+class TestErrors(unittest.TestCase):
+    def setUp(self):
+        self.sequence = decode_notes(encode_notes(parse_notes(PIECES['arpeggio'])))
+
+    def test_lengths(self):
+        rng = random.Random(1)
+        self.assertEqual(len(add_note_error(self.sequence, rng)), len(self.sequence) + 1)
+        self.assertEqual(len(remove_note_error(self.sequence, rng)), len(self.sequence) - 1)
+        self.assertEqual(len(replace_note_error(self.sequence, rng)), len(self.sequence))
+        self.assertEqual(len(self.sequence), 13)
+
+    def test_transposition_keeps_intervals(self):
+        transposed = transposition_error(self.sequence, random.Random(2))
+        original = [pitch.midi for pitch in self.sequence.to_stream().pitches]
+        result = [pitch.midi for pitch in transposed.to_stream().pitches]
+        self.assertEqual(len(set(r - o for r, o in zip(result, original))), 1)
+
+class TestIndexSampler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.system = build_system(os.path.join(self.directory, 'firms.sqlite.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_samples_are_reproducible(self):
+        sampler = IndexSampler(self.system)
+        self.assertEqual(len(sampler.pieces), len(PIECES))
+        first = [sampler.sample(piece, random.Random(5), 1, 2, 0.5) for piece in sampler.pieces]
+        second = [IndexSampler(self.system).sample(piece, random.Random(5), 1, 2, 0.5) for piece in sampler.pieces]
+        self.assertListEqual([(detail, sequence.pitches) for detail, sequence in first],
+                             [(detail, sequence.pitches) for detail, sequence in second])
+
+    def test_unmodified_sample_finds_piece(self):
+        sampler = IndexSampler(self.system)
+        for piece in sampler.pieces:
+            detail, sequence = sampler.sample(piece, random.Random(3), 2, 3)
+            results = self.system.query(sequence.to_stream())
+            self.assertEqual(max(results['BM25'], key=lambda result: result.grade).piece, detail.piece_id)
+
+if __name__ == '__main__':
+    unittest.main()
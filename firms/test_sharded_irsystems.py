@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from firms.graders import AlignmentGrader
+from firms.models import QueryBudget
+
+from firms.sharded_irsystems import ShardedIRSystem, shard_for_path, shard_paths
+from firms.test_sql_irsystems import INDEX_METHODS, PIECES, build_graders, build_system, grades_by_path, parse_query
+from firms.tokenizers import wrap_query_as_piece
+
+QUERIES = ["4/4 c4 d e f g a", "4/4 c4 e g c' g e", "4/4 a8 a a a b b", "4/4 g4 f e d c d"]
+
+def build_sharded_system(dirpath, number_of_shards):
+    system = ShardedIRSystem(dirpath, INDEX_METHODS, build_graders(), number_of_shards)
+    for name, tiny in PIECES.items():
+        system.add_piece(wrap_query_as_piece(tiny), name)
+    return system
+
+class TestShardedIRSystem(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.single = build_system(os.path.join(self.directory, 'firms.sqlite.db'))
+        self.sharded = build_sharded_system(os.path.join(self.directory, 'sharded'), 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pieces_are_partitioned(self):
+        self.assertEqual(len(shard_paths(self.sharded.dbpath)), 3)
+        self.assertEqual(self.sharded.corpus_size(), len(PIECES))
+        for name, path, piece_id in self.sharded.pieces():
+            self.assertEqual(piece_id % 3, shard_for_path(path, 3))
+            self.assertEqual(self.sharded.piece_by_id(piece_id)[0][0], piece_id)
+
+    def test_grades_match_single_file(self):
+        for tiny in QUERIES:
+            query = parse_query(tiny)
+            self.assertDictEqual(
+                grades_by_path(self.sharded, query),
+                grades_by_path(self.single, query)
+            )
+
+    def test_two_stage_matches_single_file(self):
+        for tiny in QUERIES:
+            query = parse_query(tiny)
+            self.assertDictEqual(
+                grades_by_path(self.sharded, query, self.sharded.two_stage_query(query, reranker=AlignmentGrader(), candidates=2, stage_one_stemmers=['By Pitch'])),
+                grades_by_path(self.single, query, self.single.two_stage_query(query, reranker=AlignmentGrader(), candidates=2, stage_one_stemmers=['By Pitch']))
+            )
+
+    def test_rows_per_stem_across_shards(self):
+        plan = self.sharded.plan_query(parse_query("4/4 a8 a a a b b b b a a"))
+        self.assertTrue(any(len(lookup_results) > 1 for _, _, lookup_results in self.sharded.execute_plan(plan)))
+        budget = QueryBudget(max_rows_per_stem=1)
+        lookups = list(self.sharded.execute_plan(plan, budget=budget))
+        self.assertTrue(all(len(lookup_results) <= 1 for _, _, lookup_results in lookups))
+        self.assertTrue(budget.truncated)
+
+    def test_reopen_discovers_shards(self):
+        reopened = ShardedIRSystem(self.sharded.dbpath, INDEX_METHODS, build_graders())
+        self.assertEqual(reopened.number_of_shards, 3)
+        self.assertEqual(reopened.corpus_size(), len(PIECES))
+        with self.assertRaises(ValueError):
+            ShardedIRSystem(self.sharded.dbpath, INDEX_METHODS, build_graders(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
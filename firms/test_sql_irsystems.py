@@ -0,0 +1,546 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from music21 import converter
+
+from firms.fuzzy import stem_variants
+from firms.graders import AlignmentGrader, Bm25Grader, LogWeightedSumGrader
+from firms.models import GraderLookup, LookupResult, QueryBudget, get_snippets_for_piece
+from firms.sql_irsystems import SqlIRSystem, SCHEMA_VERSION
+from firms.stemmers import index_key_by_pitch, index_key_by_simple_pitch, index_key_by_interval,\
+    index_key_by_contour, index_key_by_rythm, index_key_by_normalized_rythm
+from firms.tokenizers import wrap_query_as_piece
+
+INDEX_METHODS = {
+    'By Pitch': index_key_by_pitch,
+    'By Simple Pitch': index_key_by_simple_pitch,
+    'By Contour': index_key_by_contour,
+    'By Interval': index_key_by_interval,
+    'By Rythm': index_key_by_rythm,
+    'By Normal Rythm': index_key_by_normalized_rythm
+}
+
+WEIGHTS = {'By Pitch': 4.3, 'By Simple Pitch': 2.5, 'By Interval': 3.0, 'By Contour': -1.94, 'By Rythm': 1.36, 'By Normal Rythm': -2.85}
+
+PIECES = {
+    'scale': "4/4 c4 d e f g a b c' d' c' b a g f e d c",
+    'arpeggio': "4/4 c4 e g c' g e c e g c' g e c2",
+    'repeated': "4/4 a8 a a a b b b b a a a a g g g g a a a a"
+}
+
+def build_graders():
+    return {'BM25': Bm25Grader(), 'LogWeightedSumGrader': LogWeightedSumGrader(WEIGHTS)}
+
+def build_system(dbpath, snippet_lengths=None, query_workers=1):
+    system = SqlIRSystem(dbpath, INDEX_METHODS, build_graders(), [], False, snippet_lengths, query_workers)
+    for name, tiny in PIECES.items():
+        system.add_piece(wrap_query_as_piece(tiny), name)
+    return system
+
+def parse_query(tiny):
+    return converter.parse("tinynotation: %s" % tiny).recurse().notesAndRests
+
+def grades_by_path(system, query, results=None):
+    """
+    Grades of a query by grader, as sorted (path, rounded grade) pairs, comparable across indexes.
+    Results of another query method may be given; they default to system.query(query)
+    """
+    if results is None:
+        results = system.query(query)
+    paths = {piece_id: path for name, path, piece_id in system.pieces()}
+    return {
+        grader_name: sorted((paths[result.piece], round(result.grade, 9)) for result in grader_results)
+        for grader_name, grader_results in results.items()
+    }
+
+def top_piece(results):
+    return max(results, key=lambda result: result.grade).piece
+
+class SqlIRSystemTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.directory, 'firms.sqlite.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def piece_ids(self, system):
+        return {path: piece_id for name, path, piece_id in system.pieces()}
+
+class TestSnippetLengths(SqlIRSystemTestCase):
+    def test_default_length(self):
+        system = build_system(self.dbpath)
+        for index in system.indexes.values():
+            self.assertListEqual(index.snippet_lengths, [5])
+
+    def test_stored_lengths_are_reused(self):
+        build_system(self.dbpath, {name: [3, 5, 8] for name in INDEX_METHODS})
+        system = SqlIRSystem(self.dbpath, INDEX_METHODS, build_graders(), [], False)
+        for index in system.indexes.values():
+            self.assertListEqual(index.snippet_lengths, [3, 5, 8])
+        self.assertEqual(len(set(system.stemmer_ids.values())), 3 * len(INDEX_METHODS))
+
+    def test_query_length_uses_longest_fitting(self):
+        system = build_system(self.dbpath, {name: [3, 5, 8] for name in INDEX_METHODS})
+        index = system.indexes['By Pitch']
+        self.assertIsNone(index.query_length(2))
+        self.assertEqual(index.query_length(4), 3)
+        self.assertEqual(index.query_length(7), 5)
+        self.assertEqual(index.query_length(20), 8)
+
+    def test_short_query_matches(self):
+        system = build_system(self.dbpath, {name: [3, 5] for name in INDEX_METHODS})
+        results = system.query(parse_query("4/4 c4 e g c'"))
+        self.assertEqual(top_piece(results['BM25']), self.piece_ids(system)['arpeggio'])
+
+    def test_short_query_without_fitting_length(self):
+        system = build_system(self.dbpath)
+        results = system.query(parse_query("4/4 c4 e g c'"))
+        for grader_results in results.values():
+            self.assertListEqual(grader_results, [])
+
+class TestSchemaVersion(SqlIRSystemTestCase):
+    def test_current_schema_skips_ddl(self):
+        build_system(self.dbpath)
+        with sqlite3.connect(self.dbpath) as conn:
+            self.assertEqual(SqlIRSystem.schema_version(conn), SCHEMA_VERSION)
+            conn.execute("DROP INDEX entry_stem_idx")
+        SqlIRSystem(self.dbpath, INDEX_METHODS, build_graders(), [], False)
+        with sqlite3.connect(self.dbpath) as conn:
+            self.assertListEqual(conn.execute("SELECT name FROM sqlite_master WHERE name='entry_stem_idx'").fetchall(), [])
+            conn.execute("PRAGMA user_version = 0")
+        # Older databases are brought up to date
+        SqlIRSystem(self.dbpath, INDEX_METHODS, build_graders(), [], False)
+        with sqlite3.connect(self.dbpath) as conn:
+            self.assertEqual(len(conn.execute("SELECT name FROM sqlite_master WHERE name='entry_stem_idx'").fetchall()), 1)
+
+class TestQueryStemDeduplication(SqlIRSystemTestCase):
+    def test_repeated_stems_are_collapsed(self):
+        system = build_system(self.dbpath)
+        plan = system.plan_query(parse_query("4/4 a8 a a a a a a"))
+        rythm_stems = [(query_stem, count) for query_stem, count in plan.items() if query_stem.stemmer == 'By Rythm']
+        self.assertEqual(len(rythm_stems), 1)
+        self.assertEqual(rythm_stems[0][1], 3)
+        self.assertEqual(sum(plan.values()), 3 * len(INDEX_METHODS))
+
+    def test_scores_match_per_snippet_lookups(self):
+        system = build_system(self.dbpath)
+        query = parse_query("4/4 a8 a a a b b b b a a g g a a")
+        deduplicated = system.query(query)
+
+        accumulators = {grader_name: grader.accumulator() for grader_name, grader in build_graders().items()}
+        conn = sqlite3.connect(self.dbpath)
+        cursor = conn.cursor()
+        for index_name, index in system.indexes.items():
+            for snippet in get_snippets_for_piece("query", "query", list(query), 5):
+                matches = GraderLookup(index_name, index.lookup(snippet, conn, cursor))
+                for accumulator in accumulators.values():
+                    accumulator.aggregate(matches)
+        for grader_name, accumulator in accumulators.items():
+            expected = sorted(accumulator.grade(system.corpus_size()))
+            self.assertListEqual(sorted(deduplicated[grader_name]), expected)
+        conn.close()
+
+class TestParallelStemmerLookups(SqlIRSystemTestCase):
+    def test_parallel_matches_sequential(self):
+        sequential = build_system(self.dbpath)
+        parallel = SqlIRSystem(self.dbpath, INDEX_METHODS, build_graders(), [], False, query_workers=len(INDEX_METHODS))
+        query = parse_query("4/4 c4 d e f g a b c'")
+        expected = sequential.query(query)
+        for _ in range(3):
+            self.assertDictEqual(parallel.query(query), expected)
+
+class TestConcurrentQueries(SqlIRSystemTestCase):
+    def test_threads_share_system(self):
+        system = build_system(self.dbpath)
+        queries = [parse_query(tiny) for tiny in PIECES.values()]
+        expected = [system.query(query) for query in queries]
+        with ThreadPoolExecutor(len(queries)) as executor:
+            for _ in range(3):
+                self.assertListEqual(list(executor.map(system.query, queries)), expected)
+
+    def test_graders_are_not_modified_by_queries(self):
+        system = build_system(self.dbpath)
+        grader = system.grader_methods['BM25']
+        first = grader.accumulator()
+        system.query(parse_query("4/4 c4 d e f g a"))
+        self.assertListEqual(first.piece_ids, [])
+        self.assertIsNot(grader.accumulator(), first)
+
+class TestBatchQueries(SqlIRSystemTestCase):
+    def test_batch_matches_query(self):
+        system = build_system(self.dbpath)
+        queries = [parse_query(tiny) for tiny in PIECES.values()] + [parse_query(PIECES['scale'])]
+        expected = [system.query(query) for query in queries]
+        for chunk_size in [None, 1, 2]:
+            batch_results = list(system.batch_query(queries, chunk_size=chunk_size))
+            self.assertListEqual([batch_result.grades for batch_result in batch_results], expected)
+
+    def test_repeated_queries_share_lookups(self):
+        system = build_system(self.dbpath)
+        query = parse_query(PIECES['arpeggio'])
+        first, second = system.batch_query([query, query])
+        self.assertEqual(second.stats['lookups'], 0)
+        self.assertEqual(second.stats['cached_lookups'], first.stats['lookups'])
+
+    def test_failed_query_does_not_end_batch(self):
+        system = build_system(self.dbpath)
+        results = list(system.batch_query([None, parse_query(PIECES['scale'])]))
+        self.assertIsNotNone(results[0].error)
+        self.assertIsNone(results[1].error)
+        self.assertEqual(top_piece(results[1].grades['BM25']), self.piece_ids(system)['scale'])
+
+SLOW_STATEMENT = """WITH RECURSIVE counter(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM counter)
+                    SELECT count(*) FROM counter"""
+
+class TestAsyncQueries(SqlIRSystemTestCase):
+    def test_concurrent_aqueries_match_query(self):
+        system = build_system(self.dbpath)
+        queries = [parse_query(tiny) for tiny in PIECES.values()]
+        expected = [system.query(query) for query in queries]
+        async def run_all():
+            return await asyncio.gather(*[system.aquery(query) for query in queries])
+        self.assertListEqual(asyncio.run(run_all()), expected)
+
+    def test_deadline(self):
+        system = build_system(self.dbpath)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(system.aquery(parse_query("4/4 c4 d e f g a"), deadline=0))
+
+    def test_cancellation_interrupts_statement(self):
+        system = build_system(self.dbpath)
+        pool = system.async_pool
+        async def cancel_slow_statement():
+            task = asyncio.ensure_future(pool.run(lambda conn: conn.execute(SLOW_STATEMENT).fetchall()))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The interrupted connection is returned to the pool and can be reused
+            return await asyncio.wait_for(
+                asyncio.gather(*[pool.run(lambda conn: conn.execute("SELECT 1").fetchone()[0]) for _ in range(pool.size)]),
+                5)
+        self.assertListEqual(asyncio.run(cancel_slow_statement()), [1] * pool.size)
+
+class TestMerge(SqlIRSystemTestCase):
+    def test_merged_index_matches_single_index(self):
+        expected = build_system(self.dbpath)
+        source_paths = []
+        for name, tiny in PIECES.items():
+            source_path = os.path.join(self.directory, '%s.sqlite.db' % name)
+            SqlIRSystem(source_path, INDEX_METHODS, {}, [], False).add_piece(wrap_query_as_piece(tiny), name)
+            source_paths.append(source_path)
+        merged_path = os.path.join(self.directory, 'merged.sqlite.db')
+        with sqlite3.connect(merged_path, uri=True) as conn:
+            SqlIRSystem.ensure_db(conn)
+            counts = [SqlIRSystem.merge(conn, source_path) for source_path in source_paths + source_paths[:1]]
+        self.assertListEqual([count['pieces'] for count in counts], [1, 1, 1, 0])
+        self.assertEqual(counts[-1]['skipped'], 1)
+        merged = SqlIRSystem(merged_path, INDEX_METHODS, build_graders(), [], False)
+        self.assertDictEqual(merged.info(), expected.info())
+        for tiny in ["4/4 c4 d e f g a", "4/4 c4 e g c' g e", "4/4 a8 a a a b b"]:
+            query = parse_query(tiny)
+            self.assertDictEqual(grades_by_path(merged, query), grades_by_path(expected, query))
+
+    def test_skipped_pieces_add_no_stems(self):
+        build_system(self.dbpath)
+        source_path = os.path.join(self.directory, 'source.sqlite.db')
+        SqlIRSystem(source_path, INDEX_METHODS, {}, [], False).add_piece(wrap_query_as_piece("4/4 g8 f# e d c# b a g"), 'scale')
+        with sqlite3.connect(self.dbpath, uri=True) as conn:
+            stems = conn.execute("SELECT count(*) FROM stems").fetchone()[0]
+            self.assertEqual(SqlIRSystem.merge(conn, source_path)['skipped'], 1)
+            self.assertEqual(conn.execute("SELECT count(*) FROM stems").fetchone()[0], stems)
+
+    def test_older_source_is_read_only(self):
+        source_path = os.path.join(self.directory, 'source.sqlite.db')
+        SqlIRSystem(source_path, INDEX_METHODS, {}, [], False, {'By Pitch': [5]}).add_piece(wrap_query_as_piece(PIECES['scale']), 'scale')
+        with sqlite3.connect(source_path) as source:
+            # As written before snippet lengths and part notes were stored
+            source.execute("DROP TABLE part_notes")
+            source.execute("ALTER TABLE stemmers DROP COLUMN snippet_length")
+            source.execute("PRAGMA user_version = 1")
+        with open(source_path, 'rb') as f:
+            contents = f.read()
+        with sqlite3.connect(self.dbpath, uri=True) as conn:
+            SqlIRSystem.ensure_db(conn)
+            self.assertEqual(SqlIRSystem.merge(conn, source_path)['pieces'], 1)
+        with open(source_path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        merged = SqlIRSystem(self.dbpath, {'By Pitch': index_key_by_pitch}, build_graders(), [], False)
+        self.assertEqual(top_piece(merged.query(parse_query("4/4 c4 d e f g a"))['BM25']), self.piece_ids(merged)['scale'])
+
+    def test_newer_source_is_refused(self):
+        source_path = os.path.join(self.directory, 'source.sqlite.db')
+        with sqlite3.connect(source_path) as source:
+            SqlIRSystem.ensure_db(source)
+            source.execute("PRAGMA user_version = %d" % (SCHEMA_VERSION + 1))
+        with sqlite3.connect(self.dbpath, uri=True) as conn:
+            SqlIRSystem.ensure_db(conn)
+            with self.assertRaises(ValueError):
+                SqlIRSystem.merge(conn, source_path)
+
+class TestRemove(SqlIRSystemTestCase):
+    QUERIES = ["4/4 c4 d e f g a", "4/4 c4 e g c' g e", "4/4 a8 a a a b b"]
+
+    def assert_same_index(self, system, expected):
+        self.assertDictEqual(system.info(), expected.info())
+        for tiny in self.QUERIES:
+            query = parse_query(tiny)
+            self.assertDictEqual(grades_by_path(system, query), grades_by_path(expected, query))
+
+    def test_remove_matches_index_without_piece(self):
+        system = build_system(self.dbpath)
+        system.add_piece(wrap_query_as_piece("4/4 f4 f# g a- a b- b c'"), 'chromatic')
+        counts = system.remove_path('chromatic')
+        self.assertEqual(counts['pieces'], 1)
+        self.assertGreater(counts['stems'], 0)
+        self.assertListEqual(system.piece_ids_by_path('chromatic'), [])
+        self.assert_same_index(system, build_system(os.path.join(self.directory, 'expected.sqlite.db')))
+
+    def test_replace_updates_in_place(self):
+        system = build_system(self.dbpath)
+        changed = "4/4 c4 d e f g a b c' b a g f e d c"
+        system.replace_piece(wrap_query_as_piece(changed), 'scale')
+        self.assertEqual(len(system.piece_ids_by_path('scale')), 1)
+        expected = SqlIRSystem(os.path.join(self.directory, 'expected.sqlite.db'), INDEX_METHODS, build_graders(), [], False)
+        for name, tiny in PIECES.items():
+            expected.add_piece(wrap_query_as_piece(changed if name == 'scale' else tiny), name)
+        self.assert_same_index(system, expected)
+
+    def test_failed_replace_keeps_old_piece(self):
+        system = build_system(self.dbpath)
+        # The second score can't be indexed, after the first has been
+        with self.assertRaises(AttributeError):
+            system.add_scores([wrap_query_as_piece("4/4 c4 d e f g a b c'"), None], 'scale', replace=True)
+        self.assert_same_index(system, build_system(os.path.join(self.directory, 'expected.sqlite.db')))
+
+class TestStemFilters(SqlIRSystemTestCase):
+    QUERIES = ["4/4 c4 d e f g a", "4/4 f4 f# g a- a b- b", "4/4 c4 d e f# g a"]
+
+    def assert_same_grades(self, system):
+        unfiltered = SqlIRSystem(self.dbpath, INDEX_METHODS, build_graders(), [], False, stem_filters=False)
+        for tiny in self.QUERIES:
+            query = parse_query(tiny)
+            self.assertDictEqual(grades_by_path(system, query), grades_by_path(unfiltered, query))
+
+    def test_filters_follow_other_writers(self):
+        system = build_system(self.dbpath)
+        self.assert_same_grades(system)
+        with sqlite3.connect(self.dbpath) as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM stem_filters").fetchone()[0], len(INDEX_METHODS))
+        writer = SqlIRSystem(self.dbpath, INDEX_METHODS, {}, [], False)
+        writer.add_piece(wrap_query_as_piece("4/4 f4 f# g a- a b- b c'"), 'chromatic')
+        self.assert_same_grades(system)
+        writer.remove_path('chromatic')
+        writer.add_piece(wrap_query_as_piece("4/4 c4 d e f# g a b c'"), 'lydian')
+        self.assert_same_grades(system)
+
+    def test_queries_do_not_write_filters(self):
+        system = build_system(self.dbpath)
+        with sqlite3.connect(self.dbpath) as conn:
+            conn.execute("DELETE FROM stem_filters")
+        reader = SqlIRSystem(self.dbpath, INDEX_METHODS, build_graders(), [], False)
+        self.assert_same_grades(reader)
+        self.assertTrue(reader.indexes['By Pitch'].stem_filters)
+        with sqlite3.connect(self.dbpath) as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM stem_filters").fetchone()[0], 0)
+
+    def test_missing_stems_skip_lookups(self):
+        system = build_system(self.dbpath)
+        system.query(parse_query(self.QUERIES[0]))
+        stats = {s['stemmer']: s for s in system.stem_filter_stats()}
+        self.assertLess(stats['By Pitch']['false_positive_rate'], 0.01)
+        idx = system.indexes['By Pitch']
+        stem_filter = idx.stem_filters[idx.stemmer_ids[5]]
+        self.assertNotIn('not a stem', stem_filter)
+
+def pitch_stem(tiny):
+    return index_key_by_pitch(converter.parse("tinynotation: %s" % tiny).flatten())[0]
+
+class TestFuzzy(SqlIRSystemTestCase):
+    # The scale with one wrong note
+    QUERY = "4/4 c4 d e f# g a b c'"
+
+    def pitch_matches(self, system, piece_id, *args):
+        idx = system.indexes['By Pitch']
+        with sqlite3.connect(self.dbpath) as conn:
+            matches = idx.lookup_stem(pitch_stem("4/4 c4 d e f# g"), 5, conn, conn.cursor(), *args)
+        return matches.in_pieces({piece_id})
+
+    def test_one_wrong_note_matches(self):
+        system = build_system(self.dbpath, {'By Pitch': [5]})
+        scale = self.piece_ids(system)['scale']
+        self.assertEqual(len(self.pitch_matches(system, scale)), 0)
+        matches = self.pitch_matches(system, scale, 1)
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches.distance(matches.stems[0]), 1)
+        self.assertEqual(matches.matched_stems[matches.stems[0]], (1, pitch_stem("4/4 c4 d e f g")))
+
+    def test_fuzzy_matches_weigh_less(self):
+        system = build_system(self.dbpath, {'By Pitch': [5]})
+        query = parse_query(self.QUERY)
+        exact = {result.piece: result.grade for result in system.query(query)['LogWeightedSumGrader']}
+        fuzzy = {result.piece: result.grade for result in system.query(query, 1)['LogWeightedSumGrader']}
+        scale = self.piece_ids(system)['scale']
+        self.assertGreater(fuzzy[scale], exact.get(scale, 0))
+
+    def test_queries_do_not_write_fuzzy_index(self):
+        system = build_system(self.dbpath, {'By Pitch': [5]})
+        query = parse_query(self.QUERY)
+        with sqlite3.connect(self.dbpath) as writer:
+            writer.execute("BEGIN IMMEDIATE")
+            in_memory = grades_by_path(system, query, system.query(query, 1))
+            writer.rollback()
+        with sqlite3.connect(self.dbpath) as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM stem_variants").fetchone()[0], 0)
+        system.build_fuzzy_indexes(1)
+        reader = SqlIRSystem(self.dbpath, INDEX_METHODS, build_graders(), [], False, {'By Pitch': [5]})
+        self.assertEqual(grades_by_path(reader, query, reader.query(query, 1)), in_memory)
+        self.assertFalse(reader.indexes['By Pitch'].fuzzy_variants)
+
+    def test_index_follows_ingest_and_removal(self):
+        system = build_system(self.dbpath, {'By Pitch': [5]})
+        system.build_fuzzy_indexes(2)
+        scale = self.piece_ids(system)['scale']
+        self.assertEqual(len(self.pitch_matches(system, scale, 2)), 1)
+        system.add_piece(wrap_query_as_piece("4/4 c4 d e f# g a b c'"), 'lydian')
+        lydian = self.piece_ids(system)['lydian']
+        query = parse_query(self.QUERY)
+        self.assertIn(lydian, [result.piece for result in system.query(query, 1)['BM25']])
+        system.remove_path('scale')
+        self.assertEqual(len(self.pitch_matches(system, scale, 2)), 0)
+        with sqlite3.connect(self.dbpath) as conn:
+            orphans = conn.execute("SELECT count(*) FROM stem_variants WHERE stem_id NOT IN (SELECT id FROM stems)").fetchone()[0]
+        self.assertEqual(orphans, 0)
+
+    def test_candidates_and_neighbours_are_capped(self):
+        system = build_system(self.dbpath, {'By Pitch': [5]})
+        system.add_piece(wrap_query_as_piece("4/4 c4 d e- f# a-"), 'far')
+        idx = system.indexes['By Pitch']
+        stem = pitch_stem("4/4 c4 d e f# g")
+        variants = list(stem_variants(stem, 2))
+        with sqlite3.connect(self.dbpath) as conn:
+            self.assertGreater(len(idx.fuzzy_candidates(idx.stemmer_ids[5], variants, 2, conn.cursor())), 1)
+            self.assertEqual(len(idx.fuzzy_candidates(idx.stemmer_ids[5], variants, 2, conn.cursor(), 1)), 1)
+            system.build_fuzzy_indexes(2)
+            self.assertEqual(len(idx.fuzzy_candidates(idx.stemmer_ids[5], variants, 2, conn.cursor(), 1)), 1)
+            # Only the nearest neighbour's rows fit in the budget
+            budget = QueryBudget(max_rows_per_stem=1)
+            matches = idx.lookup_stem(stem, 5, conn, conn.cursor(), 2, None, budget)
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches.distance(matches.stems[0]), 1)
+        self.assertTrue(budget.truncated)
+
+    def test_failed_index_update_adds_nothing(self):
+        system = build_system(self.dbpath)
+        system.build_fuzzy_indexes(1)
+        pieces = system.pieces()
+
+        def fail(*args):
+            raise sqlite3.OperationalError("disk I/O error")
+        # Indexes are updated in order, so this fails once the first stemmer's variants are stored
+        list(system.indexes.values())[1].add_stem_variants = fail
+        with self.assertRaises(sqlite3.OperationalError):
+            system.add_piece(wrap_query_as_piece("4/4 c4 d e f# g a b c'"), 'lydian')
+        self.assertEqual(system.pieces(), pieces)
+
+    def test_budget_counts_exact_and_neighbour_rows(self):
+        system = build_system(self.dbpath, {'By Pitch': [5]})
+        system.add_piece(wrap_query_as_piece("4/4 c4 d e f# g"), 'lydian')
+        idx = system.indexes['By Pitch']
+        with sqlite3.connect(self.dbpath) as conn:
+            self.assertEqual(len(idx.lookup_stem(pitch_stem("4/4 c4 d e f g"), 5, conn, conn.cursor(), 1)), 2)
+            budget = QueryBudget(max_rows_per_stem=1)
+            self.assertEqual(len(idx.lookup_stem(pitch_stem("4/4 c4 d e f g"), 5, conn, conn.cursor(), 1, None, budget)), 1)
+        self.assertTrue(budget.truncated)
+
+class TestTwoStageQuery(SqlIRSystemTestCase):
+    def test_plan_records_query_offsets(self):
+        system = build_system(self.dbpath)
+        plan = system.plan_query(parse_query("4/4 c4 d e c d e c d"))
+        offsets = {query_stem.stem: plan.offsets[query_stem] for query_stem in plan if query_stem.stemmer == 'By Pitch'}
+        self.assertEqual(offsets[pitch_stem("4/4 c4 d e c d")], [0, 3])
+        self.assertEqual(offsets[pitch_stem("4/4 d4 e c d e")], [1])
+
+    def test_lookups_restricted_to_pieces(self):
+        system = build_system(self.dbpath)
+        plan = system.plan_query(parse_query("4/4 c4 d e f g a"))
+        scale = self.piece_ids(system)['scale']
+        for (query_stem, _, matches), (_, _, restricted) in zip(system.execute_plan(plan), system.execute_plan(plan, piece_ids=[scale])):
+            self.assertEqual(restricted, matches.in_pieces({scale}))
+
+    def test_many_candidate_pieces(self):
+        system = build_system(self.dbpath)
+        plan = system.plan_query(parse_query("4/4 c4 d e f g a"))
+        # More ids than sqlite allows parameters in a statement, as a large --rerank may give
+        piece_ids = [piece_id + 1000 for piece_id in range(300000)] + [self.piece_ids(system)['scale']]
+        for (query_stem, _, matches), (_, _, restricted) in zip(system.execute_plan(plan), system.execute_plan(plan, piece_ids=piece_ids)):
+            self.assertEqual(restricted, matches.in_pieces(set(piece_ids)))
+
+    def test_alignment_ranks_consecutive_matches(self):
+        system = build_system(self.dbpath)
+        results = system.two_stage_query(parse_query("4/4 c4 d e f g a b"), reranker=AlignmentGrader(), candidates=2, stage_one_stemmers=['By Rythm'])['Reranked']
+        self.assertEqual(len(results), 2)
+        best = max(results, key=lambda result: result.grade)
+        self.assertEqual(best.piece, self.piece_ids(system)['scale'])
+        self.assertEqual((best.meta['query_offset'], best.meta['offset']), (0, 0))
+        self.assertIn('stage_one', best.meta)
+
+class TestLookupResult(SqlIRSystemTestCase):
+    def test_columns_describe_matches(self):
+        system = build_system(self.dbpath, {'By Pitch': [5]})
+        scale = self.piece_ids(system)['scale']
+        idx = system.indexes['By Pitch']
+        with sqlite3.connect(self.dbpath) as conn:
+            matches = idx.lookup_stem(pitch_stem("4/4 d4 e f g a"), 5, conn, conn.cursor())
+            part_ids = [row[0] for row in conn.execute("SELECT id FROM parts WHERE piece_id=?", (scale,))]
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(list(matches.piece_ids), [scale])
+        self.assertIn(matches.parts[0], part_ids)
+        self.assertEqual(list(matches.offsets), [1])
+        self.assertEqual(matches.matched_stems, {})
+
+    def test_select(self):
+        matches = LookupResult([1, 2, 3], [10, 20, 10], [4, 5, 4], [0, 7, 8], [9, 9, 9])
+        self.assertEqual(matches.in_pieces({10}).rows(), [(1, 10, 4, 0, 9), (3, 10, 4, 8, 9)])
+        self.assertEqual(matches.head(1).rows(), [(1, 10, 4, 0, 9)])
+        matches.extend(LookupResult([4], [30], [6], [1], [8], {8: (1, 'stem')}))
+        self.assertEqual(len(matches), 4)
+        self.assertEqual((matches.distance(8), matches.distance(9)), (1, 0))
+
+class TestQueryBudget(SqlIRSystemTestCase):
+    QUERY = "4/4 a8 a a a b b b b a a"
+
+    def test_unlimited_query_is_not_truncated(self):
+        system = build_system(self.dbpath)
+        results = system.query(parse_query(self.QUERY), max_rows=10000)
+        self.assertFalse(results.truncated)
+        self.assertDictEqual(results, system.query(parse_query(self.QUERY)))
+
+    def test_rows_per_stem(self):
+        system = build_system(self.dbpath)
+        budget = QueryBudget(max_rows_per_stem=1)
+        lookups = list(system.execute_plan(system.plan_query(parse_query(self.QUERY)), budget=budget))
+        self.assertTrue(all(len(lookup_results) <= 1 for _, _, lookup_results in lookups))
+        self.assertTrue(budget.truncated)
+        self.assertTrue(system.query(parse_query(self.QUERY), max_rows_per_stem=1).truncated)
+
+    def test_total_rows(self):
+        system = build_system(self.dbpath)
+        budget = QueryBudget(max_rows=5)
+        lookups = list(system.execute_plan(system.plan_query(parse_query(self.QUERY)), budget=budget))
+        self.assertEqual(sum(len(lookup_results) for _, _, lookup_results in lookups), 5)
+        self.assertTrue(budget.truncated)
+
+    def test_deadline(self):
+        system = build_system(self.dbpath, query_workers=2)
+        results = system.query(parse_query(self.QUERY), deadline=0)
+        self.assertTrue(results.truncated)
+        self.assertEqual(results['BM25'], [])
+
+if __name__ == '__main__':
+    unittest.main()
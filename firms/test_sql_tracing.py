@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from firms.sql_tracing import SqlTracer, sql_tracer
+from firms.test_sql_irsystems import build_system, parse_query
+
+class TestSqlTracer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.directory, 'traced.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_disabled_connections_are_plain(self):
+        conn = SqlTracer().connect(self.dbpath)
+        self.assertIs(type(conn), sqlite3.Connection)
+        conn.close()
+
+    def test_statements_and_slow_log(self):
+        tracer = SqlTracer()
+        slow_log = os.path.join(self.directory, 'slow.jsonl')
+        tracer.enable(slow_ms=0, slow_log=slow_log)
+        conn = tracer.connect(self.dbpath)
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE numbers (value INTEGER)")
+        cursor.executemany("INSERT INTO numbers (value) VALUES (?)", [(value,) for value in range(10)])
+        for _ in range(2):
+            cursor.execute("SELECT value FROM numbers WHERE value > ?", (4,))
+            self.assertEqual(len(cursor.fetchall()), 5)
+        self.assertEqual(len(list(cursor.execute("SELECT value FROM numbers"))), 10)
+        conn.commit()
+        conn.close()
+        statements = tracer.statements[self.dbpath]
+        self.assertListEqual(statements["SELECT value FROM numbers WHERE value > ?"][::3], [2, 10])
+        self.assertEqual(statements["SELECT value FROM numbers"][3], 10)
+        self.assertEqual(statements["INSERT INTO numbers (value) VALUES (?)"][3], 10)
+        self.assertTrue(tracer.plans[self.dbpath]["SELECT value FROM numbers WHERE value > ?"][0].startswith('SCAN'))
+        with open(slow_log) as inf:
+            logged = [json.loads(line) for line in inf]
+        self.assertIn("SELECT value FROM numbers WHERE value > 4", [entry['statement'] for entry in logged])
+
+    def test_save_merges_into_index(self):
+        tracer = SqlTracer()
+        tracer.enable()
+        sqlite3.connect(self.dbpath).execute("CREATE TABLE numbers (value INTEGER)")
+        for _ in range(2):
+            conn = tracer.connect(self.dbpath)
+            conn.execute("SELECT 1").fetchall()
+            tracer.record_stem(self.dbpath, 'By Pitch', 5, 'C4 D4 E4 F4 G4', 0.5, 3)
+            tracer.save()
+        conn = sqlite3.connect(self.dbpath)
+        self.assertListEqual(conn.execute("SELECT calls, rows FROM sql_statement_stats WHERE statement='SELECT 1'").fetchall(), [(2, 2)])
+        self.assertListEqual(conn.execute("SELECT stemmer, calls, seconds, rows FROM sql_stem_stats").fetchall(), [('By Pitch', 2, 1.0, 6)])
+        conn.close()
+
+class TestQueryTracing(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sql_tracer.disable()
+        sql_tracer.reset()
+        shutil.rmtree(self.directory)
+
+    def test_lookups_by_stemmer(self):
+        system = build_system(os.path.join(self.directory, 'firms.sqlite.db'))
+        self.assertIsNone(system.sql_stats(10))
+        sql_tracer.enable()
+        system.query(parse_query("4/4 c4 d e f g a b"))
+        sql_tracer.disable()
+        sql_tracer.save()
+        statements, stems, stemmers = system.sql_stats(10)
+        self.assertTrue(any(statement.startswith('SELECT snippets.id') for statement, *_ in statements))
+        self.assertIn('By Pitch', [stemmer for stemmer, *_ in stemmers])
+        self.assertEqual(sum(calls for _, calls, _, _ in stemmers), sum(calls for _, _, _, calls, _, _ in system.sql_stats(1000)[1]))
+        system.reset_sql_stats()
+        self.assertIsNone(system.sql_stats(10))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+
+from firms.stem_filters import StemFilter, filter_shape
+
+class TestStemFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        stem_filter = StemFilter.for_stems(2000)
+        for i in range(2000):
+            stem_filter.add("stem %s" % i, i + 1)
+        self.assertTrue(all("stem %s" % i in stem_filter for i in range(2000)))
+        self.assertEqual(stem_filter.stems, 2000)
+        self.assertEqual(stem_filter.max_stem_id, 2000)
+        self.assertFalse(stem_filter.full())
+
+    def test_false_positive_rate(self):
+        stem_filter = StemFilter(5000)
+        for i in range(5000):
+            stem_filter.add("stem %s" % i)
+        false_positives = sum("missing %s" % i in stem_filter for i in range(20000)) / 20000
+        self.assertLess(false_positives, 0.02)
+        self.assertAlmostEqual(stem_filter.false_positive_rate(), 0.01, delta=0.005)
+
+    def test_round_trip(self):
+        stem_filter = StemFilter(100)
+        stem_filter.add("a", 3)
+        stored = StemFilter(stem_filter.capacity, stem_filter.number_of_hashes, bytes(stem_filter.bits), stem_filter.stems, stem_filter.max_stem_id)
+        self.assertIn("a", stored)
+        self.assertEqual(stored.memory_bytes(), filter_shape(100)[0] // 8)
+
+if __name__ == '__main__':
+    unittest.main()
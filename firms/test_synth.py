@@ -0,0 +1,69 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+from firms.sampling import decode_notes, pitch_to_semitones, REST
+from firms.sql_irsystems import SqlIRSystem
+from firms.synth import MelodyGenerator, plant_query, synth_piece_path
+from firms.test_sql_irsystems import INDEX_METHODS, build_graders
+
+def generate(seed, **kwargs):
+    rng = random.Random(seed)
+    return MelodyGenerator(rng, **kwargs).piece(rng, 2, 60)
+
+class TestMelodyGenerator(unittest.TestCase):
+    def test_seeded_generation_is_reproducible(self):
+        self.assertListEqual([part.encode() for part in generate(3)], [part.encode() for part in generate(3)])
+        self.assertNotEqual([part.encode() for part in generate(3)], [part.encode() for part in generate(4)])
+
+    def test_encoding_round_trips(self):
+        for part in generate(1, chord_rate=0.2):
+            decoded = decode_notes(part.encode())
+            self.assertListEqual(decoded.pitches, part.pitches)
+            self.assertListEqual(list(decoded.measures), list(part.measures))
+            self.assertListEqual(list(part.measures), sorted(part.measures))
+
+    def test_stem_frequencies_are_skewed(self):
+        rng = random.Random(2)
+        generator = MelodyGenerator(rng, rest_rate=0.0)
+        intervals = Counter()
+        for _ in range(20):
+            semitones = [pitch_to_semitones(pitch) for pitch in generator.melody(rng, 100).pitches]
+            intervals.update(b - a for a, b in zip(semitones, semitones[1:]))
+        counts = sorted(intervals.values(), reverse=True)
+        self.assertGreater(counts[0], 5 * counts[len(counts) // 2])
+
+    def test_chords_and_rests(self):
+        rng = random.Random(5)
+        melody = MelodyGenerator(rng, chord_rate=1.0, rest_rate=0.5).melody(rng, 100)
+        self.assertIn(REST, melody.pitches)
+        self.assertTrue(all(pitches == REST or '.' in pitches for pitches in melody.pitches))
+
+class TestPlantedQueries(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_planted_query_finds_piece(self):
+        system = SqlIRSystem(os.path.join(self.directory, 'firms.sqlite.db'), INDEX_METHODS, build_graders(), [], False)
+        rng = random.Random(0)
+        generator = MelodyGenerator(rng)
+        piece_ids = []
+        planted = []
+        for piece_number in range(10):
+            parts = generator.piece(rng, 1, 80)
+            piece_ids.append(system.add_parts(synth_piece_path(0, piece_number), "Synthetic %s" % piece_number,
+                                              [("Part 0", parts[0].to_notes(), parts[0].encode())]))
+            planted.append(plant_query(rng, parts, 3, 5))
+        self.assertEqual(system.corpus_size(), 10)
+        for piece_id, query in zip(piece_ids, planted):
+            results = system.query(query.to_stream())
+            self.assertEqual(max(results['BM25'], key=lambda result: result.grade).piece, piece_id)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,5 +26,6 @@ setup(
         'music21',
         'tabulate',
         'click',
-        'scipy'
+        'scipy',
+        'numpy'
     ])